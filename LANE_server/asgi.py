@@ -18,11 +18,17 @@ django.setup()
 from django.core.asgi import get_asgi_application
 from ariadne.asgi import GraphQL
 from .graphql_config import schema
+from apps.histograms.export import export_histograms
 from django.urls import path, re_path
 from django.conf import settings
 from channels.routing import URLRouter
 from channels.auth import AuthMiddlewareStack
 from starlette.middleware.cors import CORSMiddleware
+from apps.histograms.livestore import get_live_store
+
+# Attach the live store, if enabled, before serving anything, so that
+# a live db that does not fit in the store stops the server from starting
+get_live_store()
 
 application = AuthMiddlewareStack(
     URLRouter(
@@ -35,6 +41,14 @@ application = AuthMiddlewareStack(
                     allow_methods=["*"],
                 ),
             ),
+            path(
+                "export/histograms/",
+                CORSMiddleware(
+                    export_histograms,
+                    allow_origins=settings.CORS_ALLOWED_ORIGINS,
+                    allow_methods=["GET"],
+                ),
+            ),
             re_path(r"", get_asgi_application()),
         ]
     )
@@ -0,0 +1,27 @@
+"""
+Database access from async resolvers
+
+`database_sync_to_async` from channels runs every call on a single thread,
+so a slow query holds up all other queries and mutations of the process.
+Resolvers that only read may use `database_read_async` instead, which runs
+them on a pool of settings.DATABASE_READ_WORKERS threads, each with its own
+connections. Anything that writes keeps using `database_sync_to_async`,
+so writes remain serialized
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync, database_sync_to_async
+from django.conf import settings
+
+_read_executor = ThreadPoolExecutor(max_workers=settings.DATABASE_READ_WORKERS, thread_name_prefix='lane-db-read') if settings.DATABASE_READ_WORKERS else None
+
+
+def database_read_async(func):
+    '''Decorator running a read-only database function on the read pool
+
+    Falls back to `database_sync_to_async` if DATABASE_READ_WORKERS is 0
+    '''
+    if _read_executor is None:
+        return database_sync_to_async(func)
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=_read_executor)
@@ -1,6 +1,6 @@
 from ariadne import make_executable_schema, load_schema_from_path, gql
 
-from apps.histograms.query import query as h_query
+from apps.histograms.query import query as h_query, histogram_type, hist_table_entry_type
 from apps.histograms.mutation import mutation as h_mutation
 from apps.histograms.subscription import subscription as h_subscription
 from apps.histograms.scalar import datetime_scalar
@@ -27,6 +27,8 @@ for file in schema_files:
 schema = make_executable_schema(
     type_defs,
     h_query,
+    histogram_type,
+    hist_table_entry_type,
     h_mutation,
     h_subscription,
     datetime_scalar,
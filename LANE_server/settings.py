@@ -94,21 +94,63 @@ WSGI_APPLICATION = 'LANE_server.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# PRAGMAs run on every new sqlite connection, see LANE_server/sqlite3/base.py
+# In WAL mode readers no longer wait for writers (and vice versa), and with synchronous=normal
+# a commit does not wait for the disk, at the cost of the last commits on power loss (not corruption)
+# Each database gets its own copy, which may override these in its 'PRAGMAS'
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get("LANE_SQLITE_JOURNAL_MODE", "wal"),
+    'synchronous': os.environ.get("LANE_SQLITE_SYNCHRONOUS", "normal"),
+    'mmap_size': int(os.environ.get("LANE_SQLITE_MMAP_SIZE", 256 * 2**20)),  # [bytes]
+    'cache_size': int(os.environ.get("LANE_SQLITE_CACHE_SIZE", -64 * 2**10)),  # negative: [KiB] per connection
+    'busy_timeout': int(os.environ.get("LANE_SQLITE_BUSY_TIMEOUT", 5000)),  # [ms] to wait for the write lock
+    'temp_store': os.environ.get("LANE_SQLITE_TEMP_STORE", "memory"),
+}
+
 DATABASES = {
     'data': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'LANE_server.sqlite3',
         'NAME': BASE_DIR / 'db/data.sqlite3',
+        'PRAGMAS': dict(SQLITE_PRAGMAS),
     },
     'default': {  # Making the users database the default as the other databases may be backed up/deleted
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'LANE_server.sqlite3',
         'NAME': BASE_DIR / 'db/users.sqlite3',
+        'PRAGMAS': dict(SQLITE_PRAGMAS),
     },
     'live': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'LANE_server.sqlite3',
         'NAME': BASE_DIR / 'db/liveData.sqlite3',
+        'PRAGMAS': dict(SQLITE_PRAGMAS),
     },
 }
 
+# Number of threads serving read-only queries in parallel, see LANE_server/db.py
+# Writes are always made from a single thread. 0 serializes reads with the writes
+DATABASE_READ_WORKERS = int(os.environ.get("LANE_DB_READ_WORKERS", 4))
+
+# [frames per second] max rate of subscription frames sent to each client, see apps/histograms/broadcast.py
+# Clients may ask for a lower rate. 0 removes the cap
+SUBSCRIPTION_MAX_FRAME_RATE = float(os.environ.get("LANE_SUBSCRIPTION_MAX_FRAME_RATE", 2))
+
+# Live histograms may be kept in shared memory instead of the live db,
+# see apps/histograms/livestore.py. All server processes on the host share the store
+LIVE_STORE = {
+    'ENABLED': strtobool(os.environ.get("LANE_LIVE_STORE", "False")),
+    'NAME': os.environ.get("LANE_LIVE_STORE_NAME", "lane_live_histograms"),
+    'SLOTS': int(os.environ.get("LANE_LIVE_STORE_SLOTS", 64)),  # Max number of live histograms
+    'POINTS': int(os.environ.get("LANE_LIVE_STORE_POINTS", 16384)),  # Max number of points per live histogram
+    'SNAPSHOT_INTERVAL': 10,  # [seconds] between copies of the store to the live db
+}
+
+# Updates to histograms (`updateHistogram`) may be held in memory and saved
+# together, see apps/histograms/writebehind.py
+WRITE_BEHIND = {
+    'ENABLED': strtobool(os.environ.get("LANE_WRITE_BEHIND", "False")),
+    'WINDOW': float(os.environ.get("LANE_WRITE_BEHIND_WINDOW", 0.5)),  # [seconds] max time an update stays unsaved
+    'MAX_PENDING': 256,  # Number of histograms with unsaved updates that triggers an early save
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -0,0 +1,38 @@
+"""
+SQLite database backend used for all LANE databases
+
+Identical to django.db.backends.sqlite3, except that
+- transactions take the write lock as soon as they begin. With a plain `BEGIN`,
+  a transaction that reads before it writes fails immediately with "database is
+  locked" whenever another connection is writing, instead of waiting for the busy timeout
+- the PRAGMAs in the database's 'PRAGMAS' setting (see settings.SQLITE_PRAGMAS)
+  are run on every new connection
+"""
+
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+# PRAGMAs that may be set in the 'PRAGMAS' of a database
+PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout', 'temp_store')
+
+
+def apply_pragmas(connection, pragmas):
+    '''Runs `PRAGMA name = value` on a sqlite3 connection for every item of `pragmas`'''
+    for name, value in pragmas.items():
+        if name not in PRAGMAS:
+            raise ImproperlyConfigured(f'Unsupported sqlite PRAGMA {name!r}, expected one of {PRAGMAS}')
+        if not re.fullmatch(r'-?\w+', str(value)):
+            raise ImproperlyConfigured(f'Invalid value {value!r} for sqlite PRAGMA {name}')
+        connection.execute(f'PRAGMA {name} = {value}')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        apply_pragmas(connection, self.settings_dict.get('PRAGMAS', {}))
+        return connection
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
@@ -0,0 +1,222 @@
+"""
+Vectorized analysis of histograms
+
+Histograms are handled as (x, y) numpy arrays, where x are the lower bin edges
+(see `bin_edges`) and y the contents of each bin
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .common import bin_edges, STATS_CACHE_SIZE
+
+AGGREGATE_OPS = ['SUM', 'MEAN', 'RATIO', 'DIFF']
+
+
+def rebin(x, y, xrange, edges):
+    '''Redistributes the contents `y` of bins starting at `x` onto the bins defined by `edges`
+
+    Contents are assumed to be uniform within each bin, so that the integral is
+    conserved over the range covered by both binnings
+    '''
+    source_edges = bin_edges(x, xrange)
+    cumulative = np.concatenate(([0.0], np.cumsum(y, dtype=np.float64)))
+    return np.diff(np.interp(edges, source_edges, cumulative))
+
+
+def sum_histograms(histograms, edges):
+    '''Returns (sum of y, coverage) of `histograms` on the bins defined by `edges`
+
+    `coverage` is the number of histograms contributing to each bin. A histogram
+    whose range only covers part of a bin counts for that fraction of it
+    '''
+    total = np.zeros(len(edges) - 1)
+    coverage = np.zeros(len(edges) - 1)
+    for hist in histograms:
+        x, y = hist.arrays()
+        if x is None or not len(x):
+            continue
+        if len(x) == len(edges) - 1 and np.array_equal(bin_edges(x, hist.xrange), edges):
+            total += y
+            coverage += 1
+        else:
+            source_edges = bin_edges(x, hist.xrange)
+            total += rebin(x, y, hist.xrange, edges)
+            coverage += np.diff(np.clip(edges, source_edges[0], source_edges[-1])) / np.diff(edges)
+    return total, coverage
+
+
+def aggregate(histograms, op, reference=None):
+    '''Combines `histograms` bin by bin on the binning of the first histogram
+
+    SUM and MEAN combine `histograms`. MEAN divides each bin by the number of
+    histograms covering it, so histograms without data in a bin do not pull its
+    mean towards 0. RATIO and DIFF compare the sum of `histograms` to the sum of
+    `reference`. Bins where the mean or the ratio is undefined are 0
+
+    returns: (x, y, xrange) where x and y are numpy arrays
+    '''
+    if op not in AGGREGATE_OPS:
+        raise ValueError(f'Unknown op {op}')
+    if op in ['RATIO', 'DIFF'] and not reference:
+        raise ValueError(f'{op} requires reference histograms')
+    binning = next((hist for hist in histograms if hist.len), None)
+    if binning is None:
+        raise ValueError('No histograms with data to aggregate')
+
+    x = np.array(binning.arrays()[0], dtype=np.float64)
+    edges = bin_edges(x, binning.xrange)
+    total, coverage = sum_histograms(histograms, edges)
+    if op == 'SUM':
+        return x, total, binning.xrange
+    elif op == 'MEAN':
+        mean = np.zeros_like(total)
+        np.divide(total, coverage, out=mean, where=coverage > 0)
+        return x, mean, binning.xrange
+
+    reference_total, _ = sum_histograms(reference, edges)
+    if op == 'DIFF':
+        return x, total - reference_total, binning.xrange
+    ratio = np.zeros_like(total)
+    np.divide(total, reference_total, out=ratio, where=reference_total != 0)
+    return x, ratio, binning.xrange
+
+
+def compare(reference, candidates):
+    '''Compares the shapes of `candidates` to `reference`, each normalized to its integral
+
+    Candidates are rebinned onto the bins of `reference` and compared at once as a 2D array:
+    - `chi2`: sum of the squared normalized residuals, over the `ndf` + 1 bins that are not empty in both
+    - `ks`: Kolmogorov-Smirnov distance, the largest difference between the cumulative distributions
+    - `maxResidual`: largest absolute normalized residual
+
+    returns: list of dicts with the fields of the graphql HistogramComparison, in the order of `candidates`.
+    Values are None for empty histograms
+    '''
+    x, y = reference.arrays()
+    if x is None or not len(x):
+        raise ValueError(f'Reference histogram {reference.id} has no data')
+    edges = bin_edges(np.asarray(x, dtype=np.float64), reference.xrange)
+    ref = np.asarray(y, dtype=np.float64)
+    cand = np.stack([sum_histograms([hist], edges)[0] for hist in candidates]) if candidates else np.empty((0, len(ref)))
+
+    refIntegral = ref.sum()
+    candIntegral = cand.sum(axis=1, keepdims=True)
+    valid = (candIntegral[:, 0] > 0) & (refIntegral > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Variance of the difference of the normalized contents of each bin
+        variance = ref / refIntegral**2 + cand / candIntegral**2
+        residuals = np.where(variance > 0, (cand / candIntegral - ref / refIntegral) / np.sqrt(variance), 0.0)
+        ks = np.abs(np.cumsum(cand, axis=1) / candIntegral - np.cumsum(ref) / refIntegral).max(axis=1, initial=0.0)
+    chi2 = (residuals**2).sum(axis=1)
+    ndf = (variance > 0).sum(axis=1) - 1
+    maxResidual = np.abs(residuals).max(axis=1, initial=0.0)
+
+    comparisons = []
+    for (i, hist) in enumerate(candidates):
+        if valid[i]:
+            comparisons.append({'id': hist.id, 'chi2': float(chi2[i]), 'ndf': int(ndf[i]), 'ks': float(ks[i]), 'maxResidual': float(maxResidual[i])})
+        else:
+            comparisons.append({'id': hist.id, 'chi2': None, 'ndf': None, 'ks': None, 'maxResidual': None})
+    return comparisons
+
+
+def summary_stats(x, y, xrange):
+    '''Summary statistics of a histogram
+
+    Bins starting outside of `xrange` are counted in the underflow and overflow,
+    and are excluded from the other statistics. The mean, rms and peak position are
+    taken at the bin centers. `fwhm` interpolates the half maximum crossings on
+    either side of the peak
+
+    returns: dict with the fields of the graphql HistogramStats
+    '''
+    stats = {'integral': 0.0, 'mean': None, 'rms': None, 'peak': None, 'fwhm': None, 'underflow': 0.0, 'overflow': 0.0}
+    if x is None or not len(x):
+        return stats
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = bin_edges(x, xrange)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    inRange = np.ones(len(x), dtype=bool)
+    if xrange:
+        stats['underflow'] = float(y[x < xrange['min']].sum())
+        stats['overflow'] = float(y[x > xrange['max']].sum())
+        inRange = (x >= xrange['min']) & (x <= xrange['max'])
+    centers, y = centers[inRange], y[inRange]
+    if not len(y):
+        return stats
+
+    integral = y.sum()
+    stats['integral'] = float(integral)
+    if integral > 0:
+        mean = np.dot(centers, y) / integral
+        stats['mean'] = float(mean)
+        stats['rms'] = float(np.sqrt(max(np.dot((centers - mean) ** 2, y) / integral, 0.0)))
+
+    peak = int(np.argmax(y))
+    stats['peak'] = float(centers[peak])
+    if y[peak] > 0:
+        half = y[peak] / 2
+        below = np.flatnonzero(y < half)
+        left, right = below[below < peak], below[below > peak]
+        # Interpolate between the last bin below half max and the next one, on either side
+        lower = centers[0] if not len(left) else np.interp(half, y[left[-1] : left[-1] + 2], centers[left[-1] : left[-1] + 2])
+        upper = centers[-1] if not len(right) else np.interp(half, y[right[0] - 1 : right[0] + 1][::-1], centers[right[0] - 1 : right[0] + 1][::-1])
+        stats['fwhm'] = float(upper - lower)
+    return stats
+
+
+def stats_key(histogram):
+    '''Identifies the contents of a Histogram model instance
+
+    `dataVersion` changes when points are overwritten and `len` when points are appended.
+    `created` tells apart histograms recreated with the same id
+    '''
+    xrange = (histogram.xrange['min'], histogram.xrange['max']) if histogram.xrange else None
+    return (histogram._state.db, histogram.id, histogram.created, histogram.dataVersion, histogram.len, xrange)
+
+
+class StatsCache:
+    '''Thread-safe LRU cache of summary stats, keyed by `stats_key`'''
+
+    def __init__(self, maxsize=STATS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._stats = OrderedDict()  # (database, id) -> (key, stats)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            cached = self._stats.get(key[:2])
+            if cached is None or cached[0] != key:
+                return None
+            self._stats.move_to_end(key[:2])
+            return cached[1]
+
+    def put(self, key, stats):
+        with self._lock:
+            self._stats[key[:2]] = (key, stats)
+            self._stats.move_to_end(key[:2])
+            while len(self._stats) > self.maxsize:
+                self._stats.popitem(last=False)
+
+    def invalidate(self, database_name, id):
+        with self._lock:
+            self._stats.pop((database_name, int(id)), None)
+
+
+stats_cache = StatsCache()
+
+
+def histogram_stats(histogram):
+    '''Returns the summary stats of a Histogram model instance whose full data is loaded'''
+    key = stats_key(histogram)
+    stats = stats_cache.get(key)
+    if stats is None:
+        x, y = histogram.arrays()
+        stats = summary_stats(x, y, histogram.xrange)
+        stats_cache.put(key, stats)
+    return stats
@@ -0,0 +1,136 @@
+"""
+Fan-out of live histogram snapshots
+
+A single producer task per server process builds each snapshot once and hands
+the same object to every connected subscriber, so the database is queried and
+the data decoded once regardless of the number of subscribers. Each subscriber
+still resolves its own graphql selection on the shared snapshot, see
+`_build_live_snapshot` for the fields that are also serialized only once.
+The producer only runs while there are subscribers
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+
+
+class Mailbox:
+    '''Holds the latest snapshot for a single subscriber (latest wins)
+
+    A subscriber that falls behind only ever holds one pending snapshot. Older
+    snapshots are dropped and counted in `dropped`
+
+    Note that sending a frame over the websocket does not wait for the client:
+    daphne queues it in the transport buffer and returns, without any backpressure.
+    A subscriber therefore only falls behind because of the pause between its
+    frames (see `frames`), not because of a slow connection or client, and
+    `dropped` does not detect those. The server-side cap of
+    settings.SUBSCRIPTION_MAX_FRAME_RATE is what bounds the frames queued per subscriber
+
+    Created inside the subscriber's event loop. Snapshots may be delivered from any thread
+    '''
+
+    def __init__(self, onDrop=None):
+        self._loop = asyncio.get_event_loop()
+        self._ready = asyncio.Event()
+        self._latest = None
+        self._onDrop = onDrop
+        self.dropped = 0
+
+    def deliver(self, snapshot):
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, snapshot)
+        except RuntimeError:  # Event loop of the subscriber is already closed
+            pass
+
+    def _deliver(self, snapshot):
+        if self._ready.is_set():
+            self.dropped += 1
+            if self._onDrop:
+                self._onDrop()
+        self._latest = snapshot
+        self._ready.set()
+
+    async def next(self):
+        '''Waits for the next snapshot. Re-raises any exception hit by the producer'''
+        await self._ready.wait()
+        self._ready.clear()
+        if isinstance(self._latest, Exception):
+            raise self._latest
+        return self._latest
+
+    async def frames(self, minInterval=0):
+        '''Yields snapshots, waiting at least `minInterval` seconds between two of them
+
+        The wait starts once the previous snapshot has been consumed, so a slow
+        consumer gets fewer frames rather than a backlog of them
+        '''
+        while True:
+            yield await self.next()
+            await asyncio.sleep(minInterval)
+
+
+class SnapshotBroadcaster:
+    '''`build_snapshot` is an async callable returning the snapshot to broadcast
+
+    `wait_for_change` is an async callable, taking a hub listener, that returns
+    once the next snapshot should be built
+    '''
+
+    def __init__(self, build_snapshot, wait_for_change, hub):
+        self._build_snapshot = build_snapshot
+        self._wait_for_change = wait_for_change
+        self._hub = hub
+        self._lock = threading.Lock()
+        self._mailboxes = set()
+        self._latest = None
+        self._task = None
+        self._loop = None
+        self.droppedFrames = 0  # Snapshots dropped for subscribers that fell behind, over all subscribers
+
+    def _count_drop(self):
+        with self._lock:
+            self.droppedFrames += 1
+
+    @contextmanager
+    def subscribe(self):
+        mailbox = Mailbox(onDrop=self._count_drop)
+        with self._lock:
+            self._mailboxes.add(mailbox)
+            if self._latest is not None:
+                mailbox.deliver(self._latest)
+            if self._task is None or self._task.done() or self._loop.is_closed():
+                self._loop = asyncio.get_event_loop()
+                self._task = self._loop.create_task(self._produce())
+        try:
+            yield mailbox
+        finally:
+            with self._lock:
+                self._mailboxes.discard(mailbox)
+                if not self._mailboxes and self._task is not None:
+                    # Nobody is listening. Stop producing and forget the
+                    # cached snapshot as it will no longer be kept up to date
+                    try:
+                        self._loop.call_soon_threadsafe(self._task.cancel)
+                    except RuntimeError:  # Event loop of the producer is already closed
+                        pass
+                    self._task = None
+                    self._latest = None
+
+    def _broadcast(self, snapshot):
+        with self._lock:
+            self._latest = None if isinstance(snapshot, Exception) else snapshot
+            mailboxes = list(self._mailboxes)
+        for mailbox in mailboxes:
+            mailbox.deliver(snapshot)
+
+    async def _produce(self):
+        with self._hub.listen() as listener:
+            while True:
+                try:
+                    snapshot = await self._build_snapshot()
+                except Exception as e:
+                    self._broadcast(e)
+                    return
+                self._broadcast(snapshot)
+                await self._wait_for_change(listener)
@@ -2,6 +2,9 @@
 Common histogram-related functions
 """
 
+import numpy as np
+import base64
+
 # Input fields as defined by graphql schema
 histInputField = ['id', 'name', 'data', 'xrange', 'yrange', 'type', 'isLive']
 
@@ -10,12 +13,46 @@ histInputField = ['id', 'name', 'data', 'xrange', 'yrange', 'type', 'isLive']
 # These will be replaced with an empty str
 hist_string_field = ['name', 'type']
 
+# Histogram model columns needed to resolve each graphql field
+# Graphql fields not listed here map to the column of the same name
+histFieldColumns = {
+    'data': ['packed', 'dtype', 'len'],
+    'current': ['packed', 'dtype', 'len'],
+    'stats': ['created', 'dataVersion', 'len', 'xrange'],  # Cache key of the stats, see `analysis.stats_key`
+}
+
 LIVE_DATABASE = "live"
 STATIC_DATABASE = "data"
 
 # Default number of entries for getHistTableEntries query if `first` not specified
 DEFAULT_TABLE_FIRST = 100
 
+# Default and maximum number of histograms per page of getHistogramPage
+DEFAULT_HISTOGRAM_FIRST = 20
+MAX_HISTOGRAM_FIRST = 100
+
+# Appended points are stored as HistogramChunk rows until either their points
+# outnumber those of `packed`, or a histogram has this many chunks
+MAX_HISTOGRAM_CHUNKS = 128
+
+# Decimation factors of the levels precomputed for static histograms.
+# Level `factor` holds at most len // factor points, see `downsample_indices`
+PYRAMID_FACTORS = [4, 16, 64]
+
+# Numpy dtype of the packed x and y arrays stored in Histogram.packed
+# Must be little-endian. '<f4' halves the row size at the cost of precision
+PACKED_DTYPE = '<f8'
+
+# Max number of histograms whose summary stats are cached
+STATS_CACHE_SIZE = 4096
+
+# Number of histograms loaded at once when streaming an export
+EXPORT_CHUNK_SIZE = 50
+
+# Seconds after which the in-memory latest run is read again from the database,
+# to pick up runs created by other processes
+LATEST_RUN_MAX_AGE = 30
+
 
 def histogram_payload(modified, message, success):
     return {
@@ -25,6 +62,14 @@ def histogram_payload(modified, message, success):
     }
 
 
+def histograms_payload(modified, message, success):
+    return {
+        'message': message,
+        'success': success,
+        'modifiedHistograms': modified,
+    }
+
+
 def clean_hist_input(hist):
     '''Takes histogram input from graphQL resolver and prepares to put it into the database'''
     histInput = {}
@@ -36,6 +81,148 @@ def clean_hist_input(hist):
     return histInput
 
 
+def check_max_points(maxPoints):
+    '''Raises ValueError if `maxPoints` is too small to keep the minimum and maximum of a bucket'''
+    if maxPoints is not None and maxPoints < 2:
+        raise ValueError('`maxPoints` must be at least 2')
+
+
+def downsample_indices(y, maxPoints):
+    '''Shape preserving decimation of `y` to at most `maxPoints` points
+
+    The data is split into maxPoints // 2 buckets, and the minimum and maximum
+    of each bucket is kept so that peaks survive the decimation. NaN values are
+    ignored, and buckets holding only NaN are left out
+
+    returns: sorted numpy array of the indices of `y` to keep
+    '''
+    check_max_points(maxPoints)
+    length = len(y)
+    if maxPoints is None or length <= maxPoints:
+        return np.arange(length)
+    buckets = maxPoints // 2
+    size = -(-length // buckets)  # ceil division
+    buckets = -(-length // size)
+
+    # Pad to a whole number of buckets so the search can be done on a 2D view
+    padded = np.full(buckets * size, np.nan)
+    padded[:length] = y
+    padded = padded.reshape(buckets, size)
+    isNan = np.isnan(padded)
+    filled = ~isNan.all(axis=1)
+    offsets = np.arange(buckets)[filled] * size
+    lowest = np.argmin(np.where(isNan, np.inf, padded)[filled], axis=1)
+    highest = np.argmax(np.where(isNan, -np.inf, padded)[filled], axis=1)
+    return np.unique(np.concatenate((offsets + lowest, offsets + highest)))
+
+
+def choose_pyramid_factor(length, maxPoints):
+    '''Returns the largest factor of PYRAMID_FACTORS whose level still holds
+    at least `maxPoints` points, or None if no level does and the full
+    histogram has to be used
+
+    The level is downsampled to `maxPoints` afterwards, so it must not be coarser
+    '''
+    if maxPoints is None or length is None:
+        return None
+    for factor in reversed(PYRAMID_FACTORS):
+        if length // factor >= maxPoints:
+            return factor
+    return None
+
+
+def bin_edges(x, xrange):
+    '''Returns the bin edges of a histogram whose `x` values are the lower bin edges
+
+    The last bin ends at the max of `xrange` if it lies above the last `x`,
+    otherwise the last bin is as wide as the one before it
+    '''
+    if xrange and xrange['max'] > x[-1]:
+        upper = xrange['max']
+    elif len(x) > 1:
+        upper = x[-1] + (x[-1] - x[-2])
+    else:
+        upper = x[-1] + 1
+    return np.append(x, upper)
+
+
+def fill_counts(edges, counts, values, weights=None):
+    '''Adds (optionally weighted) `values` into `counts` of the bins defined by `edges`
+
+    returns: (new_counts, underflow, overflow) where underflow/overflow are the
+    number of values below the first edge or at/above the last edge
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    index = np.searchsorted(edges, values, side='right') - 1
+    inRange = (index >= 0) & (index < len(counts))
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)[inRange]
+    added = np.bincount(index[inRange], weights=weights, minlength=len(counts))
+    underflow = int(np.count_nonzero(index < 0))
+    overflow = int(np.count_nonzero(index >= len(counts)))
+    return counts + added, underflow, overflow
+
+
+def encode_packed_values(values):
+    '''Encodes an array of values as a base64 string of little-endian float64, see `decode_packed_values`'''
+    if values is None:
+        return None
+    return base64.b64encode(np.asarray(values, dtype='<f8').tobytes()).decode('ascii')
+
+
+def decode_packed_values(encoded):
+    '''Decodes a base64 string of little-endian float64 values'''
+    if encoded is None:
+        return None
+    return np.frombuffer(base64.b64decode(encoded), dtype='<f8')
+
+
+def widen_range(current, values):
+    '''Returns a {"min": min, "max": max} range that covers both `current` and `values`'''
+    if not values:
+        return current
+    low, high = min(values), max(values)
+    if current:
+        low, high = min(low, current['min']), max(high, current['max'])
+    return {'min': low, 'max': high}
+
+
+def _selected_field_nodes(selection_sets, info):
+    '''Yields the field nodes of `selection_sets`, expanding fragments'''
+    pending = list(selection_sets)
+    while pending:
+        selection_set = pending.pop()
+        if selection_set is None:
+            continue
+        for selection in selection_set.selections:
+            kind = selection.kind
+            if kind == 'field':
+                yield selection
+            elif kind == 'inline_fragment':
+                pending.append(selection.selection_set)
+            elif kind == 'fragment_spread':
+                pending.append(info.fragments[selection.name.value].selection_set)
+
+
+def selected_fields(info, *path):
+    '''Returns the set of field names requested on the object returned by a resolver
+
+    `path` descends into sub-fields first, e.g. selected_fields(info, 'edges', 'node')
+    '''
+    selection_sets = [field_node.selection_set for field_node in info.field_nodes]
+    for name in path:
+        selection_sets = [node.selection_set for node in _selected_field_nodes(selection_sets, info) if node.name.value == name]
+    return {node.name.value for node in _selected_field_nodes(selection_sets, info)}
+
+
+def hist_columns(fields):
+    '''Returns the Histogram columns needed to resolve the graphql `fields`'''
+    columns = {'id'}
+    for field in fields:
+        columns.update(histFieldColumns.get(field, [field]))
+    return columns
+
+
 def chooseDatabase(isLive=None):
     '''Really janky way of choosing whether to write to live database or static database
 
@@ -45,3 +232,34 @@ def chooseDatabase(isLive=None):
         return LIVE_DATABASE
     else:
         return STATIC_DATABASE
+
+
+def pack_points(points, dtype=PACKED_DTYPE):
+    '''Packs a list of {"x": x, "y": y} dicts into a BLOB of
+    contiguous little-endian x values followed by y values
+    '''
+    if points is None:
+        return None
+    packed = np.empty((2, len(points)), dtype=dtype)
+    packed[0] = [point['x'] for point in points]
+    packed[1] = [point['y'] for point in points]
+    return packed.tobytes()
+
+
+def unpack_arrays(packed, dtype=PACKED_DTYPE):
+    '''Returns (x, y) numpy arrays from a BLOB made by `pack_points`
+
+    Arrays are read-only views on the BLOB, copy before modifying
+    '''
+    if packed is None:
+        return None, None
+    xy = np.frombuffer(packed, dtype=dtype).reshape(2, -1)
+    return xy[0], xy[1]
+
+
+def unpack_points(packed, dtype=PACKED_DTYPE):
+    '''Inverse of `pack_points`'''
+    x, y = unpack_arrays(packed, dtype)
+    if x is None:
+        return None
+    return [{'x': xi, 'y': yi} for (xi, yi) in zip(x.tolist(), y.tolist())]
@@ -0,0 +1,152 @@
+"""
+Streaming export of histograms over http
+
+GET export/histograms/?run=<name>&minDate=<iso>&maxDate=<iso>&isLive=<bool>&format=<csv|npz>
+
+Histograms are read from the database EXPORT_CHUNK_SIZE at a time, so memory
+stays bounded regardless of the size of the export
+- csv: one row per point, with columns id, name, type, created, x, y
+- npz: one `<id>.npy` array of shape (2, len) per histogram, holding x then y,
+  followed by `histograms.json` with the metadata of each histogram
+"""
+
+import csv
+import io
+import json
+import re
+import zipfile
+from urllib.parse import quote
+
+import numpy as np
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, StreamingResponse
+
+from LANE_server.db import database_read_async
+from .models import Histogram, HistTableMember
+from .query import _apply_histogram_filters
+from .scalar import parse_datetime_value
+from .common import chooseDatabase, STATIC_DATABASE, EXPORT_CHUNK_SIZE
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'npz': 'application/octet-stream'}
+EXPORT_COLUMNS = ['id', 'name', 'type', 'created', 'x', 'y']
+
+
+@database_read_async
+def _run_hist_ids(run):
+    return sorted(HistTableMember.objects.using(STATIC_DATABASE).filter(run__name=run).values_list('histId', flat=True))
+
+
+@database_read_async
+def _export_chunk(database_name, ids, minDate, maxDate, afterId):
+    """Returns the next EXPORT_CHUNK_SIZE histograms with an id above `afterId`
+
+    Each chunk is a separate query, so that no transaction stays open between chunks
+    """
+    queryset = _apply_histogram_filters(Histogram.objects.using(database_name).order_by('id'), ids, None, None, minDate, maxDate)
+    if afterId is not None:
+        queryset = queryset.filter(id__gt=afterId)
+    return list(queryset[:EXPORT_CHUNK_SIZE])
+
+
+async def _iterate_histograms(database_name, ids, minDate, maxDate):
+    """Yields the histograms of `ids` (all if None) in the date range, by id
+
+    The ids of a run are looked up EXPORT_CHUNK_SIZE at a time, which
+    keeps queries under the sqlite limit on the number of parameters
+    """
+    if ids is not None:
+        for start in range(0, len(ids), EXPORT_CHUNK_SIZE):
+            for hist in await _export_chunk(database_name, ids[start : start + EXPORT_CHUNK_SIZE], minDate, maxDate, None):
+                yield hist
+        return
+    afterId = None
+    while True:
+        chunk = await _export_chunk(database_name, None, minDate, maxDate, afterId)
+        for hist in chunk:
+            yield hist
+        if len(chunk) < EXPORT_CHUNK_SIZE:
+            return
+        afterId = chunk[-1].id
+
+
+async def _stream_csv(histograms):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for hist in histograms:
+        x, y = hist.arrays()
+        if x is not None:
+            created = hist.created.isoformat()
+            writer.writerows((hist.id, hist.name, hist.type, created, xi, yi) for (xi, yi) in zip(x.tolist(), y.tolist()))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Unseekable stream collecting the bytes written by zipfile until they are sent"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def _stream_npz(histograms):
+    buffer = _ChunkBuffer()
+    metadata = []
+    with zipfile.ZipFile(buffer, mode='w') as archive:
+        async for hist in histograms:
+            x, y = hist.arrays()
+            xy = np.empty((2, 0)) if x is None else np.stack((x, y))
+            with archive.open(f'{hist.id}.npy', mode='w') as member:
+                np.lib.format.write_array(member, xy, allow_pickle=False)
+            metadata.append({'id': hist.id, 'name': hist.name, 'type': hist.type, 'created': hist.created.isoformat(), 'xrange': hist.xrange, 'yrange': hist.yrange, 'len': hist.len})
+            yield buffer.pop()
+        archive.writestr('histograms.json', json.dumps(metadata))
+    yield buffer.pop()
+
+
+def _parse_date(value):
+    '''Parses dates like the Datetime scalar, so dates without a timezone are in TIME_ZONE'''
+    return parse_datetime_value(value) if value else None
+
+
+def _content_disposition(filename):
+    '''Attachment header for `filename`, with an ascii fallback for clients ignoring `filename*`'''
+    fallback = re.sub(r'[^A-Za-z0-9._-]', '_', filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+async def export_histograms(scope, receive, send):
+    """ASGI app streaming the histograms of a run and/or date range"""
+    params = Request(scope, receive).query_params
+    format = params.get('format', 'csv')
+    try:
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f'Unknown format {format}, expected one of {list(EXPORT_FORMATS)}')
+        minDate = _parse_date(params.get('minDate'))
+        maxDate = _parse_date(params.get('maxDate'))
+    except ValueError as e:
+        response = PlainTextResponse(str(e), status_code=400)
+    else:
+        run = params.get('run')
+        ids = await _run_hist_ids(run) if run else None
+        database_name = chooseDatabase(params.get('isLive', 'false').lower() == 'true')
+        histograms = _iterate_histograms(database_name, ids, minDate, maxDate)
+
+        stream = _stream_csv(histograms) if format == 'csv' else _stream_npz(histograms)
+        headers = {'Content-Disposition': _content_disposition(f'{run or "histograms"}.{format}')}
+        response = StreamingResponse(stream, media_type=EXPORT_FORMATS[format], headers=headers)
+    await response(scope, receive, send)
@@ -0,0 +1,74 @@
+"""
+In-process notification hub for histogram changes
+
+Mutations publish an event after every change to a histogram, and
+subscriptions wait on a listener instead of polling the database.
+
+Note that the hub only spans a single server process. Subscriptions check
+for changes made through another daphne process separately, see
+`subscription._wait_for_change`
+"""
+
+import asyncio
+from contextlib import contextmanager
+
+
+class Listener:
+    '''Collects events published to the hub for a single subscriber
+
+    Created inside the subscriber's event loop. Events may be published from any thread
+    '''
+
+    def __init__(self):
+        self._loop = asyncio.get_event_loop()
+        self._changed = asyncio.Event()
+        self._events = []
+
+    def notify(self, event):
+        try:
+            self._loop.call_soon_threadsafe(self._notify, event)
+        except RuntimeError:  # Event loop of the subscriber is already closed
+            pass
+
+    def _notify(self, event):
+        self._events.append(event)
+        self._changed.set()
+
+    async def wait(self, timeout=None):
+        '''Waits until at least one event is published, or `timeout` seconds elapse
+
+        returns: list of events published since the last call (empty on timeout)
+        '''
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+        events, self._events = self._events, []
+        return events
+
+
+class NotificationHub:
+    def __init__(self):
+        self._listeners = set()
+
+    def publish(self, kind, id, isLive):
+        '''Notifies every listener that histogram `id` was changed
+
+        `kind` is one of 'create', 'update', 'append', 'delete'
+        '''
+        event = {'kind': kind, 'id': int(id), 'isLive': bool(isLive)}
+        for listener in list(self._listeners):
+            listener.notify(event)
+
+    @contextmanager
+    def listen(self):
+        listener = Listener()
+        self._listeners.add(listener)
+        try:
+            yield listener
+        finally:
+            self._listeners.discard(listener)
+
+
+histogram_hub = NotificationHub()
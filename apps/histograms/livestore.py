@@ -0,0 +1,423 @@
+"""
+Shared memory store of live histograms
+
+When enabled in settings.LIVE_STORE, live histograms are kept in fixed-size numpy
+buffers in a `multiprocessing.shared_memory` segment that every server process on
+the host attaches to. Live mutations and reads then become memory operations
+instead of sqlite transactions
+
+The store is copied to the live db every SNAPSHOT_INTERVAL seconds and on exit,
+and is filled from the live db when the segment is created (e.g. after a reboot).
+The store refuses to start if the live db holds more histograms or points than
+it fits. Rows of the live db are only ever deleted by the copy once the histogram
+was deleted through the store. Queries that are not served by the store
+(`getHistogramPage` and the export endpoint) read the last copy in the live db
+
+Requires python 3.8 for `multiprocessing.shared_memory`
+
+Layout of the segment: a header, then a table of SLOTS slot records, then
+the points of each slot as a (SLOTS, 2, POINTS) float64 array
+- Writers, from any process, are serialized with a lock file
+- Readers never lock. Each slot has a sequence number that is odd while the slot
+  is written, and readers retry until they copy the slot with an even, unchanged sequence number
+- A writer killed while writing leaves an odd sequence number behind. As no write is in
+  progress while the lock is held, writers and stuck readers reset it under the lock
+"""
+
+import atexit
+import datetime
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Histogram, HistogramChunk
+from .common import LIVE_DATABASE, PACKED_DTYPE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x4C414E454C495645  # "LANELIVE"
+
+# [seconds] a reader waits for a slot being written before checking whether its writer died
+READ_TIMEOUT = 1
+
+# States of a slot. DELETED slots are free, but their histogram still has to be deleted from the live db
+FREE, USED, DELETED = 0, 1, 2
+
+HEADER_DTYPE = np.dtype(
+    [
+        ('magic', '<u8'),
+        ('slots', '<u8'),
+        ('points', '<u8'),
+        ('generation', '<u8'),  # Incremented after every write
+        ('snapshotGeneration', '<u8'),  # `generation` when the store was last copied to the live db
+    ]
+)
+
+SLOT_DTYPE = np.dtype(
+    [
+        ('seq', '<u8'),  # Odd while the slot is being written
+        ('used', 'u1'),  # FREE, USED or DELETED
+        ('id', '<u8'),
+        ('dataVersion', '<u8'),
+        ('len', '<u8'),
+        ('created', '<f8'),  # POSIX timestamp
+        ('hasXrange', 'u1'),
+        ('xrange', '<f8', (2,)),
+        ('hasYrange', 'u1'),
+        ('yrange', '<f8', (2,)),
+        ('name', 'S500'),
+        ('type', 'S100'),
+    ]
+)
+
+
+def _range(has, values):
+    return {'min': float(values[0]), 'max': float(values[1])} if has else None
+
+
+class LiveStore:
+    '''Live histograms in shared memory, handed out as unsaved Histogram model instances'''
+
+    def __init__(self, name, slots, points):
+        try:
+            from multiprocessing import shared_memory, resource_tracker
+        except ImportError:
+            raise ImproperlyConfigured('The live store (LANE_LIVE_STORE) requires python 3.8 or later')
+
+        self.name = name
+        self._threadLock = threading.Lock()
+        self._lockFile = open(os.path.join(tempfile.gettempdir(), f'{name}.lock'), 'a')
+        self._snapshotLockFile = open(os.path.join(tempfile.gettempdir(), f'{name}.snapshot.lock'), 'a')
+
+        size = HEADER_DTYPE.itemsize + slots * SLOT_DTYPE.itemsize + slots * 2 * points * np.dtype(PACKED_DTYPE).itemsize
+        with self._locked():
+            try:
+                self._shm = shared_memory.SharedMemory(name=name)
+                histograms = None
+            except FileNotFoundError:
+                # Checked before the segment exists, so that a failure leaves nothing behind
+                histograms = self._read_database(slots, points)
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            created = histograms is not None
+            # The segment is shared by independent server processes, so it
+            # must not be removed when the process that created it exits
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+
+            buffer = self._shm.buf
+            self._header = np.ndarray((), HEADER_DTYPE, buffer, 0)
+            if created:
+                self._header[()] = (MAGIC, slots, points, 0, 0)
+            elif self._header['magic'] != MAGIC or self._header['slots'] != slots or self._header['points'] != points:
+                raise RuntimeError(f'Shared memory segment {name} does not hold a live store of {slots} slots of {points} points')
+            self.slots, self.points = slots, points
+            self._slots = np.ndarray((slots,), SLOT_DTYPE, buffer, HEADER_DTYPE.itemsize)
+            self._data = np.ndarray((slots, 2, points), PACKED_DTYPE, buffer, HEADER_DTYPE.itemsize + slots * SLOT_DTYPE.itemsize)
+            if created:
+                try:
+                    for index, hist in enumerate(histograms):
+                        self._write(index, hist)
+                except Exception:
+                    self.close()
+                    self.unlink()
+                    raise
+                self._header['snapshotGeneration'] = self._header['generation']
+
+    @contextmanager
+    def _locked(self):
+        '''Excludes writers of every thread and process'''
+        with self._threadLock:
+            fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+
+    @property
+    def generation(self):
+        '''Changes whenever a live histogram is written, by any process'''
+        return int(self._header['generation'])
+
+    def _find(self, id):
+        index = np.flatnonzero((self._slots['used'] == USED) & (self._slots['id'] == int(id)))
+        return int(index[0]) if len(index) else None
+
+    def _read(self, index):
+        '''Returns a consistent copy of slot `index` as a Histogram, or None if the slot is free
+
+        Raises TimeoutError if the slot is being written for more than READ_TIMEOUT seconds
+        '''
+        deadline = time.monotonic() + READ_TIMEOUT
+        while True:
+            seq = int(self._slots['seq'][index])
+            if seq % 2:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Slot {index} of live store {self.name} is being written for more than {READ_TIMEOUT} s')
+                time.sleep(0)  # Let the writer finish
+                continue
+            record = self._slots[index].copy()
+            xy = self._data[index, :, : min(int(record['len']), self.points)].copy()
+            if int(self._slots['seq'][index]) == seq:
+                break
+        if record['used'] != USED:
+            return None
+        hist = Histogram(
+            id=int(record['id']),
+            name=record['name'].decode(),
+            type=record['type'].decode(),
+            xrange=_range(record['hasXrange'], record['xrange']),
+            yrange=_range(record['hasYrange'], record['yrange']),
+            len=int(record['len']),
+            dataVersion=int(record['dataVersion']),
+            created=datetime.datetime.fromtimestamp(record['created'], tz=datetime.timezone.utc),
+        )
+        hist.packed = xy.tobytes() if record['len'] else None
+        hist._state.adding = False
+        hist._state.db = LIVE_DATABASE
+        return hist
+
+    def _read_unlocked(self, index):
+        '''`_read` for callers not holding the writer lock, recovering slots left by a killed writer'''
+        try:
+            return self._read(index)
+        except TimeoutError:
+            with self._locked():
+                self._recover(index)
+                return self._read(index)
+
+    def _recover(self, index):
+        '''Ends a write of slot `index` left unfinished by a killed writer. Must hold the writer lock'''
+        if self._slots['seq'][index] % 2:
+            logger.warning(f'Slot {index} of live store {self.name} was left half written, its histogram may be corrupt')
+            self._slots['seq'][index] += 1
+
+    def _write(self, index, hist):
+        '''Writes `hist` into slot `index`. Must hold the writer lock'''
+        x, y = hist.arrays()
+        length = 0 if x is None else len(x)
+        if length > self.points:
+            raise ValueError(f'hist {hist.id} has {length} points, live histograms hold at most {self.points}')
+        if hist.created is None:
+            hist.created = timezone.now()
+
+        self._recover(index)
+        self._slots['seq'][index] += 1
+        try:
+            record = self._slots[index : index + 1]
+            record['used'] = USED
+            record['id'] = hist.id
+            record['dataVersion'] = hist.dataVersion
+            record['len'] = length
+            record['created'] = hist.created.timestamp()
+            record['hasXrange'] = hist.xrange is not None
+            record['xrange'] = (hist.xrange['min'], hist.xrange['max']) if hist.xrange else (0, 0)
+            record['hasYrange'] = hist.yrange is not None
+            record['yrange'] = (hist.yrange['min'], hist.yrange['max']) if hist.yrange else (0, 0)
+            record['name'] = (hist.name or '').encode()
+            record['type'] = (hist.type or '').encode()
+            if length:
+                self._data[index, 0, :length] = x
+                self._data[index, 1, :length] = y
+        finally:
+            self._slots['seq'][index] += 1
+            self._header['generation'] += 1
+        hist.len = length
+        hist._state.adding = False
+        hist._state.db = LIVE_DATABASE
+
+    def _free(self, index):
+        '''Frees slot `index`. Its histogram is deleted from the live db by the next copy'''
+        self._recover(index)
+        self._slots['seq'][index] += 1
+        self._slots['used'][index] = DELETED
+        self._slots['seq'][index] += 1
+        self._header['generation'] += 1
+
+    def get(self, id):
+        '''Returns the live histogram `id`. Raises Histogram.DoesNotExist like the ORM'''
+        index = self._find(id)
+        hist = None if index is None else self._read_unlocked(index)
+        if hist is None or hist.id != int(id):
+            raise Histogram.DoesNotExist(f'Live histogram {id} does not exist')
+        return hist
+
+    def exists(self, ids):
+        '''Returns the ids of `ids` held by the store'''
+        held = set(self._slots['id'][self._slots['used'] == USED].tolist())
+        return [int(id) for id in ids if int(id) in held]
+
+    def filter(self, ids=None, names=None, types=None, minDate=None, maxDate=None):
+        '''Returns the live histograms matching the filters of `query._apply_histogram_filters`, sorted by id'''
+        histograms = [self._read_unlocked(index) for index in np.flatnonzero(self._slots['used'] == USED)]
+        histograms = [hist for hist in histograms if hist is not None]
+        if ids:
+            ids = {int(id) for id in ids}
+            histograms = [hist for hist in histograms if hist.id in ids]
+        if names:
+            histograms = [hist for hist in histograms if hist.name in names]
+        if types:
+            histograms = [hist for hist in histograms if hist.type in types]
+        if minDate:
+            histograms = [hist for hist in histograms if hist.created >= minDate]
+        if maxDate:
+            histograms = [hist for hist in histograms if hist.created <= maxDate]
+        return sorted(histograms, key=lambda hist: hist.id)
+
+    def insert(self, histograms):
+        '''Adds new Histogram instances. Nothing is written if any id already exists or the store is full
+
+        Slots of deleted histograms are only reused once no other slot is free.
+        Their deletion is then made in the live db right away
+        '''
+        with self._locked():
+            existing = self.exists([hist.id for hist in histograms])
+            if existing:
+                raise ValueError(f'hists {sorted(existing)} already exist in {LIVE_DATABASE}')
+            free = np.concatenate((np.flatnonzero(self._slots['used'] == FREE), np.flatnonzero(self._slots['used'] == DELETED)))[: len(histograms)]
+            if len(free) < len(histograms):
+                raise ValueError(f'Live store is full, it holds at most {self.slots} histograms')
+            deleted = self._slots['id'][free[self._slots['used'][free] == DELETED]].tolist()
+            if deleted:
+                Histogram.objects.using(LIVE_DATABASE).filter(id__in=deleted).delete()
+            for index, hist in zip(free, histograms):
+                self._write(int(index), hist)
+        return histograms
+
+    @contextmanager
+    def modify(self, id):
+        '''Yields the live histogram `id`, and writes it back on exit
+
+        Other writers are excluded meanwhile, so read-modify-write sequences are atomic
+        '''
+        with self._locked():
+            index = self._find(id)
+            if index is None:
+                raise Histogram.DoesNotExist(f'Live histogram {id} does not exist')
+            self._recover(index)
+            hist = self._read(index)
+            yield hist
+            self._write(index, hist)
+
+    def delete(self, id):
+        '''Returns whether the live histogram `id` existed'''
+        with self._locked():
+            index = self._find(id)
+            if index is None:
+                return False
+            self._free(index)
+            return True
+
+    @staticmethod
+    def _read_database(slots, points):
+        '''Returns the histograms of the live db, checking that they fit in `slots` slots of `points` points'''
+        queryset = Histogram.objects.using(LIVE_DATABASE)
+        count = queryset.count()
+        if count > slots:
+            raise ImproperlyConfigured(f'The live db holds {count} histograms, more than the {slots} slots of the live store (LANE_LIVE_STORE_SLOTS)')
+        histograms = list(queryset.order_by('id'))
+        tooLong = [hist.id for hist in histograms if hist.packed is not None and len(hist.arrays()[0]) > points]
+        if tooLong:
+            raise ImproperlyConfigured(f'Live histograms {tooLong} have more than the {points} points of the live store (LANE_LIVE_STORE_POINTS)')
+        return histograms
+
+    def snapshot_to_database(self):
+        '''Copies the store to the live db in a single transaction, unless nothing changed since the last copy
+
+        Only one process copies at a time. Returns whether a copy was made
+        '''
+        try:
+            fcntl.flock(self._snapshotLockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            generation = self.generation
+            if generation == self._header['snapshotGeneration']:
+                return False
+            deletedSlots = np.flatnonzero(self._slots['used'] == DELETED)
+            deleted = self._slots['id'][deletedSlots].tolist()
+            histograms = self.filter()
+            ids = [hist.id for hist in histograms]
+            with transaction.atomic(using=LIVE_DATABASE):
+                queryset = Histogram.objects.using(LIVE_DATABASE)
+                queryset.filter(id__in=deleted).exclude(id__in=ids).delete()
+                existing = set(queryset.filter(id__in=ids).values_list('id', flat=True))
+                fields = ['name', 'packed', 'dtype', 'dataVersion', 'xrange', 'yrange', 'len', 'type', 'created']
+                queryset.bulk_update([hist for hist in histograms if hist.id in existing], fields, batch_size=100)
+                HistogramChunk.objects.using(LIVE_DATABASE).filter(histogram_id__in=existing).delete()  # Now part of `packed`
+                new = [hist for hist in histograms if hist.id not in existing]
+                created = [hist.created for hist in new]
+                queryset.bulk_create(new)  # Sets `created` to now
+                for hist, timestamp in zip(new, created):
+                    hist.created = timestamp
+                queryset.bulk_update(new, ['created'], batch_size=100)
+            with self._locked():
+                # Slots deleted meanwhile, or already reused, are left to the next copy
+                for index, id in zip(deletedSlots, deleted):
+                    if self._slots['used'][index] == DELETED and self._slots['id'][index] == id:
+                        self._slots['used'][index] = FREE
+            self._header['snapshotGeneration'] = generation
+            return True
+        finally:
+            fcntl.flock(self._snapshotLockFile, fcntl.LOCK_UN)
+
+    def start_snapshots(self, interval):
+        '''Copies the store to the live db every `interval` seconds in a background thread, and on exit'''
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.snapshot_to_database()
+                except Exception:
+                    logger.exception('Failed to copy the live store to the live db')
+                finally:
+                    connections[LIVE_DATABASE].close()
+
+        threading.Thread(target=run, name='live-store-snapshots', daemon=True).start()
+        atexit.register(self.snapshot_to_database)
+
+    def close(self):
+        self._header = self._slots = self._data = None
+        self._shm.close()
+
+    def unlink(self):
+        '''Removes the segment once every process closed it. The data is lost unless copied to the live db'''
+        from multiprocessing import resource_tracker
+
+        resource_tracker.register(self._shm._name, 'shared_memory')  # unlink() unregisters it
+        self._shm.unlink()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_live_store(create=True):
+    '''Returns the LiveStore of this process, or None if it is disabled in settings
+
+    Attaching the store may read the live db, so the first call with `create`
+    must be made from synchronous code
+    '''
+    global _store
+    if not settings.LIVE_STORE['ENABLED']:
+        return None
+    with _store_lock:
+        if _store is None and create:
+            config = settings.LIVE_STORE
+            _store = LiveStore(config['NAME'], config['SLOTS'], config['POINTS'])
+            _store.start_snapshots(config['SNAPSHOT_INTERVAL'])
+        return _store
+
+
+def live_store_for(database_name):
+    '''Returns the LiveStore if it holds the histograms of `database_name`, else None'''
+    return get_live_store() if database_name == LIVE_DATABASE else None
@@ -0,0 +1,55 @@
+"""
+Per-request batching of database loads
+
+Resolvers of sibling fields (e.g. the histograms of every HistTableEntry on a page)
+run concurrently. A BatchLoader collects the keys they request until the event
+loop is free, then loads all of them with a single call
+"""
+
+import asyncio
+
+
+class BatchLoader:
+    '''Batches `load` calls made in the same event loop iteration
+
+    `batch_load` is an async function taking a list of keys and returning a dict
+    key -> value. Keys missing from the dict resolve to None. Values are
+    cached for the lifetime of the loader
+    '''
+
+    def __init__(self, batch_load):
+        self._batch_load = batch_load
+        self._cache = {}
+        self._queue = []
+
+    def load(self, key):
+        '''Returns a future resolving to the value of `key`'''
+        if key not in self._cache:
+            loop = asyncio.get_event_loop()
+            if not self._queue:
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+            self._cache[key] = loop.create_future()
+            self._queue.append(key)
+        return self._cache[key]
+
+    async def load_many(self, keys):
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        try:
+            values = await self._batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                self._cache.pop(key).set_exception(e)
+            return
+        for key in keys:
+            self._cache[key].set_result(values.get(key))
+
+
+def get_loader(info, name, batch_load):
+    '''Returns the BatchLoader `name` of the current request, creating it with `batch_load` if needed'''
+    loaders = info.context.setdefault('loaders', {})
+    if name not in loaders:
+        loaders[name] = BatchLoader(batch_load)
+    return loaders[name]
@@ -0,0 +1,156 @@
+"""
+Compares the sqlite performance profile of a database (its 'PRAGMAS' setting)
+with sqlite's defaults (rollback journal, synchronous=full) under concurrent
+reads and writes of histograms
+
+Usage: python manage.py benchmark_sqlite [--database data] [--histograms N] [--points N]
+           [--readers N] [--writers N] [--seconds S]
+
+Each profile runs on a scratch copy of the histogram table in a temporary directory,
+so the databases themselves are not touched. Readers load single histograms
+(as `getHistogram`) and list histograms of a type (as `getHistograms`), writers
+append points to histograms inside a transaction (as `appendHistogramPoints`)
+"""
+
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from LANE_server.sqlite3.base import apply_pragmas
+from apps.histograms.models import Histogram
+from apps.histograms.common import STATIC_DATABASE, PACKED_DTYPE
+
+DEFAULT_PRAGMAS = {'journal_mode': 'delete', 'synchronous': 'full'}
+TYPES = 8  # Number of distinct histogram types
+APPEND = 16  # Number of points appended per write
+
+
+class Workload:
+    def __init__(self, path, pragmas, histograms, seconds):
+        self.path = path
+        self.pragmas = pragmas
+        self.histograms = histograms
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.reads = []  # Latency of each read [s]
+        self.writes = []  # Latency of each write [s]
+        self.errors = 0
+
+    def connect(self):
+        # Same connect timeout as django's sqlite backend, superseded by a busy_timeout PRAGMA
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection, self.pragmas)
+        return connection
+
+    def run(self, operation):
+        connection = self.connect()
+        rng = random.Random()
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + self.seconds
+        while True:
+            start = time.perf_counter()
+            if start >= deadline:
+                break
+            try:
+                operation(connection, rng)
+            except sqlite3.OperationalError:  # database is locked
+                errors += 1
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                continue
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+        with self.lock:
+            (self.reads if operation == self.read else self.writes).extend(latencies)
+            self.errors += errors
+
+    def read(self, connection, rng):
+        if rng.random() < 0.1:
+            connection.execute(f'SELECT id, name, type, len, created FROM {Histogram._meta.db_table} WHERE type = ?', (f'type{rng.randrange(TYPES)}',)).fetchall()
+        else:
+            connection.execute(f'SELECT packed, dtype, len, xrange, yrange FROM {Histogram._meta.db_table} WHERE id = ?', (rng.randrange(self.histograms),)).fetchone()
+
+    def write(self, connection, rng):
+        id = rng.randrange(self.histograms)
+        connection.execute('BEGIN IMMEDIATE')
+        packed, length = connection.execute(f'SELECT packed, len FROM {Histogram._meta.db_table} WHERE id = ?', (id,)).fetchone()
+        points = np.frombuffer(packed, dtype=PACKED_DTYPE).reshape(2, length)
+        x = np.arange(length, length + APPEND, dtype=PACKED_DTYPE)
+        packed = np.concatenate((points, np.stack((x, np.ones(APPEND)))), axis=1).tobytes()
+        connection.execute(f'UPDATE {Histogram._meta.db_table} SET packed = ?, len = ? WHERE id = ?', (packed, length + APPEND, id))
+        connection.execute('COMMIT')
+
+
+class Command(BaseCommand):
+    help = 'Compares the sqlite performance profile of a database with the sqlite defaults under concurrent histogram reads and writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=STATIC_DATABASE, help=f'Database whose PRAGMAS are benchmarked (default={STATIC_DATABASE})')
+        parser.add_argument('--histograms', type=int, default=500, help='Number of histograms (default=500)')
+        parser.add_argument('--points', type=int, default=2000, help='Initial number of points per histogram (default=2000)')
+        parser.add_argument('--readers', type=int, default=4, help='Number of reading threads (default=4)')
+        parser.add_argument('--writers', type=int, default=2, help='Number of writing threads (default=2)')
+        parser.add_argument('--seconds', type=float, default=5, help='Duration of each run (default=5)')
+
+    def handle(self, *args, **options):
+        if options['database'] not in settings.DATABASES:
+            raise CommandError(f'Unknown database {options["database"]}')
+        profiles = {'sqlite defaults': DEFAULT_PRAGMAS, f'{options["database"]} PRAGMAS': settings.DATABASES[options['database']].get('PRAGMAS', {})}
+
+        self.stdout.write(f'{options["histograms"]} histograms of {options["points"]} points, {options["readers"]} readers, {options["writers"]} writers, {options["seconds"]} s per profile')
+        self.stdout.write(f'{"profile":<20} {"reads/s":>10} {"read p99 [ms]":>14} {"writes/s":>10} {"write p99 [ms]":>15} {"locked":>8}')
+        with tempfile.TemporaryDirectory() as directory:
+            for i, (name, pragmas) in enumerate(profiles.items()):
+                path = Path(directory) / f'benchmark{i}.sqlite3'
+                self.create(path, options['database'], options['histograms'], options['points'])
+                workload = Workload(path, pragmas, options['histograms'], options['seconds'])
+                threads = [threading.Thread(target=workload.run, args=(workload.read,)) for _ in range(options['readers'])]
+                threads += [threading.Thread(target=workload.run, args=(workload.write,)) for _ in range(options['writers'])]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.stdout.write(
+                    f'{name:<20} {len(workload.reads) / options["seconds"]:>10.0f} {self.p99(workload.reads):>14.2f} '
+                    f'{len(workload.writes) / options["seconds"]:>10.0f} {self.p99(workload.writes):>15.2f} {workload.errors:>8}'
+                )
+
+    def create(self, path, database, histograms, points):
+        '''Creates the histogram table of `database` in a new sqlite file, filled with random histograms'''
+        with sqlite3.connect(settings.DATABASES[database]['NAME']) as source:
+            (schema,) = source.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (Histogram._meta.db_table,)).fetchone()
+        rng = np.random.default_rng()
+        x = np.arange(points, dtype=PACKED_DTYPE)
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(schema)
+            connection.executemany(
+                f'INSERT INTO {Histogram._meta.db_table} (id, name, packed, dtype, "dataVersion", xrange, yrange, len, created, type) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)',
+                (
+                    (
+                        id,
+                        f'run{id // TYPES}',
+                        np.stack((x, rng.poisson(100, points))).astype(PACKED_DTYPE).tobytes(),
+                        PACKED_DTYPE,
+                        '{"min": 0, "max": 1}',
+                        '{"min": 0, "max": 1}',
+                        points,
+                        '2022-01-01 00:00:00',
+                        f'type{id % TYPES}',
+                    )
+                    for id in range(histograms)
+                ),
+            )
+        connection.close()
+
+    @staticmethod
+    def p99(latencies):
+        return 1000 * float(np.percentile(latencies, 99)) if latencies else float('nan')
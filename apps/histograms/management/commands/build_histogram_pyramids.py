@@ -0,0 +1,30 @@
+"""
+Builds the pyramid levels of histograms already in the static database
+
+Usage: python manage.py build_histogram_pyramids [--missing-only]
+"""
+
+from django.core.management.base import BaseCommand
+
+from apps.histograms.models import Histogram
+from apps.histograms.pyramid import build_pyramid
+from apps.histograms.common import STATIC_DATABASE
+
+
+class Command(BaseCommand):
+    help = 'Builds the pyramid levels of histograms in the static database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing-only', action='store_true', help='Skip histograms that already have pyramid levels')
+
+    def handle(self, *args, **options):
+        queryset = Histogram.objects.using(STATIC_DATABASE).all()
+        if options['missing_only']:
+            queryset = queryset.filter(levels__isnull=True)
+        ids = list(queryset.values_list('id', flat=True))
+        levels = 0
+        for i, id in enumerate(ids):
+            levels += build_pyramid(id, STATIC_DATABASE)
+            if (i + 1) % 1000 == 0:
+                self.stdout.write(f'{i + 1}/{len(ids)} histograms')
+        self.stdout.write(self.style.SUCCESS(f'Built {levels} levels for {len(ids)} histograms'))
@@ -0,0 +1,199 @@
+"""
+Bulk imports histograms from files directly into the static database
+
+Usage: python manage.py import_histograms FILE [FILE ...] [--run NAME] [--type TYPE]
+           [--bins N --range MIN MAX] [--start-id ID] [--batch-size N] [--pyramids]
+
+Supported files:
+- .npz and .csv in the layout of the export endpoint (see `apps/histograms/export.py`)
+- .npy of shape (2, len) holding x then y
+- .npy of shape (len,) holding raw event values, binned with `--bins` and `--range`
+- text output of the DAQ tool worker_threads/fast_daq_worker/tools/parse.py,
+  imported as one pulse height spectrum per channel, binned with `--bins` and `--range`
+
+Histograms keep the id, name and type stored in the file if any.
+Otherwise ids are assigned after the largest id in the database, the run
+name is `--run` and the type is `--type` or the file name
+"""
+
+import csv
+import json
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from apps.histograms.models import Histogram, HistTable, HistTableMember
+from apps.histograms.pyramid import build_pyramid
+from apps.histograms.common import fill_counts, STATIC_DATABASE, PACKED_DTYPE
+
+PARSE_HEADER = '# <timestamp> <channel> <min(data)> {<data[0..N]>-<min(data)>}'  # First line written by parse.py
+PARSE_CHUNK_SIZE = 65536  # Number of pulse heights per channel kept in memory before binning them
+
+
+def _histogram(x, y, **metadata):
+    '''Returns a dict with the fields of a new Histogram for the arrays `x` and `y`'''
+    x = np.asarray(x, dtype=PACKED_DTYPE)
+    y = np.asarray(y, dtype=PACKED_DTYPE)
+    hist = {'id': None, 'name': None, 'type': None, 'xrange': None, 'yrange': None, **metadata}
+    if len(x):
+        hist['xrange'] = hist['xrange'] or {'min': float(x[0]), 'max': float(x[-1])}
+        hist['yrange'] = hist['yrange'] or {'min': float(y.min()), 'max': float(y.max())}
+    hist.update({'packed': np.stack((x, y)).tobytes(), 'dtype': PACKED_DTYPE, 'len': len(x), 'dataVersion': 1})
+    return hist
+
+
+def _read_npz(path):
+    with np.load(path) as archive:
+        for metadata in json.loads(archive['histograms.json']):
+            xy = archive[f'{metadata["id"]}.npy']
+            yield _histogram(xy[0], xy[1], id=metadata['id'], name=metadata['name'], type=metadata['type'], xrange=metadata['xrange'], yrange=metadata['yrange'])
+
+
+def _read_csv(path):
+    with open(path, newline='') as file:
+        rows = csv.DictReader(file)
+        current = None
+        for row in rows:
+            if current is None or row['id'] != current['id']:
+                if current is not None:
+                    yield _histogram(**current)
+                current = {'id': row['id'], 'name': row['name'], 'type': row['type'], 'x': [], 'y': []}
+            current['x'].append(float(row['x']))
+            current['y'].append(float(row['y']))
+        if current is not None:
+            yield _histogram(**current)
+
+
+def _read_npy(path, bins, xrange):
+    array = np.load(path, allow_pickle=False)
+    if array.ndim == 2 and array.shape[0] == 2:
+        yield _histogram(array[0], array[1], type=path.stem)
+    elif array.ndim == 1:
+        if bins is None or xrange is None:
+            raise CommandError(f'{path} holds raw values, --bins and --range are required to bin them')
+        edges = np.linspace(xrange[0], xrange[1], bins + 1)
+        counts, _, _ = fill_counts(edges, np.zeros(bins), array)
+        yield _histogram(edges[:-1], counts, type=path.stem, xrange={'min': xrange[0], 'max': xrange[1]})
+    else:
+        raise CommandError(f'{path} has shape {array.shape}, expected (2, len) or (len,)')
+
+
+def _is_parse_output(path):
+    with open(path, errors='replace') as file:
+        return file.readline().rstrip('\n') == PARSE_HEADER
+
+
+def _read_parse_output(path, bins, xrange):
+    '''Reads the events printed by parse.py into one pulse height spectrum per channel
+
+    Event lines are `<timestamp> <channel> <min(data)> <data[0]-min(data)>,<data[1]-min(data)>,...`,
+    the pulse height of an event is its largest residual. Events without samples,
+    printed as `ts: <timestamp> chan: <channel>`, are skipped
+    '''
+    if bins is None or xrange is None:
+        raise CommandError(f'{path} holds DAQ events, --bins and --range are required to bin their pulse heights')
+    edges = np.linspace(xrange[0], xrange[1], bins + 1)
+    counts = {}
+    heights = {}
+    with open(path) as file:
+        for number, line in enumerate(file, start=1):
+            if line.startswith(('#', 'ts:')) or not line.strip():
+                continue
+            try:
+                _, chan, _, residuals = line.split()
+                chan = int(chan)
+                height = max(int(value) for value in residuals.split(','))
+            except ValueError:
+                raise CommandError(f'{path}:{number} is not an event line of parse.py')
+            pending = heights.setdefault(chan, [])
+            pending.append(height)
+            if len(pending) >= PARSE_CHUNK_SIZE:
+                counts[chan], _, _ = fill_counts(edges, counts.get(chan, np.zeros(bins)), pending)
+                pending.clear()
+    for chan in sorted(heights):
+        spectrum, _, _ = fill_counts(edges, counts.get(chan, np.zeros(bins)), heights[chan])
+        yield _histogram(edges[:-1], spectrum, type=f'ch{chan}', xrange={'min': xrange[0], 'max': xrange[1]})
+
+
+class Command(BaseCommand):
+    help = 'Bulk imports histograms from npz, npy, csv or DAQ parse.py output files into the static database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', type=Path)
+        parser.add_argument('--run', help='Run name of the imported histograms. Overrides names stored in the files')
+        parser.add_argument('--type', help='Detector type of histograms without a stored type')
+        parser.add_argument('--bins', type=int, help='Number of bins for raw values')
+        parser.add_argument('--range', type=float, nargs=2, metavar=('MIN', 'MAX'), help='Range of the bins for raw values')
+        parser.add_argument('--start-id', type=int, help='First id assigned to histograms without a stored id')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of histograms inserted per transaction')
+        parser.add_argument('--pyramids', action='store_true', help='Build the pyramid levels of the imported histograms')
+
+    def read(self, path, options):
+        suffix = path.suffix.lower()
+        if suffix == '.npz':
+            return _read_npz(path)
+        elif suffix == '.csv':
+            return _read_csv(path)
+        elif suffix == '.npy':
+            return _read_npy(path, options['bins'], options['range'])
+        elif _is_parse_output(path):
+            return _read_parse_output(path, options['bins'], options['range'])
+        raise CommandError(f'Unsupported file {path}')
+
+    def handle(self, *args, **options):
+        nextId = options['start_id']
+        if nextId is None:
+            latest = Histogram.objects.using(STATIC_DATABASE).order_by('-id').values_list('id', flat=True).first()
+            nextId = 0 if latest is None else latest + 1
+
+        batch = []
+        imported = []
+        for path in options['files']:
+            for hist in self.read(path, options):
+                if hist['id'] is None:
+                    hist['id'] = nextId
+                    nextId += 1
+                hist['id'] = int(hist['id'])
+                hist['name'] = options['run'] or hist['name']
+                hist['type'] = hist['type'] or options['type'] or ''
+                if not hist['name']:
+                    raise CommandError(f'{path} has no run name, specify one with --run')
+                batch.append(hist)
+                if len(batch) >= options['batch_size']:
+                    imported += self.insert(batch)
+                    batch = []
+        imported += self.insert(batch)
+
+        if options['pyramids']:
+            for id in imported:
+                build_pyramid(id, STATIC_DATABASE)
+        self.stdout.write(self.style.SUCCESS(f'Imported {len(imported)} histograms'))
+
+    def insert(self, batch):
+        '''Inserts a batch of histograms and their run memberships in a single transaction
+
+        returns: ids of the inserted histograms
+        '''
+        if not batch:
+            return []
+        ids = [hist['id'] for hist in batch]
+        with transaction.atomic(using=STATIC_DATABASE):
+            if len(set(ids)) != len(ids):
+                raise CommandError('Duplicate ids in batch, nothing was written for this batch')
+            existing = list(Histogram.objects.using(STATIC_DATABASE).filter(id__in=ids).values_list('id', flat=True))
+            if existing:
+                raise CommandError(f'hists {sorted(existing)} already exist, nothing was written for this batch')
+            Histogram.objects.using(STATIC_DATABASE).bulk_create([Histogram(**hist) for hist in batch])
+
+            runs = {}
+            for hist in batch:
+                runs.setdefault(hist['name'], []).append(hist['id'])
+            members = []
+            for name, histIds in runs.items():
+                run, _ = HistTable.objects.using(STATIC_DATABASE).update_or_create(name=name, defaults={'isLive': False})
+                members += [HistTableMember(run=run, histId=id) for id in histIds]
+            HistTableMember.objects.using(STATIC_DATABASE).bulk_create(members)
+        self.stdout.write(f'Inserted {len(ids)} histograms')
+        return ids
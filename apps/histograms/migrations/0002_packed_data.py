@@ -0,0 +1,66 @@
+# Generated by Django 3.2.12 on 2026-10-18 11:01
+
+from django.db import migrations, models
+import numpy as np
+
+BATCH_SIZE = 500
+
+
+def pack_json_data(apps, schema_editor):
+    '''Converts the JSON list of {"x": x, "y": y} points into the packed BLOB'''
+    Histogram = apps.get_model('histograms', 'Histogram')
+    database_name = schema_editor.connection.alias
+    to_update = []
+    for hist in Histogram.objects.using(database_name).only('id', 'data').iterator():
+        if hist.data is not None:
+            packed = np.empty((2, len(hist.data)), dtype='<f8')
+            packed[0] = [point['x'] for point in hist.data]
+            packed[1] = [point['y'] for point in hist.data]
+            hist.packed = packed.tobytes()
+            hist.dtype = '<f8'
+            to_update.append(hist)
+        if len(to_update) >= BATCH_SIZE:
+            Histogram.objects.using(database_name).bulk_update(to_update, ['packed', 'dtype'])
+            to_update = []
+    Histogram.objects.using(database_name).bulk_update(to_update, ['packed', 'dtype'])
+
+
+def unpack_json_data(apps, schema_editor):
+    '''Reverse of `pack_json_data`'''
+    Histogram = apps.get_model('histograms', 'Histogram')
+    database_name = schema_editor.connection.alias
+    to_update = []
+    for hist in Histogram.objects.using(database_name).only('id', 'packed', 'dtype').iterator():
+        if hist.packed is not None:
+            x, y = np.frombuffer(hist.packed, dtype=hist.dtype).reshape(2, -1).tolist()
+            hist.data = [{'x': xi, 'y': yi} for (xi, yi) in zip(x, y)]
+            to_update.append(hist)
+        if len(to_update) >= BATCH_SIZE:
+            Histogram.objects.using(database_name).bulk_update(to_update, ['data'])
+            to_update = []
+    Histogram.objects.using(database_name).bulk_update(to_update, ['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('histograms', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='histogram',
+            name='dtype',
+            field=models.CharField(default='<f8', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='histogram',
+            name='packed',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(pack_json_data, unpack_json_data),
+        migrations.RemoveField(
+            model_name='histogram',
+            name='data',
+        ),
+    ]
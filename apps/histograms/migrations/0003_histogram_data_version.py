@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('histograms', '0002_packed_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='histogram',
+            name='dataVersion',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
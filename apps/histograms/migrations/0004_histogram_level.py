@@ -0,0 +1,28 @@
+# Generated by Django 3.2.12 on 2026-10-18 11:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('histograms', '0003_histogram_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistogramLevel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('factor', models.PositiveIntegerField()),
+                ('packed', models.BinaryField()),
+                ('dtype', models.CharField(default='<f8', max_length=8)),
+                ('len', models.PositiveBigIntegerField()),
+                ('histogram', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='levels', to='histograms.histogram')),
+            ],
+            options={
+                'unique_together': {('histogram', 'factor')},
+            },
+        ),
+    ]
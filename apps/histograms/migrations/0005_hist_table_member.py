@@ -0,0 +1,57 @@
+# Generated by Django 3.2.12 on 2026-10-18 11:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def split_hist_ids(apps, schema_editor):
+    '''Converts the HistTable.histIDs JSON lists into HistTableMember rows'''
+    HistTable = apps.get_model('histograms', 'HistTable')
+    HistTableMember = apps.get_model('histograms', 'HistTableMember')
+    database_name = schema_editor.connection.alias
+    members = []
+    for entry in HistTable.objects.using(database_name).only('id', 'histIDs').iterator():
+        # Ids may have been stored as str or int, and may be duplicated
+        for histId in dict.fromkeys(int(id) for id in entry.histIDs or []):
+            members.append(HistTableMember(run_id=entry.id, histId=histId))
+    HistTableMember.objects.using(database_name).bulk_create(members, batch_size=500)
+
+
+def join_hist_ids(apps, schema_editor):
+    '''Reverse of `split_hist_ids`'''
+    HistTable = apps.get_model('histograms', 'HistTable')
+    HistTableMember = apps.get_model('histograms', 'HistTableMember')
+    database_name = schema_editor.connection.alias
+    histIDs = {}
+    for run_id, histId in HistTableMember.objects.using(database_name).order_by('id').values_list('run_id', 'histId'):
+        histIDs.setdefault(run_id, []).append(histId)
+    entries = list(HistTable.objects.using(database_name).all())
+    for entry in entries:
+        entry.histIDs = histIDs.get(entry.id, [])
+    HistTable.objects.using(database_name).bulk_update(entries, ['histIDs'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('histograms', '0004_histogram_level'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistTableMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('histId', models.PositiveBigIntegerField()),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='histograms.histtable')),
+            ],
+            options={
+                'unique_together': {('run', 'histId')},
+            },
+        ),
+        migrations.RunPython(split_hist_ids, join_hist_ids),
+        migrations.RemoveField(
+            model_name='histtable',
+            name='histIDs',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.12 on 2026-10-18 11:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('histograms', '0005_hist_table_member'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='histogram',
+            index=models.Index(fields=['created', 'id'], name='hist_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='histogram',
+            index=models.Index(fields=['type', 'created', 'id'], name='hist_type_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='histogram',
+            index=models.Index(fields=['name', 'created', 'id'], name='hist_name_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='histtable',
+            index=models.Index(fields=['created'], name='histtable_created_idx'),
+        ),
+    ]
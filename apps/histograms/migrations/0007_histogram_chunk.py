@@ -0,0 +1,26 @@
+# Generated by Django 3.2.12 on 2026-10-18 12:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('histograms', '0006_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistogramChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.PositiveBigIntegerField()),
+                ('packed', models.BinaryField()),
+                ('histogram', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='histograms.histogram')),
+            ],
+            options={
+                'unique_together': {('histogram', 'offset')},
+            },
+        ),
+    ]
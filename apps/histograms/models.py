@@ -1,19 +1,181 @@
 from django.db import models
+import numpy as np
+
+from .common import pack_points, unpack_arrays, unpack_points, downsample_indices, bin_edges, fill_counts, PACKED_DTYPE
+
+# Max number of ids per `id__in` query, below the 999 variables of SQLite before 3.32
+CHUNK_QUERY_BATCH = 500
+
+
+class HistogramQuerySet(models.QuerySet):
+    '''Appends the HistogramChunk rows of the loaded histograms to their `packed` data
+
+    Chunks are looked up with a single query per queryset, and only for histograms
+    holding fewer points in `packed` than `len`. Histograms loaded without
+    `packed` or `dtype`, and `iterator()` or `values()` querysets, are not completed
+    '''
+
+    def _fetch_all(self):
+        loaded = self._result_cache is None
+        super()._fetch_all()
+        if loaded and self._iterable_class is models.query.ModelIterable:
+            _append_chunks(self._result_cache, self.db)
+
+
+def _append_chunks(histograms, database_name):
+    incomplete = {}
+    for hist in histograms:
+        deferred = hist.get_deferred_fields()
+        if {'packed', 'dtype'} & deferred or hist.packed is None:
+            continue
+        stored = len(hist.packed) // (2 * np.dtype(hist.dtype).itemsize)
+        if 'len' in deferred or (hist.len or 0) > stored:
+            incomplete[hist.id] = hist
+    ids = list(incomplete)
+    for start in range(0, len(ids), CHUNK_QUERY_BATCH):
+        chunks = {}
+        queryset = HistogramChunk.objects.using(database_name).filter(histogram_id__in=ids[start : start + CHUNK_QUERY_BATCH])
+        for id, packed in queryset.order_by('histogram_id', 'offset').values_list('histogram_id', 'packed'):
+            chunks.setdefault(id, []).append(packed)
+        for id, packed in chunks.items():
+            hist = incomplete[id]
+            hist.packed = np.hstack([np.frombuffer(part, dtype=hist.dtype).reshape(2, -1) for part in [hist.packed] + packed]).tobytes()
 
 
 class Histogram(models.Model):
     id = models.PositiveBigIntegerField(primary_key=True)
     name = models.CharField(blank=True, max_length=500)
-    data = models.JSONField(null=True)
+    packed = models.BinaryField(null=True)  # x values followed by y values, see `pack_points`
+    dtype = models.CharField(default=PACKED_DTYPE, max_length=8)  # numpy dtype of `packed`
+    dataVersion = models.PositiveBigIntegerField(default=0)  # incremented whenever points are overwritten (not appended)
     xrange = models.JSONField(null=True)
     yrange = models.JSONField(null=True)
     len = models.PositiveBigIntegerField(null=True)
     created = models.DateTimeField(auto_now_add=True)
     type = models.CharField(blank=True, max_length=100)
 
+    objects = HistogramQuerySet.as_manager()
+
+    class Meta:
+        # Match the filters of getHistograms and the (-created, -id) order of getHistogramPage
+        indexes = [
+            models.Index(fields=['created', 'id'], name='hist_created_id_idx'),
+            models.Index(fields=['type', 'created', 'id'], name='hist_type_created_idx'),
+            models.Index(fields=['name', 'created', 'id'], name='hist_name_created_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        '''Saving `packed` folds in the appended chunks, as the instance holds all points'''
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        updateFields = kwargs.get('update_fields')
+        if not adding and (updateFields is None or 'packed' in updateFields):
+            HistogramChunk.objects.using(self._state.db).filter(histogram_id=self.id).delete()
+
+    @property
+    def data(self):
+        '''List of {"x": x, "y": y} points as served by graphql'''
+        return unpack_points(self.packed, self.dtype)
+
+    @data.setter
+    def data(self, points):
+        self.dataVersion += 1
+        self.dtype = PACKED_DTYPE
+        self.packed = pack_points(points, self.dtype)
+
+    def arrays(self):
+        '''Returns the (x, y) data as read-only numpy arrays'''
+        return unpack_arrays(self.packed, self.dtype)
+
+    def downsample(self, maxPoints):
+        '''Replaces the in-memory data with at most `maxPoints` points. Does not save
+
+        `len` keeps counting the points stored in the database
+        '''
+        if self.packed is None or maxPoints is None:
+            return
+        xy = np.frombuffer(self.packed, dtype=self.dtype).reshape(2, -1)
+        if xy.shape[1] <= maxPoints:
+            return
+        self.packed = xy[:, downsample_indices(xy[1], maxPoints)].tobytes()
+
+    def fill(self, values, weights=None):
+        '''Bins raw `values` into the existing bins, with `x` the lower bin edges, and
+        adds them to the counts `y`
+
+        returns: (underflow, overflow) number of values outside of the bins
+        '''
+        if not self.len:
+            raise ValueError(f'hist {self.id} has no bins to fill')
+        if weights is not None and len(weights) != len(values):
+            raise ValueError('`values` and `weights` must have the same length')
+        xy = np.frombuffer(self.packed, dtype=self.dtype).reshape(2, -1)
+        counts, underflow, overflow = fill_counts(bin_edges(xy[0], self.xrange), xy[1], values, weights)
+        self.packed = np.vstack((xy[0], counts)).astype(self.dtype).tobytes()
+        self.dataVersion += 1
+        return underflow, overflow
+
+    def append(self, points):
+        '''Appends a list of {"x": x, "y": y} points and updates `len`
+
+        returns: the appended points packed like `packed`, see HistogramChunk
+        '''
+        added = pack_points(points, self.dtype)
+        new = np.frombuffer(added, dtype=self.dtype).reshape(2, -1)
+        if self.packed is not None:
+            new = np.hstack((np.frombuffer(self.packed, dtype=self.dtype).reshape(2, -1), new))
+        self.packed = new.tobytes()
+        self.len = new.shape[1]
+        return added
+
+
+class HistogramChunk(models.Model):
+    '''Points appended to a Histogram in the database after its `packed` data was saved
+
+    Appending inserts a chunk instead of rewriting the whole `packed` BLOB, see
+    `mutation._append_histogram_points`. Histograms loaded through their queryset
+    get the chunks concatenated to `packed`, and saving `packed` deletes them
+    '''
+
+    histogram = models.ForeignKey(Histogram, on_delete=models.CASCADE, related_name='chunks')
+    offset = models.PositiveBigIntegerField()  # Index of the first point of the chunk
+    packed = models.BinaryField()  # Same layout and dtype as `Histogram.packed`
+
+    class Meta:
+        unique_together = [('histogram', 'offset')]
+
+
+class HistogramLevel(models.Model):
+    '''Precomputed decimation of a static Histogram holding at most len // factor points'''
+
+    histogram = models.ForeignKey(Histogram, on_delete=models.CASCADE, related_name='levels')
+    factor = models.PositiveIntegerField()
+    packed = models.BinaryField()
+    dtype = models.CharField(default=PACKED_DTYPE, max_length=8)
+    len = models.PositiveBigIntegerField()
+
+    class Meta:
+        unique_together = [('histogram', 'factor')]
+
 
 class HistTable(models.Model):
     name = models.CharField(max_length=500, unique=True)
     created = models.DateTimeField(auto_now_add=True)
-    histIDs = models.JSONField(null=True)
     isLive = models.BooleanField()
+
+    class Meta:
+        indexes = [models.Index(fields=['created'], name='histtable_created_idx')]
+
+
+class HistTableMember(models.Model):
+    '''Membership of a histogram in a HistTable run
+
+    Stored in the static db along with the HistTable, so `histId` is a
+    plain id rather than a foreign key since the histogram may be live
+    '''
+
+    run = models.ForeignKey(HistTable, on_delete=models.CASCADE, related_name='members')
+    histId = models.PositiveBigIntegerField()
+
+    class Meta:
+        unique_together = [('run', 'histId')]
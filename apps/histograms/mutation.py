@@ -1,17 +1,32 @@
 from ariadne import MutationType
-from .models import Histogram, HistTable
+from .models import Histogram, HistogramChunk, HistTable, HistTableMember
 from channels.db import database_sync_to_async
+from django.db import transaction
+from django.db.models import Count, Min
+from django.core.exceptions import ValidationError
+from contextlib import contextmanager, ExitStack
+from functools import partial
 
 from .common import (
     histogram_payload,
+    histograms_payload,
     clean_hist_input,
     chooseDatabase,
     hist_string_field,
+    widen_range,
+    decode_packed_values,
     STATIC_DATABASE,
     LIVE_DATABASE,
+    MAX_HISTOGRAM_CHUNKS,
 )
 
 from .query import _get_histogram
+from .hub import histogram_hub
+from .pyramid import schedule_pyramid_build, drop_pyramid
+from .analysis import stats_cache
+from .runs import latest_run
+from .livestore import live_store_for
+from .writebehind import get_write_behind, flush_listeners
 
 """
 Asynchronous database access 
@@ -30,62 +45,254 @@ def _create_histogram(clean_hist, database_name):
 
     # Create new histogram
     new_hist = Histogram(**clean_hist)
-    new_hist.save(using=database_name)
+    store = live_store_for(database_name)
+    if store:
+        store.insert([new_hist])
+    else:
+        new_hist.save(using=database_name)
     return new_hist, True
 
 
+def _validate_new_histograms(clean_hists):
+    """Checks a batch of new histograms without touching the databases
+
+    Returns an error message, or None if the batch is valid
+    """
+    ids = [int(clean_hist['id']) for clean_hist in clean_hists]
+    if len(set(ids)) != len(ids):
+        return 'Duplicate ids in batch'
+    for clean_hist in clean_hists:
+        hist = Histogram(**{key: value for (key, value) in clean_hist.items() if key != 'isLive'})
+        try:
+            hist.clean_fields(exclude=['len'])  # Unset without data
+        except ValidationError as e:
+            return f'hist {hist.id} is invalid: {e.messages}'
+        for field in ('xrange', 'yrange'):
+            if clean_hist[field] is not None and clean_hist[field]['min'] > clean_hist[field]['max']:
+                return f'hist {hist.id} has a {field} with min above max'
+        store = live_store_for(chooseDatabase(clean_hist['isLive']))
+        if store and (clean_hist.get('len') or 0) > store.points:
+            return f'hist {hist.id} has {clean_hist["len"]} points, live histograms hold at most {store.points}'
+    return None
+
+
+@database_sync_to_async
+def _create_histograms(clean_hists):
+    """Creates a batch of histograms in a single transaction
+
+    The whole batch is validated before any transaction is opened,
+    and nothing is written if it is invalid
+
+    Returns (created_histograms, message, success)
+    """
+    error = _validate_new_histograms(clean_hists)
+    if error:
+        return [], error, False
+    ids = [int(clean_hist['id']) for clean_hist in clean_hists]
+
+    by_database = {}
+    for clean_hist in clean_hists:
+        by_database.setdefault(chooseDatabase(clean_hist['isLive']), []).append(clean_hist)
+
+    created = []
+    with ExitStack() as transactions:
+        # Only take the write lock of the databases the batch writes to, always in the same order.
+        # Runs are in the static db, and histograms in the live store are not in the live db
+        for database_name in sorted({STATIC_DATABASE} | {name for name in by_database if not live_store_for(name)}):
+            transactions.enter_context(transaction.atomic(using=database_name))
+        for database_name, batch in by_database.items():
+            batch_ids = [clean_hist['id'] for clean_hist in batch]
+            store = live_store_for(database_name)
+            existing = store.exists(batch_ids) if store else list(Histogram.objects.using(database_name).filter(id__in=batch_ids).values_list('id', flat=True))
+            if existing:
+                return [], f'hists {sorted(existing)} already exist in {database_name}', False
+
+        stored = []
+        for database_name, batch in by_database.items():
+            new_hists = [Histogram(**{key: value for (key, value) in clean_hist.items() if key != 'isLive'}) for clean_hist in batch]
+            store = live_store_for(database_name)
+            if store:
+                stored.append((store, new_hists))
+            else:
+                created += Histogram.objects.using(database_name).bulk_create(new_hists)
+
+        # Write each affected HistTable entry once, and all memberships at once
+        by_name = {}
+        for clean_hist in clean_hists:
+            by_name.setdefault(clean_hist['name'], []).append(clean_hist)
+        members = []
+        table_entries = []
+        for name, batch in by_name.items():
+            isLive = chooseDatabase(batch[-1]['isLive']) is LIVE_DATABASE
+            table_entry, _ = HistTable.objects.using(STATIC_DATABASE).update_or_create(name=name, defaults={'isLive': isLive})
+            members += [HistTableMember(run=table_entry, histId=int(clean_hist['id'])) for clean_hist in batch]
+            table_entries.append(table_entry)
+        HistTableMember.objects.using(STATIC_DATABASE).bulk_create(members)
+
+        # Last, as the store is not rolled back with the transaction
+        for store, new_hists in stored:
+            created += store.insert(new_hists)
+    for table_entry in table_entries:
+        latest_run.observe(table_entry.name, table_entry.created)
+    return created, f'created hists {ids}', True
+
+
+@contextmanager
+def _modified_histogram(id, database_name, updatedFields=None):
+    """Yields histogram `id`, then saves it
+
+    Only the fields of `updatedFields` are saved, if given. The list
+    may be extended inside the block. Concurrent changes are excluded meanwhile.
+    If the data changed, the pyramid levels of static histograms are dropped in the same transaction
+    """
+    store = live_store_for(database_name)
+    if store:
+        with store.modify(id) as histogram:
+            yield histogram
+        return
+    buffer = get_write_behind()
+    if buffer:
+        buffer.flush(database_name, id)
+    with transaction.atomic(using=database_name):
+        histogram = Histogram.objects.using(database_name).select_for_update().get(id=id)
+        version = (histogram.dataVersion, histogram.len)
+        yield histogram
+        histogram.save(using=database_name, update_fields=updatedFields)
+        if database_name == STATIC_DATABASE and (histogram.dataVersion, histogram.len) != version:
+            drop_pyramid(id, database_name)
+
+
+# Model fields holding the `data` of a histogram
+DATA_FIELDS = ['packed', 'dtype', 'dataVersion']
+
+
+def _updated_fields(clean_hist):
+    '''Names of the non-empty fields of `clean_hist` that an update sets'''
+    # Avoid altering PK
+    return [attr for (attr, value) in clean_hist.items() if attr != 'id' and value is not None and hasattr(Histogram, attr)]
+
+
+def _apply_update(clean_hist, in_database):
+    '''Sets the non-empty fields of `clean_hist` on `in_database`, returns the model fields to save'''
+    modelFields = []
+    for attr in _updated_fields(clean_hist):
+        setattr(in_database, attr, clean_hist[attr])
+        modelFields += DATA_FIELDS if attr == 'data' else [attr]
+    return modelFields
+
+
 @database_sync_to_async
 def _update_histogram(clean_hist, database_name):
-    '''Returns (updated_histogram, updated_fields, success)'''
-    in_database = Histogram.objects.using(database_name).get(id=clean_hist['id'])
+    '''Returns (updated_histogram, updated_fields, saved)
+
+    Updates are held in the write-behind buffer if it is enabled, in which case `saved` is False
+    '''
+    buffer = None if live_store_for(database_name) else get_write_behind()
+    if buffer:
+        in_database = buffer.update(database_name, clean_hist['id'], partial(_apply_update, clean_hist))
+        return (in_database, _updated_fields(clean_hist), False)
+    with _modified_histogram(clean_hist['id'], database_name) as in_database:
+        _apply_update(clean_hist, in_database)
+    return (in_database, _updated_fields(clean_hist), True)
+
+
+@database_sync_to_async
+def _append_histogram_points(id, points, widenRanges, database_name):
+    '''Returns (updated_histogram, success)
 
-    updatedFields = []
-    for attr in clean_hist.keys():
-        if attr == 'id':  # Avoid altering PK
-            continue
-        elif (clean_hist[attr] is not None) and hasattr(in_database, attr):
-            setattr(in_database, attr, clean_hist[attr])
-            updatedFields.append(attr)
-    in_database.save(using=database_name)
-    return (in_database, updatedFields, True)
+    In the database the points are inserted as a HistogramChunk instead of rewriting
+    `packed`, which is only saved again, with all points, once the chunks hold as many
+    points as it does, or MAX_HISTOGRAM_CHUNKS is reached to bound the rows read per histogram
+    '''
+    updatedFields = ['len']
+    with _modified_histogram(id, database_name, updatedFields) as in_database:
+        stored = 0 if in_database.packed is None else len(in_database.arrays()[0])
+        added = in_database.append(points)
+        if live_store_for(database_name) or not stored:
+            updatedFields += ['packed', 'dtype']
+        else:
+            chunks = HistogramChunk.objects.using(database_name).filter(histogram_id=id).aggregate(count=Count('id'), first=Min('offset'))
+            saved = chunks['first'] if chunks['count'] else stored
+            if in_database.len - saved >= saved or chunks['count'] >= MAX_HISTOGRAM_CHUNKS:
+                updatedFields += ['packed', 'dtype']
+            else:
+                HistogramChunk.objects.using(database_name).create(histogram_id=id, offset=stored, packed=added)
+        if widenRanges:
+            in_database.xrange = widen_range(in_database.xrange, [point['x'] for point in points])
+            in_database.yrange = widen_range(in_database.yrange, [point['y'] for point in points])
+            updatedFields += ['xrange', 'yrange']
+    return in_database, True
+
+
+@database_sync_to_async
+def _fill_histogram(id, values, weights, widenRanges, database_name):
+    '''Returns (updated_histogram, underflow, overflow, success)'''
+    updatedFields = ['packed', 'dtype', 'dataVersion']
+    with _modified_histogram(id, database_name, updatedFields) as in_database:
+        underflow, overflow = in_database.fill(values, weights)
+        if widenRanges:
+            in_database.yrange = widen_range(in_database.yrange, in_database.arrays()[1].tolist())
+            updatedFields.append('yrange')
+    return in_database, underflow, overflow, True
 
 
 @database_sync_to_async
 def _delete_histogram(id, database_name):
-    to_delete = Histogram.objects.using(database_name).get(id=id)
+    buffer = get_write_behind()
+    if buffer:
+        buffer.discard(database_name, id)
+    store = live_store_for(database_name)
+    to_delete = store.get(id) if store else Histogram.objects.using(database_name).get(id=id)
 
-    # Update HistTable entry
-    table_entry = HistTable.objects.using(STATIC_DATABASE).get(name=to_delete.name)
-    table_entry.histIDs.remove(id)
-    if not table_entry.histIDs:
-        table_entry.delete()
-    else:
-        table_entry.save(using=STATIC_DATABASE)
+    # Update HistTable entry, and remove it along with its last histogram
+    with transaction.atomic(using=STATIC_DATABASE):
+        HistTableMember.objects.using(STATIC_DATABASE).filter(run__name=to_delete.name, histId=id).delete()
+        deleted, _ = HistTable.objects.using(STATIC_DATABASE).filter(name=to_delete.name, members__isnull=True).delete()
+    if deleted:
+        latest_run.invalidate()
 
-    to_delete.delete()
+    if store:
+        store.delete(id)
+    else:
+        to_delete.delete()
     return True
 
 
 @database_sync_to_async
 def _update_hist_table_entry(clean_hist, database_name):
     """Update HistTable entry"""
-    try:
-        table_entry = HistTable.objects.using(STATIC_DATABASE).get(name=clean_hist['name'])
-        table_entry.histIDs.append(clean_hist['id'])
-        table_entry.isLive = database_name is LIVE_DATABASE
-        table_entry.save(using=STATIC_DATABASE)
-    except HistTable.DoesNotExist:
+    with transaction.atomic(using=STATIC_DATABASE):
         # If this is the first histogram with a certain name,
-        # create a new entry in the HistTable
-        new_table_entry = HistTable(
+        # creates a new entry in the HistTable
+        table_entry, _ = HistTable.objects.using(STATIC_DATABASE).update_or_create(
             name=clean_hist['name'],
-            histIDs=[clean_hist['id']],
-            isLive=(database_name is LIVE_DATABASE),
+            defaults={'isLive': database_name is LIVE_DATABASE},
         )
-        new_table_entry.save(using=STATIC_DATABASE)
+        HistTableMember.objects.using(STATIC_DATABASE).get_or_create(run=table_entry, histId=int(clean_hist['id']))
+    latest_run.observe(table_entry.name, table_entry.created)
     return True
 
 
+def _histogram_changed(kind, id, isLive, dataChanged=True):
+    '''Notifies subscriptions, drops cached stats and rebuilds the pyramid of static histograms'''
+    histogram_hub.publish(kind, id, isLive)
+    stats_cache.invalidate(chooseDatabase(isLive), id)
+    if dataChanged and kind != 'delete' and not isLive:
+        schedule_pyramid_build(id, STATIC_DATABASE)
+
+
+def _updates_saved(flushed):
+    '''Called once updates held in the write-behind buffer are saved'''
+    for database_name, id, updatedFields in flushed:
+        dataChanged = 'packed' in updatedFields
+        if dataChanged and database_name == STATIC_DATABASE:
+            drop_pyramid(id, database_name)
+        _histogram_changed('update', id, database_name == LIVE_DATABASE, dataChanged=dataChanged)
+
+
+flush_listeners.append(_updates_saved)
+
+
 """
 Mutations
 """
@@ -93,29 +300,76 @@ Mutations
 mutation = MutationType()
 
 
-@mutation.field("createHistogram")
-async def create_histogram(*_, hist):
+def _clean_new_hist_input(hist):
     clean_hist = clean_hist_input(hist)
     # Django does not like saving null values in the string fields
     # and prefers blank strs
     for field in hist_string_field:
         if clean_hist[field] is None:
             clean_hist[field] = ''
-    table_status = await _update_hist_table_entry(clean_hist, database_name=chooseDatabase(clean_hist['isLive']))
-    modified, create_status = await _create_histogram(clean_hist, database_name=chooseDatabase(clean_hist['isLive']))
+    return clean_hist
+
+
+@mutation.field("createHistogram")
+async def create_histogram(*_, hist):
+    clean_hist = _clean_new_hist_input(hist)
+    isLive = clean_hist['isLive']
+    table_status = await _update_hist_table_entry(clean_hist, database_name=chooseDatabase(isLive))
+    modified, create_status = await _create_histogram(clean_hist, database_name=chooseDatabase(isLive))
+    _histogram_changed('create', modified.id, isLive)
     return histogram_payload(modified=modified, message=f'created hist {clean_hist["id"]}', success=all([create_status, table_status]))
 
 
+@mutation.field("createHistograms")
+async def create_histograms(*_, hists):
+    clean_hists = [_clean_new_hist_input(hist) for hist in hists]
+    modified, message, status = await _create_histograms(clean_hists)
+    if status:
+        for clean_hist in clean_hists:
+            _histogram_changed('create', clean_hist['id'], clean_hist['isLive'])
+    return histograms_payload(modified=modified, message=message, success=status)
+
+
 @mutation.field("updateHistogram")
 async def update_histogram(*_, hist):
     '''Updates non-empty fields from hist object'''
     clean_hist = clean_hist_input(hist)
-    modified, updatedFields, status = await _update_histogram(clean_hist, database_name=chooseDatabase(clean_hist['isLive']))
-    return histogram_payload(modified=modified, message=f'Updated fields {updatedFields}', success=status)
+    modified, updatedFields, saved = await _update_histogram(clean_hist, database_name=chooseDatabase(clean_hist['isLive']))
+    if saved:
+        _histogram_changed('update', modified.id, clean_hist['isLive'], dataChanged='data' in updatedFields)
+        return histogram_payload(modified=modified, message=f'Updated fields {updatedFields}', success=True)
+    return histogram_payload(modified=modified, message=f'Updated fields {updatedFields} (saved within {get_write_behind().window} s)', success=True)
+
+
+@mutation.field("appendHistogramPoints")
+async def append_histogram_points(*_, id, points, isLive=False, widenRanges=False):
+    '''Appends `points` to the end of an existing histogram'''
+    modified, status = await _append_histogram_points(id, points, widenRanges, database_name=chooseDatabase(isLive))
+    _histogram_changed('append', modified.id, isLive)
+    return histogram_payload(modified=modified, message=f'Appended {len(points)} points to hist {id}', success=status)
+
+
+@mutation.field("fillHistogram")
+async def fill_histogram(*_, id, values, weights=None, isLive=False, widenRanges=False):
+    '''Bins raw `values` into an existing histogram'''
+    modified, underflow, overflow, status = await _fill_histogram(id, values, weights, widenRanges, database_name=chooseDatabase(isLive))
+    _histogram_changed('update', modified.id, isLive)
+    return histogram_payload(
+        modified=modified,
+        message=f'Filled {len(values)} values into hist {id} ({underflow} underflow, {overflow} overflow)',
+        success=status,
+    )
+
+
+@mutation.field("fillHistogramPacked")
+async def fill_histogram_packed(*_, id, values, weights=None, isLive=False, widenRanges=False):
+    '''Same as fillHistogram, with `values` and `weights` as base64 little-endian float64 arrays'''
+    return await fill_histogram(id=id, values=decode_packed_values(values), weights=decode_packed_values(weights), isLive=isLive, widenRanges=widenRanges)
 
 
 @mutation.field("deleteHistogram")
 async def delete_histogram(*_, id, isLive=False):
     modified = await _get_histogram(id, database_name=chooseDatabase(isLive))
     status = await _delete_histogram(id, database_name=chooseDatabase(isLive))
+    _histogram_changed('delete', modified.id, isLive)
     return histogram_payload(modified=modified, message=f'deleted hist {id}', success=status)
@@ -0,0 +1,107 @@
+"""
+Multi-resolution pyramid of static histograms
+
+Each static histogram gets a HistogramLevel per factor of PYRAMID_FACTORS,
+built in a background thread after it is created or changed. Queries with
+`maxPoints` then load the coarsest level still holding `maxPoints` points
+instead of the full data, and downsample that in memory
+
+Mutations that change the data drop the levels of the histogram in their
+transaction, so queries decimate the full data until the rebuild is done
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import numpy as np
+from django.db import transaction, connections, IntegrityError
+
+from .models import Histogram, HistogramLevel
+from .common import downsample_indices, choose_pyramid_factor, PYRAMID_FACTORS
+
+# Single worker so that pyramid builds do not compete with each other for the SQLite write lock
+_executor = ThreadPoolExecutor(max_workers=1)
+
+logger = logging.getLogger(__name__)
+
+
+def build_pyramid(id, database_name):
+    '''(Re)builds all pyramid levels of histogram `id`
+
+    returns: number of levels stored
+    '''
+    try:
+        hist = Histogram.objects.using(database_name).get(id=id)
+    except Histogram.DoesNotExist:  # Deleted before the build ran
+        return 0
+    levels = []
+    if hist.packed is not None:
+        xy = np.frombuffer(hist.packed, dtype=hist.dtype).reshape(2, -1)
+        for factor in PYRAMID_FACTORS:
+            if xy.shape[1] // factor < 2:
+                break
+            level = xy[:, downsample_indices(xy[1], xy.shape[1] // factor)]
+            levels.append(HistogramLevel(histogram_id=id, factor=factor, packed=level.tobytes(), dtype=hist.dtype, len=level.shape[1]))
+    try:
+        with transaction.atomic(using=database_name):
+            # Skip levels built from data changed while they were computed, the change schedules another build
+            current = Histogram.objects.using(database_name).filter(id=id).values_list('dataVersion', 'len').first()
+            if current != (hist.dataVersion, hist.len):
+                return 0
+            HistogramLevel.objects.using(database_name).filter(histogram_id=id).delete()
+            HistogramLevel.objects.using(database_name).bulk_create(levels)
+    except IntegrityError:  # Deleted while the build was running
+        return 0
+    return len(levels)
+
+
+def _build_pyramid_in_background(id, database_name):
+    try:
+        build_pyramid(id, database_name)
+    finally:
+        connections.close_all()
+
+
+def _log_build_failure(id, future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f'Failed to build the pyramid of hist {id}', exc_info=future.exception())
+
+
+def schedule_pyramid_build(id, database_name):
+    '''Queues a rebuild of the pyramid of histogram `id` without waiting for it'''
+    future = _executor.submit(_build_pyramid_in_background, id, database_name)
+    future.add_done_callback(lambda future: _log_build_failure(id, future))
+    return future
+
+
+def drop_pyramid(id, database_name):
+    '''Deletes the pyramid levels of histogram `id`, which no longer match its data'''
+    HistogramLevel.objects.using(database_name).filter(histogram_id=id).delete()
+
+
+def load_pyramid_data(histograms, database_name, maxPoints):
+    '''Fills `packed` of histograms loaded with `defer('packed')`
+
+    Uses the coarsest pyramid level holding at least `maxPoints` points,
+    falling back to the full data if that level has not been built
+    '''
+    by_factor = {}
+    for hist in histograms:
+        by_factor.setdefault(choose_pyramid_factor(hist.len, maxPoints), []).append(hist)
+
+    missing = by_factor.pop(None, [])
+    for factor, hists in by_factor.items():
+        levels = HistogramLevel.objects.using(database_name).filter(factor=factor, histogram_id__in=[hist.id for hist in hists])
+        levels = {level.histogram_id: level for level in levels}
+        for hist in hists:
+            level = levels.get(hist.id)
+            if level is None:
+                missing.append(hist)
+            else:
+                hist.packed, hist.dtype = level.packed, level.dtype
+
+    if missing:
+        full = Histogram.objects.using(database_name).filter(id__in=[hist.id for hist in missing]).only('packed', 'dtype', 'len')
+        full = {hist.id: hist for hist in full}
+        for hist in missing:
+            hist.packed, hist.dtype = full[hist.id].packed, full[hist.id].dtype
+    return histograms
@@ -1,8 +1,27 @@
-from ariadne import QueryType
-from .models import Histogram, HistTable
-from channels.db import database_sync_to_async
-from cursor_pagination import CursorPaginator
-from .common import chooseDatabase, STATIC_DATABASE, DEFAULT_TABLE_FIRST
+from ariadne import QueryType, ObjectType
+from .models import Histogram, HistTable, HistTableMember
+from LANE_server.db import database_read_async
+from cursor_pagination import CursorPaginator, Tuple
+from django.db.models import Value, TextField
+from django.db import connections
+import datetime
+from .common import (
+    chooseDatabase,
+    selected_fields,
+    check_max_points,
+    hist_columns,
+    downsample_indices,
+    STATIC_DATABASE,
+    DEFAULT_TABLE_FIRST,
+    DEFAULT_HISTOGRAM_FIRST,
+    MAX_HISTOGRAM_FIRST,
+)
+from .pyramid import load_pyramid_data
+from .loader import get_loader
+from .runs import latest_run
+from .livestore import live_store_for
+from .writebehind import get_write_behind
+from .analysis import aggregate, compare, summary_stats, stats_key, stats_cache
 
 """ Asynchronous generator for database access 
 Note that we cannot pass querysets out from the generator, 
@@ -10,15 +29,102 @@ so we must evaluate the query set before returning
 """
 
 
-@database_sync_to_async
-def _get_histogram(id, database_name):
-    return Histogram.objects.using(database_name).get(id=id)
+class StoredCursorPaginator(CursorPaginator):
+    """CursorPaginator whose cursors hold datetimes in the format stored by the database
 
+    CursorPaginator compares cursors as text against the stored values. Its
+    default cursors end with a `+00:00` that sqlite does not store, so the
+    entry of the `after` cursor would be returned again
 
-@database_sync_to_async
-def _filter_histograms(ids, names, types, minDate, maxDate, isLive):
-    """Applies filters onto queryset"""
-    queryset = Histogram.objects.using(chooseDatabase(isLive)).all()
+    Also supports orderings on several fields with sqlite
+    """
+
+    def apply_cursor(self, cursor, queryset, reverse=False):
+        # Same as CursorPaginator, but with alias() instead of annotate()
+        # as sqlite does not allow row values in the SELECT clause
+        position = self.decode_cursor(cursor)
+        is_reversed = self.ordering[0].startswith('-')
+        queryset = queryset.alias(_cursor=Tuple(*[o.lstrip('-') for o in self.ordering]))
+        current_position = [Value(p, output_field=TextField()) for p in position]
+        if reverse != is_reversed:
+            return queryset.filter(_cursor__lt=Tuple(*current_position))
+        return queryset.filter(_cursor__gt=Tuple(*current_position))
+
+    def position_from_instance(self, instance):
+        connection = connections[self.queryset.db]
+        position = []
+        for order in self.ordering:
+            value = getattr(instance, order.lstrip('-'))
+            if isinstance(value, datetime.datetime):
+                value = connection.ops.adapt_datetimefield_value(value)
+            position.append(str(value))
+        return position
+
+
+def _histogram_queryset(database_name, fields, usePyramid):
+    """Only loads the columns needed to resolve the graphql `fields` (all if None)
+
+    The full data is never loaded if it will be replaced by a pyramid level
+    """
+    queryset = Histogram.objects.using(database_name).all()
+    if fields is not None:
+        # Graphql fields such as `__typename` have no column
+        columns = hist_columns(fields) & {field.name for field in Histogram._meta.concrete_fields}
+        queryset = queryset.only(*columns)
+    if usePyramid:
+        queryset = queryset.defer('packed')
+    return queryset
+
+
+def _uses_pyramid(database_name, fields, maxPoints):
+    return maxPoints is not None and database_name == STATIC_DATABASE and (fields is None or 'data' in fields)
+
+
+@database_read_async
+def _get_histogram(id, database_name, maxPoints=None, fields=None):
+    """If `maxPoints` is specified for a static histogram, loads
+    the pyramid level closest to `maxPoints` instead of the full data
+
+    `fields` is the set of graphql fields to resolve (default: all)
+    """
+    store = live_store_for(database_name)
+    if store:
+        return store.get(id)
+    buffer = get_write_behind()
+    pending = buffer and buffer.pending(database_name, id)
+    if pending:
+        return pending
+    usePyramid = _uses_pyramid(database_name, fields, maxPoints)
+    histogram = _histogram_queryset(database_name, fields, usePyramid).get(id=id)
+    if usePyramid:
+        load_pyramid_data([histogram], database_name, maxPoints)
+    return histogram
+
+
+@database_read_async
+def _filter_histograms(ids, names, types, minDate, maxDate, isLive, maxPoints=None, fields=None):
+    """Applies filters onto queryset
+
+    `maxPoints` and `fields` behave as in `_get_histogram`
+    """
+    database_name = chooseDatabase(isLive)
+    store = live_store_for(database_name)
+    if store:
+        return store.filter(ids, names, types, minDate, maxDate)
+    usePyramid = _uses_pyramid(database_name, fields, maxPoints)
+    queryset = _apply_histogram_filters(_histogram_queryset(database_name, fields, usePyramid), ids, names, types, minDate, maxDate)
+
+    histograms = load_pyramid_data(list(queryset), database_name, maxPoints) if usePyramid else list(queryset)
+    return _with_pending_updates(database_name, histograms)
+
+
+def _with_pending_updates(database_name, histograms):
+    """Replaces histograms by their copy in the write-behind buffer, if they have unsaved updates"""
+    buffer = get_write_behind()
+    return buffer.overlay(database_name, histograms) if buffer else histograms
+
+
+def _apply_histogram_filters(queryset, ids, names, types, minDate, maxDate):
     if ids:
         queryset = queryset.filter(id__in=ids)
     if names:
@@ -29,11 +135,118 @@ def _filter_histograms(ids, names, types, minDate, maxDate, isLive):
         queryset = queryset.filter(created__gte=minDate)
     if maxDate:
         queryset = queryset.filter(created__lte=maxDate)
+    return queryset
+
+
+def _select_histograms(selection):
+    """Returns the histograms matching a graphql HistogramSelection, sorted by id"""
+    filters = [selection.get(key) for key in ('ids', 'names', 'types', 'minDate', 'maxDate')]
+    database_name = chooseDatabase(selection.get('isLive'))
+    store = live_store_for(database_name)
+    if store:
+        return store.filter(*filters)
+    return list(_apply_histogram_filters(Histogram.objects.using(database_name).all(), *filters).order_by('id'))
+
+
+@database_read_async
+def _load_histograms(ids, database_name, maxPoints=None, fields=None):
+    """Loads the histograms of `ids` with a single query
+
+    `maxPoints` and `fields` behave as in `_get_histogram`
+
+    returns: dict id -> histogram
+    """
+    store = live_store_for(database_name)
+    if store:
+        return {hist.id: hist for hist in store.filter(ids=ids)}
+    usePyramid = _uses_pyramid(database_name, fields, maxPoints)
+    histograms = list(_histogram_queryset(database_name, fields, usePyramid).filter(id__in=ids))
+    if usePyramid:
+        load_pyramid_data(histograms, database_name, maxPoints)
+    return {hist.id: hist for hist in _with_pending_updates(database_name, histograms)}
+
+
+@database_read_async
+def _aggregate_histograms(selection, op, reference=None, maxPoints=None):
+    """Combines the selected histograms into a single histogram, see `analysis.aggregate`"""
+    histograms = _select_histograms(selection)
+    references = _select_histograms(reference) if reference else []
+    x, y, xrange = aggregate(histograms, op, references)
+    keep = downsample_indices(y, maxPoints)
+    x, y = x[keep], y[keep]
+    return {
+        'op': op,
+        'sourceIds': [hist.id for hist in histograms],
+        'referenceIds': [hist.id for hist in references],
+        'data': [{'x': xi, 'y': yi} for (xi, yi) in zip(x.tolist(), y.tolist())],
+        'xrange': xrange,
+        'yrange': {'min': float(y.min()), 'max': float(y.max())} if len(y) else None,
+        'len': len(y),
+    }
+
+
+@database_read_async
+def _compare_histograms(referenceId, candidateIds, isLive):
+    """Compares the candidate histograms to the reference, see `analysis.compare`
+
+    Candidates that do not exist are skipped
+    """
+    database_name = chooseDatabase(isLive)
+    store = live_store_for(database_name)
+    if store:
+        reference = store.get(referenceId)
+        candidates = {hist.id: hist for hist in store.filter(ids=candidateIds)}
+    else:
+        queryset = Histogram.objects.using(database_name).only('packed', 'dtype', 'xrange', 'len')
+        reference = queryset.get(id=referenceId)
+        candidates = {hist.id: hist for hist in queryset.filter(id__in=candidateIds)}
+    return compare(reference, [candidates[int(id)] for id in candidateIds if int(id) in candidates])
+
 
-    return list(queryset)
+@database_read_async
+def _paginate_histograms(first, after, ids, names, types, minDate, maxDate, isLive, maxPoints=None, fields=None):
+    """Paginates the histograms matching the filters of `_filter_histograms`
 
+    Histograms are sorted by descending creation date, then descending id
+    """
+    if first is None:
+        first = DEFAULT_HISTOGRAM_FIRST
+    elif first < 1:
+        raise ValueError('`first` must be positive')
+    first = min(first, MAX_HISTOGRAM_FIRST)
 
-@database_sync_to_async
+    database_name = chooseDatabase(isLive)
+    usePyramid = _uses_pyramid(database_name, fields, maxPoints)
+    if fields is not None:
+        fields = fields | {'created'}  # Needed for the cursors
+    queryset = _apply_histogram_filters(_histogram_queryset(database_name, fields, usePyramid), ids, names, types, minDate, maxDate)
+
+    paginator = StoredCursorPaginator(queryset, ordering=('-created', '-id'))
+    page = paginator.page(first=first, after=after)
+    histograms = list(page)
+    if usePyramid:
+        load_pyramid_data(histograms, database_name, maxPoints)
+
+    pageInfo = {
+        'hasNextPage': page.has_next,
+        'endCursor': paginator.cursor(histograms[-1]) if histograms else None,
+    }
+    edges = [{'node': hist, 'cursor': paginator.cursor(hist)} for hist in histograms]
+    return {'edges': edges, 'pageInfo': pageInfo}
+
+
+def _attach_hist_ids(entries):
+    """Sets `histIDs` on HistTable entries with a single indexed query"""
+    histIDs = {entry.id: [] for entry in entries}
+    members = HistTableMember.objects.using(STATIC_DATABASE).filter(run_id__in=histIDs.keys()).order_by('id')
+    for run_id, histId in members.values_list('run_id', 'histId'):
+        histIDs[run_id].append(histId)
+    for entry in entries:
+        entry.histIDs = histIDs[entry.id]
+    return entries
+
+
+@database_read_async
 def _paginate_hist_table(first, after, minDate, maxDate):
     """Paginates HistTable entries"""
     queryset = HistTable.objects.using(STATIC_DATABASE).all()
@@ -64,17 +277,39 @@ def _paginate_hist_table(first, after, minDate, maxDate):
         hasNextPage = False
 
     pageInfo = {'hasNextPage': hasNextPage, 'endCursor': endCursor}
-    edges = [{'node': p, 'cursor': paginator.cursor(p)} for p in page[pageIndex:]]
+    edges = [{'node': p, 'cursor': paginator.cursor(p)} for p in _attach_hist_ids(page[pageIndex:])]
     return {'edges': edges, 'pageInfo': pageInfo}
 
 
-@database_sync_to_async
-def _get_latest_hist_table_entry():
-    """Returns the latest HistTable entry"""
-    try:
-        return HistTable.objects.using(STATIC_DATABASE).latest('created')
-    except HistTable.DoesNotExist:
-        return None
+@database_read_async
+def _compute_stats(ids, database_name):
+    """Computes the stats of histograms `ids` from their full data in the database
+
+    The in-memory data may be missing or downsampled, so it is reloaded in a single
+    query, or from the write-behind buffer for histograms with unsaved updates
+
+    returns: dict id -> stats
+    """
+    store = live_store_for(database_name)
+    buffer = get_write_behind()
+    if store:
+        full = []
+        for id in ids:
+            try:
+                full.append(store.get(id))
+            except Histogram.DoesNotExist:  # Deleted since it was resolved
+                pass
+    else:
+        pending = {id: buffer and buffer.pending(database_name, id) for id in ids}
+        full = [hist for hist in pending.values() if hist]
+        queryset = Histogram.objects.using(database_name).only('packed', 'dtype', 'xrange', 'created', 'dataVersion', 'len')
+        full += list(queryset.filter(id__in=[id for id in ids if not pending[id]]))
+    stats = {}
+    for hist in full:
+        x, y = hist.arrays()
+        stats[hist.id] = summary_stats(x, y, hist.xrange)
+        stats_cache.put(stats_key(hist), stats[hist.id])
+    return stats
 
 
 """
@@ -85,15 +320,91 @@ query = QueryType()
 
 
 @query.field("getHistogram")
-async def resolve_histogram(*_, id, isLive=False):
-    return await _get_histogram(id=id, database_name=chooseDatabase(isLive))
+async def resolve_histogram(_, info, id, isLive=False, maxPoints=None):
+    check_max_points(maxPoints)
+    fields = selected_fields(info)
+    histogram = await _get_histogram(id=id, database_name=chooseDatabase(isLive), maxPoints=maxPoints, fields=fields)
+    if 'data' in fields:
+        histogram.downsample(maxPoints)
+    return histogram
 
 
 @query.field("getHistograms")
-async def resolve_histograms(*_, ids=None, names=None, types=None, minDate=None, maxDate=None, isLive=False):
-    return await _filter_histograms(ids, names, types, minDate, maxDate, isLive)
+async def resolve_histograms(_, info, ids=None, names=None, types=None, minDate=None, maxDate=None, isLive=False, maxPoints=None):
+    check_max_points(maxPoints)
+    fields = selected_fields(info)
+    histograms = await _filter_histograms(ids, names, types, minDate, maxDate, isLive, maxPoints, fields)
+    if 'data' in fields:
+        for histogram in histograms:
+            histogram.downsample(maxPoints)
+    return histograms
+
+
+@query.field("getHistogramPage")
+async def resolve_histogram_page(_, info, first=DEFAULT_HISTOGRAM_FIRST, after=None, ids=None, names=None, types=None, minDate=None, maxDate=None, isLive=False, maxPoints=None):
+    check_max_points(maxPoints)
+    fields = selected_fields(info, 'edges', 'node')
+    page = await _paginate_histograms(first, after, ids, names, types, minDate, maxDate, isLive, maxPoints, fields)
+    if 'data' in fields:
+        for edge in page['edges']:
+            edge['node'].downsample(maxPoints)
+    return page
+
+
+@query.field("aggregateHistograms")
+async def resolve_aggregate_histograms(*_, selection, op, reference=None, maxPoints=None):
+    check_max_points(maxPoints)
+    return await _aggregate_histograms(selection, op, reference, maxPoints)
+
+
+@query.field("compareHistograms")
+async def resolve_compare_histograms(*_, referenceId, candidateIds, isLive=False):
+    return await _compare_histograms(referenceId, candidateIds, isLive)
 
 
 @query.field("getHistTableEntries")
 async def resolve_hist_table_entries(*_, first=DEFAULT_TABLE_FIRST, after=None, minDate=None, maxDate=None):
     return await _paginate_hist_table(first, after, minDate, maxDate)
+
+
+@query.field("getLastRun")
+async def resolve_last_run(*_):
+    return await latest_run.latest()
+
+
+hist_table_entry_type = ObjectType("HistTableEntry")
+
+
+@hist_table_entry_type.field("histograms")
+async def resolve_hist_table_entry_histograms(entry, info, maxPoints=None):
+    """Histograms of all entries of a page are loaded together, see `loader.BatchLoader`"""
+    check_max_points(maxPoints)
+    fields = selected_fields(info)
+    database_name = chooseDatabase(entry.isLive)
+
+    async def batch_load(ids):
+        return await _load_histograms(ids, database_name, maxPoints, fields)
+
+    loader = get_loader(info, ('histograms', database_name, maxPoints, frozenset(fields)), batch_load)
+    histograms = [hist for hist in await loader.load_many([int(id) for id in entry.histIDs]) if hist is not None]
+    if 'data' in fields:
+        for histogram in histograms:
+            histogram.downsample(maxPoints)
+    return histograms
+
+
+histogram_type = ObjectType("Histogram")
+
+
+@histogram_type.field("stats")
+async def resolve_histogram_stats(histogram, info):
+    """Cache misses of all histograms of a response are computed together, see `loader.BatchLoader`"""
+    stats = stats_cache.get(stats_key(histogram))
+    if stats is None:
+        database_name = histogram._state.db
+
+        async def batch_load(ids):
+            return await _compute_stats(ids, database_name)
+
+        stats = await get_loader(info, ('stats', database_name), batch_load).load(histogram.id)
+    return stats
@@ -0,0 +1,71 @@
+"""
+In-memory tracker of the latest run in the HistTable
+
+Mutations report the runs they create or delete, so reading the latest run
+does not query the database. The tracker only spans a single server process,
+so it is refreshed from the database every LATEST_RUN_MAX_AGE seconds
+"""
+
+import threading
+import time
+
+from channels.db import database_sync_to_async
+
+from .models import HistTable
+from .common import STATIC_DATABASE, LATEST_RUN_MAX_AGE
+
+
+@database_sync_to_async
+def _get_latest_hist_table_entry():
+    """Returns the latest HistTable entry"""
+    try:
+        return HistTable.objects.using(STATIC_DATABASE).latest('created')
+    except HistTable.DoesNotExist:
+        return None
+
+
+class LatestRunTracker:
+    '''Name and creation date of the most recently created HistTable entry'''
+
+    def __init__(self, max_age=LATEST_RUN_MAX_AGE):
+        self.max_age = max_age
+        self._name = None
+        self._created = None
+        self._seededAt = None  # time.monotonic() of the last read from the database
+        self._observedAt = None  # time.monotonic() of the last observed run
+        self._lock = threading.Lock()
+
+    def _is_fresh(self):
+        return self._seededAt is not None and time.monotonic() - self._seededAt < self.max_age
+
+    def observe(self, name, created):
+        '''Called after a HistTable entry is created or updated'''
+        with self._lock:
+            if self._created is None or created >= self._created:
+                self._name, self._created, self._observedAt = name, created, time.monotonic()
+
+    def invalidate(self):
+        '''Called after a HistTable entry is deleted, as the previous run is not known'''
+        with self._lock:
+            self._name, self._created, self._seededAt, self._observedAt = None, None, None, None
+
+    def _seed(self, entry, seededAt):
+        with self._lock:
+            # The database is authoritative, except for a newer run observed while it was read
+            observedDuringRead = self._observedAt is not None and self._observedAt >= seededAt
+            if not observedDuringRead or (entry is not None and entry.created > self._created):
+                self._name, self._created = (entry.name, entry.created) if entry else (None, None)
+            self._seededAt = seededAt
+            return self._name
+
+    async def latest(self):
+        '''Returns the name of the latest run, reading the database only if the tracker is stale'''
+        with self._lock:
+            if self._is_fresh():
+                return self._name
+        seededAt = time.monotonic()
+        entry = await _get_latest_hist_table_entry()
+        return self._seed(entry, seededAt)
+
+
+latest_run = LatestRunTracker()
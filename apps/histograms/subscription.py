@@ -1,4 +1,6 @@
 from ariadne import SubscriptionType
+from django.conf import settings
+from django.db.models import Count, Max, Sum
 
 import asyncio
 
@@ -7,28 +9,176 @@ subscription = SubscriptionType()
 """ Asynchronous generator
 """
 
-SUB_SLEEP_TIME = 1  # [seconds] to wait in between subscription calls
+SUB_SLEEP_TIME = 1  # [seconds] minimum time in between subscription frames
 
-from .query import _filter_histograms, _get_latest_hist_table_entry
+# [seconds] max time a subscription waits for a change notification before
+# rebuilding the snapshot anyway, to pick up changes no marker detects
+SUB_MAX_IDLE_TIME = 30
 
+# Fields of a live histogram that are sent again whenever one of them changes
+LIVE_METADATA_FIELDS = ['name', 'type', 'xrange', 'yrange', 'created']
 
-@subscription.source("getLiveHistograms")
-async def source_live_histograms(obj, info):
-    while True:
-        await asyncio.sleep(SUB_SLEEP_TIME)
-        histograms = await _filter_histograms(ids=None, names=None, types=None, minDate=None, maxDate=None, isLive=True)
-        lastRun = await _get_latest_hist_table_entry()
-        if lastRun:
-            runName = lastRun.name
+from .query import _filter_histograms
+from .runs import latest_run
+from .hub import histogram_hub
+from .broadcast import SnapshotBroadcaster
+from .analysis import histogram_stats
+from .livestore import get_live_store
+from .models import Histogram
+from .common import encode_packed_values, LIVE_DATABASE
+from LANE_server.db import database_read_async
+
+
+@database_read_async
+def _live_db_marker():
+    '''Cheap summary of the live histograms in the database that changes with every
+    create, delete, append and overwrite of points, whichever process made it
+
+    Metadata-only updates made by other processes are not detected, those
+    are picked up after SUB_MAX_IDLE_TIME
+    '''
+    return Histogram.objects.using(LIVE_DATABASE).aggregate(Count('id'), Max('id'), Sum('len'), Sum('dataVersion'))
+
+
+async def _wait_for_change(listener):
+    '''Rate limits frames to one per SUB_SLEEP_TIME, then sleeps until a live histogram changes
+
+    The hub only spans this server process, so every SUB_SLEEP_TIME this also
+    checks for changes made by other processes: through the generation of the
+    live store, or a marker of the live database without it (see `_live_db_marker`).
+    Events of static histograms are ignored
+    '''
+    store = get_live_store(create=False)
+    marker = store.generation if store else await _live_db_marker()
+    await asyncio.sleep(SUB_SLEEP_TIME)
+    for _ in range(int(SUB_MAX_IDLE_TIME / SUB_SLEEP_TIME)):
+        if (store.generation if store else await _live_db_marker()) != marker:
+            return
+        if any(event['isLive'] for event in await listener.wait(timeout=SUB_SLEEP_TIME)):
+            return
+
+
+async def _build_live_snapshot():
+    '''Queries and decodes the live histograms once for all subscribers
+
+    Histograms are returned as dicts with the LiveHistogram fields,
+    plus `dataVersion` and the (`x`, `y`) numpy arrays. Stats are
+    only recomputed for histograms that changed
+
+    Note that graphql still resolves the selected fields of the snapshot
+    for each subscriber, which costs one `Point` per data point when `data`
+    is selected. `packedX` and `packedY` are serialized here, once for all
+    '''
+    histograms = await _filter_histograms(ids=None, names=None, types=None, minDate=None, maxDate=None, isLive=True)
+    runName = await latest_run.latest()
+
+    snapshot = []
+    for hist in histograms:
+        x, y = hist.arrays()
+        entry = {field: getattr(hist, field) for field in LIVE_METADATA_FIELDS}
+        entry.update({'id': hist.id, 'len': hist.len, 'dataVersion': hist.dataVersion, 'x': x, 'y': y, 'stats': histogram_stats(hist)})
+        entry['packedX'] = encode_packed_values(x)
+        entry['packedY'] = encode_packed_values(y)
+        if x is None:
+            entry['data'] = None
+            entry['current'] = None
         else:
-            runName = None
-        if histograms:
-            for i, hist in enumerate(histograms):
-                if hist.data:
-                    hist.current = hist.data[-1]
-            yield {"histograms": histograms, "lastRun": runName}
+            entry['data'] = [{'x': xi, 'y': yi} for (xi, yi) in zip(x.tolist(), y.tolist())]
+            entry['current'] = entry['data'][-1] if entry['data'] else None
+        snapshot.append(entry)
+    return {"histograms": snapshot, "lastRun": runName}
+
+
+live_broadcaster = SnapshotBroadcaster(_build_live_snapshot, _wait_for_change, histogram_hub)
+
+
+def _min_frame_interval(maxFrameRate):
+    '''Seconds between two frames sent to a client asking for at most `maxFrameRate` frames per second
+
+    Clients can lower, but not raise, the rate of settings.SUBSCRIPTION_MAX_FRAME_RATE
+    '''
+    if maxFrameRate is not None and maxFrameRate <= 0:
+        raise ValueError('`maxFrameRate` must be positive')
+    rates = [rate for rate in (maxFrameRate, settings.SUBSCRIPTION_MAX_FRAME_RATE) if rate]
+    return 1 / min(rates) if rates else 0
+
+
+@subscription.source("getLiveHistograms")
+async def source_live_histograms(obj, info, maxFrameRate=None):
+    minInterval = _min_frame_interval(maxFrameRate)
+    with live_broadcaster.subscribe() as mailbox:
+        async for snapshot in mailbox.frames(minInterval):
+            if snapshot['histograms']:
+                yield {"histograms": snapshot['histograms'], "lastRun": snapshot['lastRun'], "droppedFrames": mailbox.dropped}
+            else:
+                yield {"histograms": None, "lastRun": snapshot['lastRun'], "droppedFrames": mailbox.dropped}
+
+
+def _diff_live_histograms(histograms, seen):
+    '''Compares the histograms of a live snapshot against the state last sent to a subscriber
+
+    `seen` maps histogram id -> (dataVersion, len, metadata) and is updated in place
+
+    returns: (changed, createdIds, deletedIds) where `changed` is a list of LiveHistogramDelta dicts
+    '''
+    changed = []
+    createdIds = []
+    current_ids = set()
+    for hist in histograms:
+        current_ids.add(hist['id'])
+        metadata = tuple(hist[field] for field in LIVE_METADATA_FIELDS)
+        length = hist['len'] or 0
+        previous = seen.get(hist['id'])
+        if previous is None:
+            createdIds.append(hist['id'])
+        elif previous == (hist['dataVersion'], length, metadata):
+            continue
+
+        # Only send the tail of the data if the client already holds the rest of it
+        isFull = previous is None or previous[0] != hist['dataVersion'] or previous[1] > length
+        if isFull or hist['x'] is None:
+            points, packedX, packedY = hist['data'], hist['packedX'], hist['packedY']
         else:
-            yield {"histograms": None, "lastRun": runName}
+            start = previous[1]
+            points = [{'x': xi, 'y': yi} for (xi, yi) in zip(hist['x'][start:].tolist(), hist['y'][start:].tolist())]
+            packedX, packedY = encode_packed_values(hist['x'][start:]), encode_packed_values(hist['y'][start:])
+
+        delta = {field: value for (field, value) in zip(LIVE_METADATA_FIELDS, metadata)}
+        delta.update({'id': hist['id'], 'len': hist['len'], 'points': points, 'packedX': packedX, 'packedY': packedY, 'isFull': isFull, 'current': hist['current'], 'stats': hist['stats']})
+        changed.append(delta)
+        seen[hist['id']] = (hist['dataVersion'], length, metadata)
+
+    deletedIds = [id for id in seen if id not in current_ids]
+    for id in deletedIds:
+        del seen[id]
+    return changed, createdIds, deletedIds
+
+
+@subscription.source("getLiveHistogramDeltas")
+async def source_live_histogram_deltas(obj, info, maxFrameRate=None):
+    '''The first frame is a full snapshot. Afterwards, frames only carry what changed
+    and are only sent when something did. Clients resync by restarting the subscription
+
+    Dropped snapshots are folded into the next frame, as it is diffed against what was last sent
+    '''
+    minInterval = _min_frame_interval(maxFrameRate)
+    seen = {}
+    lastRunSent = None
+    isSnapshot = True
+    with live_broadcaster.subscribe() as mailbox:
+        async for snapshot in mailbox.frames(minInterval):
+            changed, createdIds, deletedIds = _diff_live_histograms(snapshot['histograms'], seen)
+            if isSnapshot or changed or deletedIds or snapshot['lastRun'] != lastRunSent:
+                yield {
+                    "isSnapshot": isSnapshot,
+                    "changed": changed,
+                    "createdIds": createdIds,
+                    "deletedIds": deletedIds,
+                    "lastRun": snapshot['lastRun'],
+                    "droppedFrames": mailbox.dropped,
+                }
+                isSnapshot = False
+                lastRunSent = snapshot['lastRun']
 
 
 """
@@ -37,5 +187,10 @@ Subscription
 
 
 @subscription.field("getLiveHistograms")
-def resolve_live_histograms(histograms, info):
+def resolve_live_histograms(histograms, info, maxFrameRate=None):
     return histograms
+
+
+@subscription.field("getLiveHistogramDeltas")
+def resolve_live_histogram_deltas(deltas, info, maxFrameRate=None):
+    return deltas
@@ -0,0 +1,137 @@
+"""
+Write-behind buffer for histogram updates
+
+When enabled in settings.WRITE_BEHIND, `updateHistogram` applies updates to an
+in-memory copy of the histogram and returns immediately. Repeated updates to the
+same histogram are merged into that copy, and all pending copies are saved
+together in a single transaction per database
+- at most WINDOW seconds after the first pending update (durability bound)
+- as soon as MAX_PENDING histograms have pending updates
+- before any other mutation of a histogram with pending updates
+- when the process exits
+
+Subscriptions are notified once the updates are saved. Queries for single
+histograms or filtered lists return the pending copies, other queries (e.g.
+pagination and exports) see the saved state
+"""
+
+import atexit
+import copy
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+
+from .models import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+# Called with a list of (database_name, id, updatedFields) after pending updates are saved
+flush_listeners = []
+
+
+class WriteBehindBuffer:
+    def __init__(self, window, maxPending):
+        self.window = window
+        self.maxPending = maxPending
+        self._pending = {}  # (database_name, id) -> (histogram, set of updated fields)
+        self._lock = threading.RLock()  # Held while saving, so no update reads a stale row
+        self._timer = None
+
+    def update(self, database_name, id, apply):
+        '''Calls `apply(histogram)`, which returns the names of the fields it changed, on the pending copy of histogram `id`
+
+        returns: a copy of the updated histogram
+        '''
+        key = (database_name, int(id))
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = (Histogram.objects.using(database_name).get(id=id), set())
+            histogram, updatedFields = self._pending[key]
+            updatedFields.update(apply(histogram))
+            updated = copy.copy(histogram)
+
+            if len(self._pending) >= self.maxPending:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+        return updated
+
+    def pending(self, database_name, id):
+        '''Returns a copy of the pending histogram `id`, or None'''
+        with self._lock:
+            entry = self._pending.get((database_name, int(id)))
+            return copy.copy(entry[0]) if entry else None
+
+    def overlay(self, database_name, histograms):
+        '''Replaces the histograms that have pending updates by their pending copy'''
+        with self._lock:
+            if not self._pending:
+                return histograms
+            return [self.pending(database_name, hist.id) or hist for hist in histograms]
+
+    def discard(self, database_name, id):
+        '''Drops the pending updates of a histogram that is being deleted'''
+        with self._lock:
+            self._pending.pop((database_name, int(id)), None)
+
+    def flush(self, database_name=None, id=None):
+        '''Saves the pending updates of histogram `id`, or of all histograms if not given'''
+        with self._lock:
+            keys = list(self._pending) if id is None else [(database_name, int(id))]
+            keys = [key for key in keys if key in self._pending]
+            if not keys:
+                return
+            batches = {}
+            for key in keys:
+                batches.setdefault(key[0], []).append(self._pending.pop(key))
+            if not self._pending and self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            flushed = []
+            for database_name, batch in batches.items():
+                with transaction.atomic(using=database_name):
+                    for histogram, updatedFields in batch:
+                        try:
+                            with transaction.atomic(using=database_name):
+                                histogram.save(using=database_name, update_fields=updatedFields)
+                        except DatabaseError:  # e.g. deleted by another process meanwhile
+                            logger.exception(f'Failed to save the pending updates of hist {histogram.id}')
+                            continue
+                        flushed.append((database_name, histogram.id, updatedFields))
+        if flushed:
+            for listener in flush_listeners:
+                listener(flushed)
+
+    def _flush_in_background(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Failed to save pending histogram updates')
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_behind():
+    '''Returns the WriteBehindBuffer of this process, or None if it is disabled in settings'''
+    global _buffer
+    if not settings.WRITE_BEHIND['ENABLED']:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            config = settings.WRITE_BEHIND
+            _buffer = WriteBehindBuffer(config['WINDOW'], config['MAX_PENDING'])
+            atexit.register(_buffer.flush)
+        return _buffer
@@ -1,6 +1,6 @@
 from ariadne import QueryType
 from .models import RunConfig, RunConfigStep, Device
-from channels.db import database_sync_to_async
+from LANE_server.db import database_read_async
 
 from .common import DATABASE, MAX_RUN_CONFIGS
 
@@ -10,19 +10,19 @@ so we must evaluate the query set before returning
 """
 
 
-@database_sync_to_async
+@database_read_async
 def _get_run_config(id):
     run_config = RunConfig.objects.using(DATABASE).get(pk=id)
     run_config.steps = list(run_config.runconfigstep_set.all())
     return run_config
 
 
-@database_sync_to_async
+@database_read_async
 def _get_step(id):
     return RunConfigStep.objects.using(DATABASE).get(pk=id)
 
 
-@database_sync_to_async
+@database_read_async
 def _filter_runs(names=None, minLoadDate=None, maxLoadDate=None):
     queryset = RunConfig.objects.using(DATABASE).all()
     if names:
@@ -36,7 +36,7 @@ def _filter_runs(names=None, minLoadDate=None, maxLoadDate=None):
     return list(queryset)
 
 
-@database_sync_to_async
+@database_read_async
 def _get_device(name):
     try:
         return Device.objects.using(DATABASE).get(name=name)
@@ -44,7 +44,7 @@ def _get_device(name):
         raise Exception(f'Error for device name "{name}"\n{e}')
 
 
-@database_sync_to_async
+@database_read_async
 def _filter_devices(names, isOnline):
     queryset = Device.objects.using(DATABASE).all()
     if names:
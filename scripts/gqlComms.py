@@ -69,6 +69,17 @@ def createHistogram(id, xrange=None, yrange=None, data=None, name=None, type=Non
     return send_request(query=CREATE_HIST, variables={"hist": locals()})
 
 
+def createHistograms(hists):
+    '''
+    Creates a batch of histograms in the database in a single request
+
+    `hists` is a list of dicts with the arguments of `createHistogram`
+
+    returns: response json
+    '''
+    return send_request(query=CREATE_HISTS, variables={"hists": hists})
+
+
 def getHistogram(id, isLive=False):
     '''
     Get the information from a histogram in the database
@@ -96,6 +107,15 @@ def updateHistogram(id, data=None, type=None, xrange=None, yrange=None, isLive=F
     return send_request(query=UPDATE_HIST, variables={"hist": locals()})
 
 
+def appendHistogramPoints(id, points, isLive=False, widenRanges=False):
+    '''
+    Appends points to the end of a histogram in the database
+
+    returns: response json
+    '''
+    return send_request(query=APPEND_HIST, variables=locals())
+
+
 def deleteHistogram(id, isLive=False):
     '''
     deletes a histogram from the database
@@ -264,6 +284,15 @@ mutation create($hist: HistogramInput!){
     }
 }"""
 
+CREATE_HISTS = """
+mutation createMany($hists: [HistogramInput!]!){
+    createHistograms(hists: $hists)
+    {
+        message
+        success
+    }
+}"""
+
 DELETE_HIST = """
 mutation delete($id: ID!, $isLive: Boolean){
     deleteHistogram(id: $id, isLive: $isLive)
@@ -282,6 +311,15 @@ mutation update($hist: HistogramUpdateInput!){
     }
 }"""
 
+APPEND_HIST = """
+mutation append($id: ID!, $points: [PointInput!]!, $isLive: Boolean, $widenRanges: Boolean){
+    appendHistogramPoints(id: $id, points: $points, isLive: $isLive, widenRanges: $widenRanges)
+    {
+        message
+        success
+    }
+}"""
+
 CREATE_DEVICE = """mutation createDevice($device: DeviceInput!){
 	createDevice(device: $device)
 	{
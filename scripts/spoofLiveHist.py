@@ -18,6 +18,7 @@ from gqlComms import (
     createHistogram,
     deleteHistogram,
     updateHistogram,
+    appendHistogramPoints,
     getHistTable,
 )
 import numpy as np
@@ -60,7 +61,6 @@ def main():
     rng = np.random.default_rng()
     histsToMake = np.arange(hist_offset, hist_offset + args.numAlive).tolist()
     run_id = run_offset
-    initial_data = {id: [] for id in histsToMake}
     xlimit = {id: 10 for id in histsToMake}
 
     for cycle in range(args.nCycles):
@@ -79,22 +79,19 @@ def main():
             createHistogram(**params)
 
         print('Live updating histograms')
-        data = initial_data
         for t in range(args.liveTime):
             for id in histsToMake:
-                data[id].append({'x': t, 'y': int(rng.integers(low=args.low, high=args.high))})
-                params = {
-                    'id': id,
-                    'data': data[id],
-                    'isLive': True,
-                }
+                # Only the new point is sent, the server appends it to the stored data
+                appendHistogramPoints(
+                    id=id,
+                    points=[{'x': t, 'y': int(rng.integers(low=args.low, high=args.high))}],
+                    isLive=True,
+                )
 
                 # Expand x axis range by 10 every time x axis limit is exceeded
                 if t > xlimit[id]:
                     xlimit[id] += 10
-                    params['xrange'] = {'min': 0, 'max': xlimit[id]}
-
-                updateHistogram(**params)
+                    updateHistogram(id=id, xrange={'min': 0, 'max': xlimit[id]}, isLive=True)
             time.sleep(1)
 
         print('LiveTime complete. Pausing')
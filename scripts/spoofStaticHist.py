@@ -10,7 +10,7 @@ For testing options run `python spoofStaticHist.py --help`
 If database is not empty, appends new histograms
 """
 
-from gqlComms import createHistogram, getHistTable, toSvgCoords
+from gqlComms import createHistograms, getHistTable, toSvgCoords
 import numpy as np
 import argparse
 
@@ -50,10 +50,11 @@ def main():
         else:
             run_offset = 0
 
-    # Create histograms
+    # Create histograms, one request per run
     print('Creating histograms')
     hist_id = int(hist_offset)
     for run_id in np.arange(run_offset, run_offset + args.num):
+        hists = []
         for type_id in np.arange(args.per):
             y = rng.integers(low=args.low, high=args.high, size=args.length).tolist()
             params = {
@@ -65,8 +66,9 @@ def main():
                 'type': f'detector_type_{type_id}',
                 'isLive': False,
             }
-            createHistogram(**params)
+            hists.append(params)
             hist_id += 1
+        createHistograms(hists)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,8 @@
 Queries, Mutations, Subscriptions and additional functions used for unit tests
 """
 
+import asyncio
+
 ### Common Functions ###
 
 
@@ -15,6 +17,18 @@ def toSvgCoords(xList, yList):
     return [{'x': x, 'y': y} for (x, y) in zip(xList, yList)]
 
 
+def run_async(coroutine):
+    '''
+    Runs `coroutine` to completion on a new event loop and returns its result.
+    Same as asyncio.run, which needs python 3.7
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
 ### Queries ###
 
 GET_HIST_TABLE = """
@@ -36,6 +50,33 @@ query getHistTable($first: Int!, $after: String) {
     }
 }"""
 
+GET_HIST_TABLE_HISTOGRAMS = """
+query getHistTableHistograms($first: Int!, $maxPoints: Int) {
+    getHistTableEntries(first: $first)
+    {
+        edges{
+            node{
+                name
+                histIDs
+                histograms(maxPoints: $maxPoints){
+                    id
+                    name
+                    len
+                    data{
+                        x
+                        y
+                    }
+                }
+            }
+        }
+    }
+}"""
+
+GET_LAST_RUN = """
+query getLastRun {
+    getLastRun
+}"""
+
 GET_HIST_IDS = """
 query getIDs($ids: [ID], 
         $names: [String],
@@ -83,6 +124,20 @@ query getHistogram($id: ID!, $isLive: Boolean)
         }
 }"""
 
+GET_DOWNSAMPLED_HISTOGRAM = """
+query getHistogram($id: ID!, $isLive: Boolean, $maxPoints: Int)
+{
+    getHistogram(id: $id, isLive: $isLive, maxPoints: $maxPoints)
+        {
+            id
+            data{
+                x
+                y
+            }
+            len
+        }
+}"""
+
 GET_HISTOGRAMS = """
 query getIDs($ids: [ID], 
         $names: [String],
@@ -121,6 +176,26 @@ getHistograms(
     }
 }"""
 
+GET_HISTOGRAM_PAGE = """
+query getHistogramPage($first: Int, $after: String, $ids: [ID], $isLive: Boolean)
+{
+    getHistogramPage(first: $first, after: $after, ids: $ids, isLive: $isLive)
+    {
+        edges{
+            cursor
+            node{
+                id
+                len
+                created
+            }
+        }
+        pageInfo{
+            endCursor
+            hasNextPage
+        }
+    }
+}"""
+
 GET_DEVICE = """
 query getDevice ($name: String!) {
     getDevice(name: $name){
@@ -217,6 +292,18 @@ mutation create($hist: HistogramInput!){
     }
 }"""
 
+CREATE_HISTS = """
+mutation createMany($hists: [HistogramInput!]!){
+    createHistograms(hists: $hists)
+    {
+        message
+        success
+        modifiedHistograms{
+            id
+        }
+    }
+}"""
+
 DELETE_HIST = """
 mutation delete($id: ID!, $isLive: Boolean){
     deleteHistogram(id: $id, isLive: $isLive)
@@ -235,6 +322,92 @@ mutation update($hist: HistogramUpdateInput!){
     }
 }"""
 
+APPEND_HIST = """
+mutation append($id: ID!, $points: [PointInput!]!, $isLive: Boolean, $widenRanges: Boolean){
+    appendHistogramPoints(id: $id, points: $points, isLive: $isLive, widenRanges: $widenRanges)
+    {
+        message
+        success
+    }
+}"""
+
+FILL_HIST = """
+mutation fill($id: ID!, $values: [Float!]!, $weights: [Float!], $isLive: Boolean){
+    fillHistogram(id: $id, values: $values, weights: $weights, isLive: $isLive)
+    {
+        message
+        success
+    }
+}"""
+
+FILL_HIST_PACKED = """
+mutation fillPacked($id: ID!, $values: String!, $weights: String, $isLive: Boolean){
+    fillHistogramPacked(id: $id, values: $values, weights: $weights, isLive: $isLive)
+    {
+        message
+        success
+    }
+}"""
+
+GET_HISTOGRAM_STATS = """
+query getHistogramStats($id: ID!, $isLive: Boolean, $maxPoints: Int)
+{
+    getHistogram(id: $id, isLive: $isLive, maxPoints: $maxPoints)
+    {
+        len
+        stats{
+            integral
+            mean
+            rms
+            peak
+            fwhm
+            underflow
+            overflow
+        }
+    }
+}"""
+
+GET_HISTOGRAMS_STATS = """
+query getHistogramsStats($ids: [ID!]!)
+{
+    getHistograms(ids: $ids)
+    {
+        id
+        stats{
+            integral
+        }
+    }
+}"""
+
+COMPARE_HISTS = """
+query compareHistograms($referenceId: ID!, $candidateIds: [ID!]!)
+{
+    compareHistograms(referenceId: $referenceId, candidateIds: $candidateIds)
+    {
+        id
+        chi2
+        ndf
+        ks
+        maxResidual
+    }
+}"""
+
+AGGREGATE_HISTS = """
+query aggregateHistograms($selection: HistogramSelection!, $op: AggregateOp!, $reference: HistogramSelection)
+{
+    aggregateHistograms(selection: $selection, op: $op, reference: $reference)
+    {
+        op
+        sourceIds
+        referenceIds
+        data{
+            x
+            y
+        }
+        len
+    }
+}"""
+
 CREATE_DEVICE = """mutation createDevice($device: DeviceInput!){
 	createDevice(device: $device)
 	{
@@ -368,7 +541,44 @@ subscription histSub {
             x
             y
         }
+        packedX
+        packedY
         }
         lastRun  
     }
 }"""
+
+PACED_LIVE_HIST_SUBSCRIPTION = """
+subscription pacedHistSub($maxFrameRate: Float) {
+    getLiveHistograms(maxFrameRate: $maxFrameRate) {
+        lastRun
+        droppedFrames
+    }
+}"""
+
+LIVE_HIST_DELTA_SUBSCRIPTION = """
+subscription histDeltaSub {
+    getLiveHistogramDeltas {
+        isSnapshot
+        changed{
+            id
+            name
+            type
+            len
+            isFull
+            points {
+                x
+                y
+            }
+            packedX
+            packedY
+            current {
+                x
+                y
+            }
+        }
+        createdIds
+        deletedIds
+        lastRun
+    }
+}"""
@@ -0,0 +1,235 @@
+"""
+Test the shared memory store of live histograms
+"""
+
+from LANE_server.asgi import application
+from starlette.testclient import TestClient
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connections
+from apps.histograms import livestore
+from apps.histograms.livestore import LiveStore
+from apps.histograms.models import Histogram
+from apps.histograms.common import LIVE_DATABASE
+import numpy as np
+import os
+import pytest
+import sys
+import tempfile
+import uuid
+
+from test.common import (
+    CREATE_HIST,
+    APPEND_HIST,
+    GET_HISTOGRAM,
+    DELETE_HIST,
+    toSvgCoords,
+)
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 8), reason='The live store requires python 3.8')
+
+
+@pytest.fixture
+def live_db(tmp_path, monkeypatch):
+    """
+    Points the live db to a new, empty database for the duration of a test
+    """
+    connections[LIVE_DATABASE].close()
+    monkeypatch.setitem(connections[LIVE_DATABASE].settings_dict, 'NAME', tmp_path / 'liveData.sqlite3')
+    call_command('migrate', database=LIVE_DATABASE, verbosity=0)
+    yield
+    connections[LIVE_DATABASE].close()
+
+
+@pytest.fixture
+def store_name():
+    """
+    Name of a shared memory segment, removed along with its lock files after the test
+    """
+    name = f'lane_test_{uuid.uuid4().hex[:8]}'
+    yield name
+    from multiprocessing import shared_memory
+
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        pass
+    else:
+        segment.close()
+        segment.unlink()
+    for suffix in ('lock', 'snapshot.lock'):
+        path = os.path.join(tempfile.gettempdir(), f'{name}.{suffix}')
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def segment_exists(name):
+    """
+    Not a test
+    """
+    from multiprocessing import shared_memory
+
+    try:
+        shared_memory.SharedMemory(name=name).close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class TestLiveStore:
+    """
+    Tests in this suite:
+
+    Write histograms through one attachment of the store, read them through another
+
+    Check the limits on the number of histograms and points, and recover slots left half written by a killed writer
+
+    Copy the store to the live db, and recover it from the live db
+
+    Refuse to create a store that the live db does not fit in
+
+    Serve live mutations and queries from the store, without writing to the live db
+    """
+
+    SLOTS = 4
+    POINTS = 100
+
+    def make_histogram(self, id, length=10):
+        """
+        Not a test
+        """
+        x = np.arange(length)
+        return Histogram(
+            id=id,
+            name='unit_test_name',
+            type=f'unit_test_type{id}',
+            data=toSvgCoords(x.tolist(), (x**2).tolist()),
+            xrange={'min': 0, 'max': length - 1},
+            yrange={'min': 0, 'max': (length - 1) ** 2},
+        )
+
+    def post_to_test_client(self, client, query, variables):
+        """
+        Not a test
+        """
+        response = client.post("/graphql/", json={"query": query, "variables": variables})
+        assert response.status_code == 200
+        return response.json()
+
+    def test_shared_between_attachments(self, live_db, store_name, monkeypatch):
+        """
+        Write through one LiveStore and read through another attached to the same segment, then recover a half written slot
+        """
+        writer = LiveStore(store_name, self.SLOTS, self.POINTS)
+        reader = LiveStore(store_name, self.SLOTS, self.POINTS)
+        generation = reader.generation
+
+        writer.insert([self.make_histogram(1), self.make_histogram(2)])
+        assert reader.generation != generation
+        assert [hist.id for hist in reader.filter()] == [1, 2]
+        assert reader.get(1).data == self.make_histogram(1).data and reader.get(1).xrange == {'min': 0, 'max': 9}
+
+        with writer.modify(2) as hist:
+            hist.append([{'x': 10, 'y': -1}])
+        assert reader.get(2).len == 11 and reader.get(2).data[-1] == {'x': 10, 'y': -1}
+        assert [hist.id for hist in reader.filter(types=['unit_test_type2'])] == [2]
+
+        with pytest.raises(ValueError):
+            writer.insert([self.make_histogram(1)])  # Already exists
+        with pytest.raises(ValueError):
+            writer.insert([self.make_histogram(id) for id in range(3, 3 + self.SLOTS)])  # Too many histograms
+        with pytest.raises(ValueError):
+            writer.insert([self.make_histogram(3, length=self.POINTS + 1)])  # Too many points
+        assert reader.exists([1, 2, 3]) == [1, 2]
+
+        assert writer.delete(1) and not writer.delete(1)
+        with pytest.raises(Histogram.DoesNotExist):
+            reader.get(1)
+
+        # A writer killed in the middle of a write leaves the slot's sequence number odd
+        monkeypatch.setattr(livestore, 'READ_TIMEOUT', 0.05)
+        index = writer._find(2)
+        writer._slots['seq'][index] += 1
+        with pytest.raises(TimeoutError):
+            reader._read(index)
+        assert reader.get(2).len == 11 and writer._slots['seq'][index] % 2 == 0
+        writer._slots['seq'][index] += 1
+        with writer.modify(2) as hist:
+            hist.append([{'x': 11, 'y': 0}])
+        assert reader.get(2).len == 12
+        reader.close()
+        writer.close()
+
+    def test_snapshot_and_recovery(self, live_db, store_name):
+        """
+        Copy the store to the live db, then rebuild a new segment from the live db
+        """
+        store = LiveStore(store_name, self.SLOTS, self.POINTS)
+        store.insert([self.make_histogram(1), self.make_histogram(2)])
+        store.delete(1)
+        assert store.snapshot_to_database()
+        assert not store.snapshot_to_database()  # Nothing changed
+        assert list(Histogram.objects.using(LIVE_DATABASE).values_list('id', flat=True)) == [2]
+        expected = store.get(2)
+        store.unlink()
+        store.close()
+
+        recovered = LiveStore(store_name, self.SLOTS, self.POINTS)
+        hist = recovered.get(2)
+        assert (hist.data, hist.len, hist.created, hist.xrange) == (expected.data, expected.len, expected.created, expected.xrange)
+
+        # Rows that are not in the store are only deleted if they were deleted through it
+        self.make_histogram(5).save(using=LIVE_DATABASE)
+        recovered.delete(2)
+        assert recovered.snapshot_to_database()
+        assert list(Histogram.objects.using(LIVE_DATABASE).values_list('id', flat=True)) == [5]
+
+        # Slots of deleted histograms are reused last, deleting them from the live db first
+        recovered.insert([self.make_histogram(id) for id in range(10, 10 + self.SLOTS - 1)])
+        recovered.delete(10)
+        recovered.insert([self.make_histogram(20)])
+        assert list(Histogram.objects.using(LIVE_DATABASE).values_list('id', flat=True)) == [5]
+        assert recovered.snapshot_to_database()
+        assert list(Histogram.objects.using(LIVE_DATABASE).order_by('id').values_list('id', flat=True)) == [5, 11, 12, 20]
+        recovered.unlink()
+        recovered.close()
+
+    def test_refuse_oversized_database(self, live_db, store_name):
+        """
+        Creating a store fails, without creating the segment, if the live db holds too many histograms or points
+        """
+        self.make_histogram(1, length=self.POINTS + 1).save(using=LIVE_DATABASE)
+        with pytest.raises(ImproperlyConfigured):
+            LiveStore(store_name, self.SLOTS, self.POINTS)
+        assert not segment_exists(store_name)
+
+        Histogram.objects.using(LIVE_DATABASE).all().delete()
+        for id in range(self.SLOTS + 1):
+            self.make_histogram(id).save(using=LIVE_DATABASE)
+        with pytest.raises(ImproperlyConfigured):
+            LiveStore(store_name, self.SLOTS, self.POINTS)
+        assert not segment_exists(store_name)
+
+    def test_live_mutations_use_store(self, live_db, store_name, monkeypatch):
+        """
+        Create, append to, query and delete a live histogram with the store enabled
+        """
+        store = LiveStore(store_name, self.SLOTS, self.POINTS)
+        monkeypatch.setitem(settings.LIVE_STORE, 'ENABLED', True)
+        monkeypatch.setattr(livestore, '_store', store)
+        client = TestClient(application)
+
+        hist = {'id': 7, 'name': 'unit_test_name', 'type': 'unit_test_type7', 'data': toSvgCoords([0, 1], [5, 6]), 'xrange': {'min': 0, 'max': 1}, 'yrange': {'min': 0, 'max': 6}, 'isLive': True}
+        assert self.post_to_test_client(client, CREATE_HIST, {"hist": hist})['data']['createHistogram']['success']
+        response = self.post_to_test_client(client, APPEND_HIST, {"id": 7, "points": [{'x': 2, 'y': 7}], "isLive": True})
+        assert response['data']['appendHistogramPoints']['success']
+
+        response = self.post_to_test_client(client, GET_HISTOGRAM, {"id": 7, "isLive": True})
+        assert response['data']['getHistogram']['data'] == toSvgCoords([0, 1, 2], [5, 6, 7]) and response['data']['getHistogram']['len'] == 3
+        assert store.get(7).len == 3 and not Histogram.objects.using(LIVE_DATABASE).filter(id=7).exists()
+
+        assert self.post_to_test_client(client, DELETE_HIST, {"id": 7, "isLive": True})['data']['deleteHistogram']['success']
+        assert store.exists([7]) == []
+        store.unlink()
+        store.close()
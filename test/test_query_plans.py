@@ -0,0 +1,89 @@
+"""
+Check that histogram and run queries are answered from indexes
+rather than by scanning whole tables
+"""
+
+from LANE_server.asgi import application  # Sets up django
+from datetime import datetime, timezone
+import re
+from apps.histograms.models import Histogram, HistTable
+from apps.histograms.query import _apply_histogram_filters
+from apps.histograms.common import STATIC_DATABASE
+
+MIN_DATE = datetime(2022, 1, 1, tzinfo=timezone.utc)
+MAX_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+# (ids, names, types, minDate, maxDate) as passed to getHistograms and getHistogramPage
+HISTOGRAM_FILTERS = [
+    (None, None, None, None, None),
+    (None, ['run1'], None, None, None),
+    (None, None, ['type1'], None, None),
+    (None, None, ['type1'], MIN_DATE, None),
+    (None, ['run1'], None, MIN_DATE, MAX_DATE),
+    (None, None, None, MIN_DATE, MAX_DATE),
+    ([1, 2, 3], None, None, None, None),
+]
+
+
+def plan_step(operation, table, line):
+    """
+    Not a test
+
+    Whether `line` of a query plan is a `operation` (SCAN or SEARCH) of `table`.
+    sqlite before 3.36 writes 'SEARCH TABLE <table>' rather than 'SEARCH <table>'
+    """
+    return re.search(rf'\b{operation}( TABLE)? {table}\b', line) is not None
+
+
+def query_plan(queryset):
+    """
+    Not a test
+    """
+    return queryset.explain().splitlines()
+
+
+def assert_uses_index(plan, table, sorted=True):
+    """
+    Not a test
+
+    Fails if `table` is read without an index, or, if `sorted`, if rows are sorted after being read
+    """
+    for line in plan:
+        if plan_step('SCAN', table, line):
+            assert 'INDEX' in line, plan
+    if sorted:
+        assert not any('TEMP B-TREE' in line for line in plan), plan
+
+
+class TestQueryPlans:
+    """
+    Tests in this suite:
+
+    Filtered histograms (getHistograms) are looked up through an index
+
+    Pages of filtered histograms (getHistogramPage) are read in index order
+
+    Pages of runs (getHistTableEntries) are read in index order
+    """
+
+    def test_filter_histograms(self):
+        for filters in HISTOGRAM_FILTERS[1:]:
+            queryset = _apply_histogram_filters(Histogram.objects.using(STATIC_DATABASE).all(), *filters)
+            plan = query_plan(queryset)
+            assert any(plan_step('SEARCH', 'histograms_histogram', line) for line in plan), plan
+            assert_uses_index(plan, 'histograms_histogram', sorted=False)
+
+    def test_paginate_histograms(self):
+        for filters in HISTOGRAM_FILTERS:
+            queryset = _apply_histogram_filters(Histogram.objects.using(STATIC_DATABASE).all(), *filters)
+            plan = query_plan(queryset.order_by('-created', '-id')[:10])
+            assert_uses_index(plan, 'histograms_histogram', sorted=filters[0] is None)  # A few ids are sorted in memory
+
+    def test_paginate_hist_table(self):
+        for minDate, maxDate in [(None, None), (MIN_DATE, None), (MIN_DATE, MAX_DATE)]:
+            queryset = HistTable.objects.using(STATIC_DATABASE).all()
+            if minDate:
+                queryset = queryset.filter(created__gte=minDate)
+            if maxDate:
+                queryset = queryset.filter(created__lte=maxDate)
+            assert_uses_index(query_plan(queryset.order_by('-created')[:10]), 'histograms_histtable')
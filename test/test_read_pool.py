@@ -0,0 +1,53 @@
+"""
+Test that read-only queries run in parallel while writes stay serialized
+"""
+
+from LANE_server.asgi import application  # Sets up django
+from LANE_server.db import database_read_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from apps.histograms.models import Histogram
+from apps.histograms.common import STATIC_DATABASE
+import asyncio
+import threading
+import pytest
+
+from test.common import run_async
+
+
+class TestReadPool:
+    """
+    Tests in this suite:
+
+    Two reads wait on each other, which only completes if they run at the same time
+
+    Writes run one at a time on the same thread
+    """
+
+    @pytest.mark.skipif(not settings.DATABASE_READ_WORKERS, reason='Reads are serialized with LANE_DB_READ_WORKERS=0')
+    def test_parallel_reads(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        @database_read_async
+        def read():
+            barrier.wait()  # Raises BrokenBarrierError if the other read can't start meanwhile
+            return Histogram.objects.using(STATIC_DATABASE).count()
+
+        async def main():
+            return await asyncio.gather(read(), read())
+
+        first, second = run_async(main())
+        assert first == second
+
+    def test_serialized_writes(self):
+        threads = set()
+
+        @database_sync_to_async
+        def write():
+            threads.add(threading.get_ident())
+
+        async def main():
+            await asyncio.gather(*[write() for _ in range(4)])
+
+        run_async(main())
+        assert len(threads) == 1
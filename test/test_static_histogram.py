@@ -4,20 +4,54 @@ Test queries and mutations related to histograms in the static db
 
 from LANE_server.asgi import application
 from starlette.testclient import TestClient
+from django.core.management import call_command
+from apps.histograms.loader import BatchLoader
+import asyncio
+import threading
+from apps.histograms import pyramid, export, query, mutation
+from apps.histograms.pyramid import build_pyramid
+from apps.histograms.analysis import rebin, summary_stats, aggregate, stats_cache
+from apps.histograms.common import downsample_indices, choose_pyramid_factor, STATIC_DATABASE
+from apps.histograms.models import Histogram, HistogramChunk
 import numpy as np
 import datetime
+import base64
+import csv
+import io
+import json
+import struct
+import subprocess
+import sys
+from pathlib import Path
 
 from test.common import (
     GET_HIST_IDS,
     CREATE_HIST,
+    CREATE_HISTS,
+    GET_HIST_TABLE,
+    GET_HIST_TABLE_HISTOGRAMS,
+    GET_LAST_RUN,
     GET_HISTOGRAM,
     GET_HISTOGRAMS,
+    GET_DOWNSAMPLED_HISTOGRAM,
+    GET_HISTOGRAM_PAGE,
     UPDATE_HIST,
+    APPEND_HIST,
+    FILL_HIST,
+    FILL_HIST_PACKED,
+    AGGREGATE_HISTS,
+    GET_HISTOGRAM_STATS,
+    GET_HISTOGRAMS_STATS,
+    COMPARE_HISTS,
     DELETE_HIST,
     toSvgCoords,
+    run_async,
 )
 
 
+PARSE_TOOL = Path(__file__).resolve().parents[1] / 'worker_threads' / 'fast_daq_worker' / 'tools' / 'parse.py'
+
+
 class TestStaticHistogram:
     """
     Tests in this suite:
@@ -26,9 +60,37 @@ class TestStaticHistogram:
 
     Update histograms in the static db, check that the data is correct
 
+    Append points to histograms in the static db, check that the data is correct
+
+    Append points in chunks, check that they are read back and folded into the histogram
+
+    Fill histograms with raw values, check that the counts are correct
+
     Check getHistogram and getHistograms queries on created histograms
 
+    Check that queries only load the columns of the selected fields
+
+    Check downsampling of histograms via `maxPoints`
+
+    Aggregate histograms with aggregateHistograms, check the combined contents
+
+    Check the summary stats of histograms, before and after appending points
+
+    Compare histograms to a reference with compareHistograms
+
+    Export the histograms of a run as csv and npz
+
+    Import histograms with the import_histograms command
+
+    Import the pulse height spectra of DAQ events printed by parse.py
+
+    Paginate through histograms via getHistogramPage
+
+    Get the histograms of each histogram table entry, batched in a single load
+
     Remove created histograms from static db, check for removal
+
+    Create a batch of histograms in a single request, check the histogram table and batch validation
     """
 
     NUM = 4  # number of fake histograms to create
@@ -161,6 +223,126 @@ class TestStaticHistogram:
 
         assert len(histograms) == self.NUM and all(histsMatch)
 
+    def test_get_histogram_columns(self, monkeypatch):
+        """
+        Queries that do not select `data` do not load the points, and `len` and `stats` still resolve
+        """
+        id = int(next(iter(self.histogram)))
+        expectedStats = self.post_to_test_client(query=GET_HISTOGRAM_STATS, variables={"id": id})['data']['getHistogram']['stats']
+
+        loadedColumns = []
+        from_db = Histogram.from_db.__func__
+
+        def record_columns(cls, db, field_names, values):
+            loadedColumns.append(set(field_names))
+            return from_db(cls, db, field_names, values)
+
+        monkeypatch.setattr(Histogram, 'from_db', classmethod(record_columns))
+        response = self.post_to_test_client(query=GET_HIST_IDS, variables={"ids": list(self.histogram.keys())})
+        assert len(response['data']['getHistograms']) == self.NUM
+        response = self.post_to_test_client(query=GET_HISTOGRAM_STATS, variables={"id": id})
+        assert response['data']['getHistogram'] == {'len': self.LENGTH, 'stats': expectedStats}
+
+        assert loadedColumns and not any('packed' in columns for columns in loadedColumns)
+        assert {'id'} in loadedColumns
+
+    def test_get_histogram_page(self):
+        """
+        Paginate through the created histograms, checking that each is returned once in descending order
+        """
+        ids = list(self.histogram.keys())
+        variables = {"first": self.NUM - 1, "ids": ids}
+        received = []
+        hasNextPage = True
+        while hasNextPage:
+            page = self.post_to_test_client(query=GET_HISTOGRAM_PAGE, variables=variables)['data']['getHistogramPage']
+            assert len(page['edges']) <= self.NUM - 1
+            received += [(edge['node']['created'], int(edge['node']['id'])) for edge in page['edges']]
+            hasNextPage = page['pageInfo']['hasNextPage']
+            variables['after'] = page['pageInfo']['endCursor']
+
+        assert received == sorted(received, reverse=True)
+        assert sorted(id for (_, id) in received) == sorted(ids)
+
+        # Page size is capped by the server
+        page = self.post_to_test_client(query=GET_HISTOGRAM_PAGE, variables={"first": 10**6})['data']['getHistogramPage']
+        assert len(page['edges']) <= 100
+
+    def test_get_hist_table_histograms(self):
+        """
+        Resolve the histograms of table entries and check the loads are batched
+        """
+        response = self.post_to_test_client(query=GET_HIST_TABLE_HISTOGRAMS, variables={"first": 10, "maxPoints": 10})
+        entries = [edge['node'] for edge in response['data']['getHistTableEntries']['edges']]
+        for entry in entries:
+            assert sorted(hist['id'] for hist in entry['histograms']) == sorted(entry['histIDs'])
+            assert all(hist['name'] == entry['name'] and len(hist['data']) <= 10 for hist in entry['histograms'])
+        (entry,) = [entry for entry in entries if entry['name'] == 'unit_test_name']
+        for hist in entry['histograms']:
+            assert hist['len'] == self.expected[int(hist['id'])]['len']
+
+        batches = []
+
+        async def batch_load(keys):
+            batches.append(keys)
+            return {key: key * 2 for key in keys if key != 3}
+
+        async def load_concurrently():
+            loader = BatchLoader(batch_load)
+            return await asyncio.gather(loader.load_many([1, 2]), loader.load_many([2, 3]))
+
+        assert run_async(load_concurrently()) == [[2, 4], [4, None]] and batches == [[1, 2, 3]]
+
+    def test_get_downsampled_histogram(self, monkeypatch):
+        """
+        Downsampled histograms keep at most `maxPoints` points, including the extrema
+        Check with and without precomputed pyramid levels
+        """
+        maxPoints = 10
+        for id in list(self.histogram.keys()) * 2:
+            response = self.post_to_test_client(
+                query=GET_DOWNSAMPLED_HISTOGRAM,
+                variables={"id": id, "maxPoints": maxPoints},
+            )
+            histogram = response['data']['getHistogram']
+            x = [point['x'] for point in histogram['data']]
+            y = [point['y'] for point in histogram['data']]
+
+            assert histogram['len'] == self.LENGTH
+            assert len(histogram['data']) <= maxPoints
+            assert x == sorted(x)
+            assert max(y) == np.amax(self.Y[id]) and min(y) == np.amin(self.Y[id])
+
+            assert build_pyramid(id, 'data') > 0
+
+        # The level used is the coarsest one still holding maxPoints points
+        assert [choose_pyramid_factor(length, 10) for length in (10, 39, 40, 159, 160, 640, 10**6)] == [None, None, 4, 4, 16, 64, 64]
+
+        # Levels built from data that changed during the build are not stored
+        original = Histogram.objects.using('data').values('packed', 'len').get(id=id)
+
+        def append_during_build(y, count):
+            hist = Histogram.objects.using('data').get(id=id)
+            hist.append([{'x': self.LENGTH, 'y': self.HIGH}])
+            hist.save(update_fields=['packed', 'len'])
+            monkeypatch.undo()
+            return downsample_indices(y, count)
+
+        monkeypatch.setattr(pyramid, 'downsample_indices', append_during_build)
+        assert build_pyramid(id, 'data') == 0
+        Histogram.objects.using('data').filter(id=id).update(**original)
+        assert build_pyramid(id, 'data') > 0
+
+        # A single point can't hold both extrema of a bucket
+        for maxPoints in (1, 0, -5):
+            response = self.post_to_test_client(query=GET_DOWNSAMPLED_HISTOGRAM, variables={"id": id, "maxPoints": maxPoints})
+            assert response['data']['getHistogram'] is None and 'maxPoints' in response['errors'][0]['message']
+
+        # NaN values are skipped, as are buckets holding only NaN
+        y = np.array([np.nan, np.nan, np.nan, np.nan, 1, np.nan, 5, 2, np.nan, 3])
+        assert downsample_indices(y, 6).tolist() == [4, 6, 9]
+        assert downsample_indices(np.full(10, np.nan), 4).tolist() == []
+
     def test_get_histograms_filters(self):
         """
         Check if date filter for getHistograms() works
@@ -274,6 +456,242 @@ class TestStaticHistogram:
 
         assert all(histsMatchExpected)
 
+    def test_histogram_stats(self, monkeypatch):
+        """
+        Check summary stats against numpy, and that they follow changes to the data
+        """
+        id = int(next(iter(self.histogram)))
+        y = np.array([point['y'] for point in self.expected[id]['data']], dtype=np.float64)
+        x = np.array([point['x'] for point in self.expected[id]['data']], dtype=np.float64)
+
+        # Stats are computed on the full data even when downsampled
+        response = self.post_to_test_client(query=GET_HISTOGRAM_STATS, variables={"id": id, "maxPoints": 10})
+        stats = response['data']['getHistogram']['stats']
+        centers = x + 0.5
+        assert np.isclose(stats['integral'], y.sum()) and np.isclose(stats['mean'], np.dot(centers, y) / y.sum())
+        assert stats['peak'] == centers[np.argmax(y)] and stats['underflow'] == 0 and stats['overflow'] == 0
+
+        # Cached stats are replaced once points are appended
+        response = self.post_to_test_client(query=APPEND_HIST, variables={"id": id, "points": [{'x': float(x[-1] + 1), 'y': 5.0}]})
+        assert response['data']['appendHistogramPoints']['success']
+        response = self.post_to_test_client(query=GET_HISTOGRAM_STATS, variables={"id": id})
+        assert np.isclose(response['data']['getHistogram']['stats']['overflow'], 5.0)
+        response = self.post_to_test_client(query=UPDATE_HIST, variables={"hist": {"id": id, "data": toSvgCoords(x.tolist(), y.tolist())}})
+        assert response['data']['updateHistogram']['success']
+        response = self.post_to_test_client(query=GET_HISTOGRAM_STATS, variables={"id": id})
+        assert response['data']['getHistogram']['stats'] == stats
+
+        # Stats missing from the cache are computed in a single batch per response
+        batches = []
+        compute_stats = query._compute_stats
+
+        async def record_batch(ids, database_name):
+            batches.append(sorted(ids))
+            return await compute_stats(ids, database_name)
+
+        monkeypatch.setattr(query, '_compute_stats', record_batch)
+        for histId in self.histogram:
+            stats_cache.invalidate('data', histId)
+        response = self.post_to_test_client(query=GET_HISTOGRAMS_STATS, variables={"ids": list(self.histogram.keys())})
+        assert batches == [sorted(self.histogram.keys())]
+        assert np.isclose(next(hist for hist in response['data']['getHistograms'] if int(hist['id']) == id)['stats']['integral'], y.sum())
+
+        # Gaussian peak
+        x = np.arange(-50.0, 50.0)
+        y = np.exp(-((x + 0.5) ** 2) / (2 * 4.0**2))
+        stats = summary_stats(x, y, {'min': -50, 'max': 49})
+        assert np.isclose(stats['rms'], 4.0, rtol=1e-3) and np.isclose(stats['fwhm'], 2.355 * 4.0, rtol=0.02)
+
+    def test_append_histogram_points(self):
+        """
+        Append points to histograms and check if content, len and ranges are as expected
+        """
+        # Hold back the pyramid rebuilds, to query while the levels built before the append are outdated
+        rebuildsHeld = threading.Event()
+        pyramid._executor.submit(rebuildsHeld.wait, 10)
+
+        successFlag = []
+        for id in self.histogram.keys():
+            x = np.arange(self.LENGTH, 2 * self.LENGTH)
+            y = self.rng.integers(low=self.LOW, high=2 * self.HIGH, size=self.LENGTH)
+            points = toSvgCoords(x.tolist(), y.tolist())
+            response = self.post_to_test_client(
+                query=APPEND_HIST,
+                variables={"id": id, "points": points, "widenRanges": True},
+            )
+            successFlag.append(response['data']['appendHistogramPoints']['success'])
+
+            self.expected[id]['data'] = self.expected[id]['data'] + points
+            self.expected[id]['len'] = 2 * self.LENGTH
+            self.expected[id]['xrange'] = {'min': self.expected[id]['xrange']['min'], 'max': float(x[-1])}
+            self.expected[id]['yrange'] = {'min': self.LOW, 'max': max(self.HIGH, int(np.amax(y)))}
+        assert all(successFlag)
+
+        response = self.post_to_test_client(
+            query=GET_HISTOGRAMS,
+            variables={"ids": list(self.histogram.keys())},
+        )
+        histograms = response['data']['getHistograms']
+
+        histsMatch = []
+        for histogram in histograms:
+            id = int(histogram['id'])
+            histsMatch.append(self.compare_histograms(self.expected[id], histogram))
+
+        assert len(histograms) == self.NUM and all(histsMatch)
+
+        # Outdated pyramid levels are not served
+        for id in self.histogram.keys():
+            response = self.post_to_test_client(query=GET_DOWNSAMPLED_HISTOGRAM, variables={"id": id, "maxPoints": 10})
+            y = [point['y'] for point in response['data']['getHistogram']['data']]
+            assert max(y) == max(point['y'] for point in self.expected[id]['data'])
+        rebuildsHeld.set()
+
+    def test_append_chunks(self, monkeypatch):
+        """
+        Small appends are stored as chunks, read back with the rest of the points and folded into the histogram
+        """
+        monkeypatch.setattr(mutation, 'MAX_HISTOGRAM_CHUNKS', 3)
+        id = max(self.histogram) + 1000
+        points = toSvgCoords(list(range(self.LENGTH)), [self.LOW] * self.LENGTH)
+        hist = {'id': id, 'name': 'unit_test_chunks', 'type': 'unit_test_chunks', 'data': points, 'xrange': {'min': 0, 'max': self.LENGTH}, 'yrange': {'min': 0, 'max': 1}, 'isLive': False}
+        response = self.post_to_test_client(query=CREATE_HIST, variables={"hist": hist})
+        assert response['data']['createHistogram']['success']
+
+        chunks = HistogramChunk.objects.using(STATIC_DATABASE).filter(histogram_id=id)
+        for count in (1, 2, 3, 0):  # The fourth append folds the chunks into the histogram
+            added = toSvgCoords([len(points), len(points) + 1], [self.HIGH * len(points), self.LOW])
+            response = self.post_to_test_client(query=APPEND_HIST, variables={"id": id, "points": added})
+            assert response['data']['appendHistogramPoints']['success']
+            points += added
+            assert chunks.count() == count
+
+            response = self.post_to_test_client(query=GET_HISTOGRAMS, variables={"ids": [id]})
+            histogram = response['data']['getHistograms'][0]
+            assert histogram['len'] == len(points) and histogram['data'] == points
+            response = self.post_to_test_client(query=GET_DOWNSAMPLED_HISTOGRAM, variables={"id": id, "maxPoints": 10})
+            assert max(point['y'] for point in response['data']['getHistogram']['data']) == self.HIGH * (len(points) - 2)
+
+        # Chunks are deleted with their histogram, and by overwriting the data
+        self.post_to_test_client(query=APPEND_HIST, variables={"id": id, "points": toSvgCoords([len(points)], [self.LOW])})
+        response = self.post_to_test_client(query=FILL_HIST, variables={"id": id, "values": [0.5]})
+        assert response['data']['fillHistogram']['success'] and not chunks.exists()
+        self.post_to_test_client(query=APPEND_HIST, variables={"id": id, "points": toSvgCoords([len(points)], [self.LOW])})
+        response = self.post_to_test_client(query=DELETE_HIST, variables={"id": id, "isLive": False})
+        assert response['data']['deleteHistogram']['success'] and not chunks.exists()
+
+    def test_fill_histogram(self):
+        """
+        Fill histograms with raw values, as a list and as packed values, and check the counts
+        """
+        values = [0.5, 0.5, 10.2, -3.0, 1e6]  # Two in bin 0, one in bin 10, one underflow, one overflow
+        weights = [1.0, 2.0, 0.5, 1.0, 1.0]
+        for id in self.histogram.keys():
+            response = self.post_to_test_client(query=FILL_HIST, variables={"id": id, "values": values})
+            assert response['data']['fillHistogram']['success']
+
+            packed = {key: base64.b64encode(np.array(array, dtype='<f8').tobytes()).decode('ascii') for (key, array) in (('values', values), ('weights', weights))}
+            response = self.post_to_test_client(query=FILL_HIST_PACKED, variables={"id": id, **packed})
+            assert response['data']['fillHistogramPacked']['success']
+
+            expected = self.expected[id]['data']
+            expected[0] = {'x': expected[0]['x'], 'y': expected[0]['y'] + 2 + 3.0}
+            expected[10] = {'x': expected[10]['x'], 'y': expected[10]['y'] + 1 + 0.5}
+
+            response = self.post_to_test_client(query=GET_HISTOGRAM, variables={"id": id})
+            assert self.compare_histograms(self.expected[id], response['data']['getHistogram'])
+
+    def test_aggregate_histograms(self):
+        """
+        Combine histograms with each aggregate op and compare to numpy
+        """
+        ids = sorted(self.histogram.keys())
+        y = {id: np.array([point['y'] for point in self.expected[id]['data']], dtype=np.float64) for id in ids}
+        total = sum(y.values())
+
+        response = self.post_to_test_client(query=AGGREGATE_HISTS, variables={"selection": {"ids": ids}, "op": "SUM"})
+        result = response['data']['aggregateHistograms']
+        assert [int(id) for id in result['sourceIds']] == ids and result['len'] == 2 * self.LENGTH
+        assert result['data'] == [{'x': point['x'], 'y': yi} for (point, yi) in zip(self.expected[ids[0]]['data'], total.tolist())]
+
+        response = self.post_to_test_client(query=AGGREGATE_HISTS, variables={"selection": {"ids": ids}, "op": "MEAN"})
+        assert np.allclose([point['y'] for point in response['data']['aggregateHistograms']['data']], total / len(ids))
+
+        reference = {"ids": ids[1:]}
+        response = self.post_to_test_client(query=AGGREGATE_HISTS, variables={"selection": {"ids": ids[:1]}, "op": "DIFF", "reference": reference})
+        assert np.allclose([point['y'] for point in response['data']['aggregateHistograms']['data']], y[ids[0]] - (total - y[ids[0]]))
+
+        response = self.post_to_test_client(query=AGGREGATE_HISTS, variables={"selection": {"ids": ids[:1]}, "op": "RATIO", "reference": reference})
+        denominator = total - y[ids[0]]
+        expected = np.divide(y[ids[0]], denominator, out=np.zeros_like(denominator), where=denominator != 0)
+        assert np.allclose([point['y'] for point in response['data']['aggregateHistograms']['data']], expected)
+
+        # RATIO requires a reference
+        response = self.post_to_test_client(query=AGGREGATE_HISTS, variables={"selection": {"ids": ids}, "op": "RATIO"})
+        assert response['data']['aggregateHistograms'] is None and response['errors']
+
+        # The mean of each bin only counts the histograms covering it
+        wide = Histogram(id=0, xrange={'min': 0, 'max': 4}, len=4)
+        wide.data = toSvgCoords([0.0, 1.0, 2.0, 3.0], [2.0, 2.0, 2.0, 2.0])
+        narrow = Histogram(id=1, xrange={'min': 2, 'max': 4}, len=2)
+        narrow.data = toSvgCoords([2.0, 3.0], [4.0, 4.0])
+        empty = Histogram(id=2, xrange={'min': 0, 'max': 4})
+        assert aggregate([wide, narrow, empty], 'MEAN')[1].tolist() == [2, 2, 3, 3]
+
+        # Rebinning conserves the contents
+        assert np.allclose(rebin(np.array([0.0, 2.0]), np.array([4.0, 2.0]), {'min': 0, 'max': 4}, np.arange(5.0)), [2, 2, 1, 1])
+
+    def test_compare_histograms(self):
+        """
+        Compare histograms to the first one and check the scalars against numpy
+        """
+        ids = sorted(int(id) for id in self.histogram.keys())
+        y = {id: np.array([point['y'] for point in self.expected[id]['data']], dtype=np.float64) for id in ids}
+        response = self.post_to_test_client(query=COMPARE_HISTS, variables={"referenceId": ids[0], "candidateIds": ids + [max(ids) + 1000]})
+        comparisons = response['data']['compareHistograms']
+        assert [int(comparison['id']) for comparison in comparisons] == ids
+
+        # A histogram has the same shape as itself
+        assert comparisons[0] == {'id': str(ids[0]), 'chi2': 0.0, 'ndf': int((y[ids[0]] > 0).sum()) - 1, 'ks': 0.0, 'maxResidual': 0.0}
+
+        ref, cand = y[ids[0]] / y[ids[0]].sum(), y[ids[1]] / y[ids[1]].sum()
+        variance = ref / y[ids[0]].sum() + cand / y[ids[1]].sum()
+        residuals = (cand - ref)[variance > 0] / np.sqrt(variance[variance > 0])
+        assert np.isclose(comparisons[1]['chi2'], (residuals**2).sum())
+        assert np.isclose(comparisons[1]['ks'], np.abs(np.cumsum(cand) - np.cumsum(ref)).max())
+        assert np.isclose(comparisons[1]['maxResidual'], np.abs(residuals).max())
+
+    def test_export_histograms(self, monkeypatch):
+        """
+        Export the test run in each format and compare to the expected data
+        """
+        monkeypatch.setattr(export, 'EXPORT_CHUNK_SIZE', 3)  # Read the run in several chunks
+        ids = sorted(int(id) for id in self.histogram.keys())
+        response = self.client.get("/export/histograms/", params={"run": "unit_test_name", "format": "csv"})
+        assert response.status_code == 200
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        for id in ids:
+            points = [{'x': float(row['x']), 'y': float(row['y'])} for row in rows if int(row['id']) == id]
+            assert points == self.expected[id]['data']
+
+        response = self.client.get("/export/histograms/", params={"run": "unit_test_name", "format": "npz"})
+        assert response.status_code == 200
+        with np.load(io.BytesIO(response.content)) as archive:
+            assert sorted(int(hist['id']) for hist in json.loads(archive['histograms.json'])) == ids
+            for id in ids:
+                assert archive[f'{id}.npy'].T.tolist() == [[point['x'], point['y']] for point in self.expected[id]['data']]
+
+        response = self.client.get("/export/histograms/", params={"format": "hdf5"})
+        assert response.status_code == 400
+
+        # Dates without a timezone are accepted, the run name can't break the header
+        response = self.client.get("/export/histograms/", params={"minDate": "2000-01-01 00:00", "format": "csv"})
+        assert response.status_code == 200
+        response = self.client.get("/export/histograms/", params={"minDate": "not a date"})
+        assert response.status_code == 400
+        response = self.client.get("/export/histograms/", params={"run": 'run"\r\nX: é', "format": "csv"})
+        assert response.headers['content-disposition'] == "attachment; filename=\"run___X___.csv\"; filename*=UTF-8''run%22%0D%0AX%3A%20%C3%A9.csv"
+
     def test_delete_histogram(self):
         """
         Delete histograms and confirm removal from the db
@@ -300,3 +718,117 @@ class TestStaticHistogram:
             confirmedRemoval.append(id not in histogramList)
 
         assert all(successFlag) and all(confirmedRemoval)
+
+    def test_import_histograms(self, tmp_path):
+        """
+        Import binned and raw histograms from npy files, then remove them
+        """
+        values = self.rng.uniform(low=0, high=10, size=1000)
+        np.save(tmp_path / 'raw_type.npy', values)
+        np.save(tmp_path / 'binned_type.npy', np.stack((np.arange(self.LENGTH), np.arange(self.LENGTH) ** 2)))
+        call_command('import_histograms', tmp_path / 'raw_type.npy', tmp_path / 'binned_type.npy', run='unit_test_import', bins=10, range=[0, 10])
+
+        response = self.post_to_test_client(query=GET_HISTOGRAMS, variables={"names": ["unit_test_import"]})
+        histograms = {hist['type']: hist for hist in response['data']['getHistograms']}
+        assert [point['y'] for point in histograms['raw_type']['data']] == np.histogram(values, bins=10, range=(0, 10))[0].tolist()
+        assert histograms['raw_type']['xrange'] == {'min': 0, 'max': 10}
+        assert histograms['binned_type']['data'] == toSvgCoords(np.arange(self.LENGTH).tolist(), (np.arange(self.LENGTH) ** 2).tolist())
+
+        response = self.post_to_test_client(query=GET_HIST_TABLE, variables={"first": 1})
+        entry = response['data']['getHistTableEntries']['edges'][0]['node']
+        assert entry['name'] == 'unit_test_import' and sorted(entry['histIDs']) == sorted(hist['id'] for hist in histograms.values())
+
+        for hist in histograms.values():
+            response = self.post_to_test_client(query=DELETE_HIST, variables={"id": hist['id'], "isLive": False})
+            assert response['data']['deleteHistogram']['success']
+
+    def test_import_daq_output(self, tmp_path):
+        """
+        Write raw SIS3316 events, print them with parse.py and import the output, then remove the histograms
+        """
+        samples = 8
+        heights = {0: [], 1: []}
+        with open(tmp_path / 'events.dat', 'wb') as file:
+            for ts in range(200):
+                chan = ts % 2
+                raw = self.rng.integers(low=100, high=110, size=samples)
+                raw[samples // 2] += self.rng.integers(low=0, high=50)
+                heights[chan].append(raw.max() - raw.min())
+                # Channel and format, timestamp, then the raw samples header (0xE, half the number of samples)
+                file.write(struct.pack('<HHHHI', chan << 4, 0, ts, 0, 0xE << 28 | samples // 2))
+                file.write(raw.astype('<i2').tobytes())
+        with open(tmp_path / 'events.txt', 'w') as output:
+            subprocess.run([sys.executable, str(PARSE_TOOL), str(tmp_path / 'events.dat')], stdout=output, stderr=subprocess.DEVNULL, check=True)
+        call_command('import_histograms', tmp_path / 'events.txt', run='unit_test_daq', bins=64, range=[0, 64])
+
+        response = self.post_to_test_client(query=GET_HISTOGRAMS, variables={"names": ["unit_test_daq"]})
+        histograms = {hist['type']: hist for hist in response['data']['getHistograms']}
+        assert sorted(histograms) == ['ch0', 'ch1']
+        for chan, values in heights.items():
+            assert [point['y'] for point in histograms[f'ch{chan}']['data']] == np.histogram(values, bins=64, range=(0, 64))[0].tolist()
+
+        for hist in histograms.values():
+            response = self.post_to_test_client(query=DELETE_HIST, variables={"id": hist['id'], "isLive": False})
+            assert response['data']['deleteHistogram']['success']
+
+    def test_create_histograms_batch(self):
+        """
+        Create a batch of histograms with createHistograms and validate the histogram table entry
+        """
+        response = self.post_to_test_client(query=GET_HIST_IDS, variables={"isLive": False})
+        histogramList = self.make_histogram_list(response["data"]["getHistograms"])
+        startID = int(np.amax(histogramList)) + 1 if histogramList else 0
+        ids = list(range(startID, startID + self.NUM))
+
+        x = np.arange(self.LENGTH)
+        hists = [
+            {
+                'id': id,
+                'data': toSvgCoords(x.tolist(), self.rng.integers(low=self.LOW, high=self.HIGH, size=self.LENGTH).tolist()),
+                'xrange': {'min': float(x[0]), 'max': float(x[-1])},
+                'yrange': {'min': self.LOW, 'max': self.HIGH},
+                'name': 'unit_test_batch',
+                'type': f'unit_test_type{id}',
+                'isLive': False,
+            }
+            for id in ids
+        ]
+        response = self.post_to_test_client(query=CREATE_HISTS, variables={"hists": hists})
+        payload = response['data']['createHistograms']
+        assert payload['success']
+        assert [int(hist['id']) for hist in payload['modifiedHistograms']] == ids
+
+        # All histograms of the batch are in a single table entry
+        response = self.post_to_test_client(query=GET_HIST_TABLE, variables={"first": 1})
+        entry = response['data']['getHistTableEntries']['edges'][0]['node']
+        assert entry['name'] == 'unit_test_batch'
+        assert sorted(int(id) for id in entry['histIDs']) == ids
+        response = self.post_to_test_client(query=GET_LAST_RUN, variables={})
+        assert response['data']['getLastRun'] == 'unit_test_batch'
+
+        # Resending the batch fails as a whole
+        response = self.post_to_test_client(query=CREATE_HISTS, variables={"hists": hists})
+        assert not response['data']['createHistograms']['success']
+
+        # Invalid histograms reject the batch before anything is written
+        invalid = [
+            {**hists[0], 'id': startID + self.NUM, 'name': 'unit_test_invalid'},
+            {**hists[1], 'id': startID + self.NUM + 1, 'name': 'unit_test_invalid', 'type': 'x' * 101},
+        ]
+        response = self.post_to_test_client(query=CREATE_HISTS, variables={"hists": invalid})
+        assert not response['data']['createHistograms']['success'] and 'is invalid' in response['data']['createHistograms']['message']
+        invalid[1] = {**hists[1], 'id': startID + self.NUM + 1, 'name': 'unit_test_invalid', 'yrange': {'min': 1, 'max': 0}}
+        response = self.post_to_test_client(query=CREATE_HISTS, variables={"hists": invalid})
+        assert not response['data']['createHistograms']['success'] and 'min above max' in response['data']['createHistograms']['message']
+        assert not Histogram.objects.using(STATIC_DATABASE).filter(id=startID + self.NUM).exists()
+
+        # Cleanup
+        successFlag = []
+        for id in ids:
+            response = self.post_to_test_client(query=DELETE_HIST, variables={"id": id, "isLive": False})
+            successFlag.append(response['data']['deleteHistogram']['success'])
+        assert all(successFlag)
+
+        # The run is gone along with its last histogram
+        response = self.post_to_test_client(query=GET_LAST_RUN, variables={})
+        assert response['data']['getLastRun'] != 'unit_test_batch'
@@ -4,7 +4,19 @@ Test subscriptions
 
 from LANE_server.asgi import application
 from starlette.testclient import TestClient
+from django.conf import settings
+from apps.histograms.broadcast import SnapshotBroadcaster
+from apps.histograms import subscription
+from apps.histograms.subscription import _min_frame_interval
+from apps.histograms.common import decode_packed_values, LIVE_DATABASE
+from apps.histograms.hub import histogram_hub
+from apps.histograms.models import Histogram
+from channels.db import database_sync_to_async
 import numpy as np
+import asyncio
+import contextlib
+import itertools
+import time
 
 from ariadne.asgi import (
     GQL_CONNECTION_ACK,
@@ -18,9 +30,13 @@ from ariadne.asgi import (
 
 from test.common import (
     CREATE_HIST,
+    APPEND_HIST,
     DELETE_HIST,
     LIVE_HIST_SUBSCRIPTION,
+    LIVE_HIST_DELTA_SUBSCRIPTION,
+    PACED_LIVE_HIST_SUBSCRIPTION,
     toSvgCoords,
+    run_async,
 )
 
 
@@ -32,10 +48,18 @@ class TestSubscription:
 
     Validate lastRun string on subscription when no live histograms present
 
+    Connect several websockets at once, check that all receive the shared snapshot
+
+    Subscribe with a max frame rate, check that slow subscribers only get the latest frame
+
+    Check that live changes of other server processes wake up the broadcaster, and static ones don't
+
     Create liveHistograms, and validate content
 
     Update liveHistograms, and validate content
 
+    Append to liveHistograms, and validate the delta-encoded subscription
+
     Delete liveHistograms, and validate removal
     """
 
@@ -125,6 +149,125 @@ class TestSubscription:
             assert response["type"] == GQL_COMPLETE
             ws.send_json({"type": GQL_CONNECTION_TERMINATE})
 
+    def test_concurrent_subscribers(self):
+        """
+        Validate that several simultaneous subscribers all receive the same snapshot
+        """
+        with self.client.websocket_connect("/graphql/", "graphql-ws") as ws1, self.client.websocket_connect("/graphql/", "graphql-ws") as ws2:
+            for ws in (ws1, ws2):
+                ws.send_json({"type": GQL_CONNECTION_INIT})
+                ws.send_json(
+                    {
+                        "type": GQL_START,
+                        "id": self.ID,
+                        "payload": {"query": LIVE_HIST_SUBSCRIPTION},
+                    }
+                )
+            frames = []
+            for ws in (ws1, ws2):
+                response = ws.receive_json()
+                assert response["type"] == GQL_CONNECTION_ACK
+                response = ws.receive_json()
+                assert response["type"] == GQL_DATA
+                frames.append(response["payload"]["data"])
+
+            for ws in (ws1, ws2):
+                ws.send_json({"type": GQL_STOP, "id": self.ID})
+                response = ws.receive_json()
+                assert response["type"] == GQL_COMPLETE
+                ws.send_json({"type": GQL_CONNECTION_TERMINATE})
+
+        assert self.check_subscription_data_structure(frames[0]) and frames[0] == frames[1]
+
+    def test_slow_subscribers(self, monkeypatch):
+        """
+        Validate frame rate limits and the server-side cap, and that frames are dropped for a subscriber that falls behind
+        """
+        with self.client.websocket_connect("/graphql/", "graphql-ws") as ws:
+            ws.send_json({"type": GQL_CONNECTION_INIT})
+            ws.send_json({"type": GQL_START, "id": self.ID, "payload": {"query": PACED_LIVE_HIST_SUBSCRIPTION, "variables": {"maxFrameRate": 2}}})
+            assert ws.receive_json()["type"] == GQL_CONNECTION_ACK
+            response = ws.receive_json()
+            assert response["type"] == GQL_DATA and response["payload"]["data"]["getLiveHistograms"]["droppedFrames"] == 0
+            ws.send_json({"type": GQL_STOP, "id": self.ID})
+            assert ws.receive_json()["type"] == GQL_COMPLETE
+
+            ws.send_json({"type": GQL_START, "id": self.ID, "payload": {"query": PACED_LIVE_HIST_SUBSCRIPTION, "variables": {"maxFrameRate": 0}}})
+            response = ws.receive_json()
+            assert response["type"] == GQL_DATA and response["payload"]["errors"]
+            ws.send_json({"type": GQL_CONNECTION_TERMINATE})
+
+        # Clients can only lower the server-side cap
+        monkeypatch.setattr(settings, 'SUBSCRIPTION_MAX_FRAME_RATE', 4)
+        assert _min_frame_interval(None) == 0.25 and _min_frame_interval(10) == 0.25 and _min_frame_interval(2) == 0.5
+        monkeypatch.setattr(settings, 'SUBSCRIPTION_MAX_FRAME_RATE', 0)
+        assert _min_frame_interval(None) == 0 and _min_frame_interval(10) == 0.1
+
+        async def fall_behind():
+            snapshots = itertools.count()
+
+            async def build_snapshot():
+                return next(snapshots)
+
+            async def wait_for_change(listener):
+                await asyncio.sleep(0.01)
+
+            broadcaster = SnapshotBroadcaster(build_snapshot, wait_for_change, self.HubStub())
+            with broadcaster.subscribe() as mailbox:
+                frames = mailbox.frames(minInterval=0.2)
+                first = await frames.__anext__()
+                second = await frames.__anext__()  # Snapshots built in the meantime are dropped
+            return first, second, mailbox.dropped, broadcaster.droppedFrames
+
+        first, second, dropped, droppedFrames = run_async(fall_behind())
+        assert first == 0 and second > 1 and dropped == second - 1 and droppedFrames == dropped
+
+    class HubStub:
+        """
+        Not a test
+
+        Hub without any events
+        """
+
+        @contextlib.contextmanager
+        def listen(self):
+            yield None
+
+    def test_wait_for_change(self, monkeypatch):
+        """
+        Live changes wake up the broadcaster, through the hub or through the live database
+        for changes of other processes, while events of static histograms are ignored
+        """
+        monkeypatch.setattr(subscription, 'SUB_SLEEP_TIME', 0.02)
+        monkeypatch.setattr(subscription, 'SUB_MAX_IDLE_TIME', 0.5)
+        monkeypatch.setattr(subscription, 'get_live_store', lambda create: None)
+
+        @database_sync_to_async
+        def create_in_other_process():
+            Histogram.objects.using(LIVE_DATABASE).create(id=987654321, name='other process')
+
+        async def publish_static():
+            histogram_hub.publish('update', 1, isLive=False)
+
+        async def publish_live():
+            histogram_hub.publish('update', 1, isLive=True)
+
+        async def seconds_until_woken(change):
+            with histogram_hub.listen() as listener:
+                waiting = asyncio.ensure_future(subscription._wait_for_change(listener))
+                await asyncio.sleep(0.05)
+                start = time.monotonic()
+                await change()
+                await waiting
+                return time.monotonic() - start
+
+        try:
+            assert run_async(seconds_until_woken(publish_static)) > 0.3
+            assert run_async(seconds_until_woken(publish_live)) < 0.3
+            assert run_async(seconds_until_woken(create_in_other_process)) < 0.3
+        finally:
+            Histogram.objects.using(LIVE_DATABASE).filter(id=987654321).delete()
+
     def test_add_live_histograms_content(self):
         """
         Creates live histograms. Validate that subscription returns the expected content
@@ -193,9 +336,58 @@ class TestSubscription:
         for histogram in histograms:
             id = int(histogram['id'])
             histsMatch.append(self.compare_histograms(self.expected[id], histogram))
+            histsMatch.append(toSvgCoords(decode_packed_values(histogram['packedX']).tolist(), decode_packed_values(histogram['packedY']).tolist()) == histogram['data'])
 
         assert len(histograms) == self.NUM and all(histsMatch)
 
+    def test_live_histogram_deltas(self):
+        """
+        Validate that the delta subscription sends a full snapshot, followed by appended points only
+        """
+        ID = f'{self.ID}_delta'
+        with self.client.websocket_connect("/graphql/", "graphql-ws") as ws:
+            ws.send_json({"type": GQL_CONNECTION_INIT})
+            ws.send_json(
+                {
+                    "type": GQL_START,
+                    "id": ID,
+                    "payload": {"query": LIVE_HIST_DELTA_SUBSCRIPTION},
+                }
+            )
+            response = ws.receive_json()
+            assert response["type"] == GQL_CONNECTION_ACK
+            response = ws.receive_json()
+            assert response["type"] == GQL_DATA
+            snapshot = response["payload"]["data"]['getLiveHistogramDeltas']
+
+            assert snapshot['isSnapshot']
+            assert sorted(int(id) for id in snapshot['createdIds']) == sorted(self.histogram.keys())
+            for delta in snapshot['changed']:
+                id = int(delta['id'])
+                assert delta['isFull'] and delta['points'] == self.expected[id]['data']
+
+            # Append a single point to one histogram. Only that point should be sent
+            id = next(iter(self.histogram))
+            point = {'x': float(self.LENGTH), 'y': float(self.HIGH)}
+            response = self.post_to_test_client(query=APPEND_HIST, variables={"id": id, "points": [point], "isLive": True})
+            assert response['data']['appendHistogramPoints']['success']
+
+            response = ws.receive_json()
+            assert response["type"] == GQL_DATA
+            frame = response["payload"]["data"]['getLiveHistogramDeltas']
+
+            ws.send_json({"type": GQL_STOP, "id": ID})
+            response = ws.receive_json()
+            assert response["type"] == GQL_COMPLETE
+            ws.send_json({"type": GQL_CONNECTION_TERMINATE})
+
+        assert not frame['isSnapshot'] and frame['createdIds'] == [] and frame['deletedIds'] == []
+        assert len(frame['changed']) == 1
+        delta = frame['changed'][0]
+        assert int(delta['id']) == id and not delta['isFull']
+        assert delta['points'] == [point] and delta['current'] == point and delta['len'] == self.LENGTH + 1
+        assert decode_packed_values(delta['packedX']).tolist() == [point['x']] and decode_packed_values(delta['packedY']).tolist() == [point['y']]
+
     def test_delete_live_histograms_content(self):
         """
         Delete live histograms. Validate that subscription returns the expected content
@@ -0,0 +1,119 @@
+"""
+Test the write-behind buffer of histogram updates
+"""
+
+from LANE_server.asgi import application
+from starlette.testclient import TestClient
+from django.conf import settings
+from apps.histograms import writebehind
+from apps.histograms.writebehind import WriteBehindBuffer
+from apps.histograms.models import Histogram
+from apps.histograms.common import LIVE_DATABASE
+import time
+
+from test.common import (
+    CREATE_HIST,
+    UPDATE_HIST,
+    APPEND_HIST,
+    GET_HISTOGRAM,
+    GET_HISTOGRAM_STATS,
+    DELETE_HIST,
+    toSvgCoords,
+)
+
+
+class TestWriteBehind:
+    """
+    Tests in this suite:
+
+    Merge repeated updates in memory, serve them to queries and save them before the next mutation
+
+    Save pending updates once the window elapses, and notify the flush listeners
+    """
+
+    ID = 31
+
+    def post_to_test_client(self, client, query, variables):
+        """
+        Not a test
+        """
+        response = client.post("/graphql/", json={"query": query, "variables": variables})
+        assert response.status_code == 200
+        return response.json()
+
+    def saved_type(self):
+        """
+        Not a test
+        """
+        return Histogram.objects.using(LIVE_DATABASE).get(id=self.ID).type
+
+    def create_histogram(self, client):
+        """
+        Not a test
+        """
+        hist = {'id': self.ID, 'name': 'unit_test_name', 'type': 'unit_test_type', 'data': toSvgCoords([0, 1], [5, 6]), 'xrange': {'min': 0, 'max': 1}, 'yrange': {'min': 0, 'max': 6}, 'isLive': True}
+        assert self.post_to_test_client(client, CREATE_HIST, {"hist": hist})['data']['createHistogram']['success']
+
+    def test_updates_are_coalesced(self, monkeypatch):
+        """
+        Update a histogram several times without writing to the db, then append to it
+        """
+        buffer = WriteBehindBuffer(window=60, maxPending=16)
+        monkeypatch.setitem(settings.WRITE_BEHIND, 'ENABLED', True)
+        monkeypatch.setitem(settings.LIVE_STORE, 'ENABLED', False)  # Live histograms in the store bypass the buffer
+        monkeypatch.setattr(writebehind, '_buffer', buffer)
+        client = TestClient(application)
+
+        self.create_histogram(client)
+        for type in ('unit_test_type_a', 'unit_test_type_b'):
+            response = self.post_to_test_client(client, UPDATE_HIST, {"hist": {'id': self.ID, 'type': type, 'isLive': True}})
+            assert response['data']['updateHistogram']['success']
+        response = self.post_to_test_client(client, UPDATE_HIST, {"hist": {'id': self.ID, 'yrange': {'min': 0, 'max': 10}, 'isLive': True}})
+        assert response['data']['updateHistogram']['success']
+        response = self.post_to_test_client(client, UPDATE_HIST, {"hist": {'id': self.ID, 'data': toSvgCoords([0, 1], [7, 8]), 'isLive': True}})
+        assert response['data']['updateHistogram']['success']
+        assert self.saved_type() == 'unit_test_type'
+
+        response = self.post_to_test_client(client, GET_HISTOGRAM, {"id": self.ID, "isLive": True})
+        assert response['data']['getHistogram']['type'] == 'unit_test_type_b'
+        assert response['data']['getHistogram']['yrange'] == {'min': 0, 'max': 10}
+        assert response['data']['getHistogram']['data'] == toSvgCoords([0, 1], [7, 8])
+
+        # Stats are computed from the pending data
+        response = self.post_to_test_client(client, GET_HISTOGRAM_STATS, {"id": self.ID, "isLive": True})
+        assert response['data']['getHistogram']['stats']['integral'] == 15
+
+        # Other mutations save the pending updates first
+        response = self.post_to_test_client(client, APPEND_HIST, {"id": self.ID, "points": [{'x': 2, 'y': 7}], "isLive": True})
+        assert response['data']['appendHistogramPoints']['success']
+        saved = Histogram.objects.using(LIVE_DATABASE).get(id=self.ID)
+        assert (saved.type, saved.yrange, saved.len) == ('unit_test_type_b', {'min': 0, 'max': 10}, 3)
+        assert saved.data == toSvgCoords([0, 1, 2], [7, 8, 7])
+        assert buffer.pending(LIVE_DATABASE, self.ID) is None
+        assert self.post_to_test_client(client, DELETE_HIST, {"id": self.ID, "isLive": True})['data']['deleteHistogram']['success']
+
+    def test_flush_after_window(self, monkeypatch):
+        """
+        Pending updates are saved within the window, and deleting a histogram drops its updates
+        """
+        buffer = WriteBehindBuffer(window=0.1, maxPending=16)
+        monkeypatch.setitem(settings.WRITE_BEHIND, 'ENABLED', True)
+        monkeypatch.setitem(settings.LIVE_STORE, 'ENABLED', False)  # Live histograms in the store bypass the buffer
+        monkeypatch.setattr(writebehind, '_buffer', buffer)
+        flushed = []
+        monkeypatch.setattr(writebehind, 'flush_listeners', writebehind.flush_listeners + [flushed.extend])
+        client = TestClient(application)
+
+        self.create_histogram(client)
+        response = self.post_to_test_client(client, UPDATE_HIST, {"hist": {'id': self.ID, 'type': 'unit_test_type_c', 'isLive': True}})
+        assert response['data']['updateHistogram']['success']
+        deadline = time.monotonic() + 5
+        while not flushed and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert flushed == [(LIVE_DATABASE, self.ID, {'type'})]
+        assert self.saved_type() == 'unit_test_type_c'
+
+        response = self.post_to_test_client(client, UPDATE_HIST, {"hist": {'id': self.ID, 'type': 'unit_test_type_d', 'isLive': True}})
+        assert self.post_to_test_client(client, DELETE_HIST, {"id": self.ID, "isLive": True})['data']['deleteHistogram']['success']
+        buffer.flush()
+        assert not Histogram.objects.using(LIVE_DATABASE).filter(id=self.ID).exists()